@@ -10,6 +10,7 @@ import string
 from observation_stations import MesoWestStation
 from multiprocessing import Pool, Queue, Process
 from spatial_model_utilities import great_circle_distance
+from frame_writer import read_frame
 from datetime import datetime
 
 num_workers = 16
@@ -19,6 +20,10 @@ data = []
 def file_loader_slave(x):
     i, fname = x
 
+    # binary frames from the python prototype
+    if fname.endswith(".npz"):
+        return i, read_frame(fname)
+
     # read in the file
     with open(fname, "r") as f:
         d = eval(f.read())
@@ -126,6 +131,9 @@ if __name__ == '__main__':
     lst = glob.glob(os.path.join(path, "frame*"))
     N = len(lst)
 
+    # frames are text (julia prototype) or .npz files (python prototype)
+    ext = ".npz" if os.path.exists(os.path.join(path, "frame1.npz")) else ""
+
     print("Will compute %s from %d frames." % (str(what), N))
 
     # construct all subdirectories
@@ -135,7 +143,7 @@ if __name__ == '__main__':
     print("Loading the output data.")
     pool = Pool(16)
     data = [None] * N
-    read_job_list = [ (i, os.path.join(path, "frame%d" % i)) for i in range(1, N+1) ]
+    read_job_list = [ (i, os.path.join(path, "frame%d%s" % (i, ext))) for i in range(1, N+1) ]
     read_res = pool.map(file_loader_slave, read_job_list)
     for i,di in read_res:
         data[i-1] = di
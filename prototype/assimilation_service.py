@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Resident assimilation service.  The service keeps the state of the operational
+cycling (see operational_cycling.py) in memory, cycles new WRF files on a background
+thread and serves requests on a local Unix socket ('service_socket' : path) or on
+a TCP port of localhost ('service_port' : port).  Requests and replies are JSON
+objects, one per line:
+
+    { "cmd" : "ingest", "obs" : [ { "station" : "AAA01", "value" : 0.12 },
+                                  { "lat" : 39.5, "lon" : -105.1, "value" : 0.09, "variance" : 1e-4,
+                                    "time" : "2012-06-01 02:00:00" } ] }
+    { "cmd" : "point", "lat" : 39.5, "lon" : -105.1 }
+    { "cmd" : "bbox", "lat" : [ 39.4, 39.6 ], "lon" : [ -105.2, -105.0 ], "fields" : [ "fm10" ] }
+    { "cmd" : "status" }
+
+Ingested observations are assimilated into the current state right away (kriging and
+Kalman update), observations farther than 'assimilation_time_window' seconds from the
+current model time are rejected.  Queries are answered from the last analysis without
+touching the models.  The state is saved at the end of each cycle, a restarted service
+resumes from it (observations ingested after the last cycle are not saved).
+
+    python assimilation_service.py cfg/col_1km_service.cfg
+
+"""
+
+from operational_cycling import CyclingAssimilation
+from observation_stations import Station, Observation
+from spatial_model_utilities import find_closest_grid_point
+from diagnostics import init_diagnostics, diagnostics
+
+from datetime import datetime
+import SocketServer
+import numpy as np
+import threading
+import socket
+import pytz
+import json
+import time
+import sys
+import os
+
+
+# the fields of the analysis that can be queried
+analysis_fields = [ 'fm1', 'fm10', 'fm100', 'fm10_var', 'fm10_na' ]
+
+
+class AssimilationService:
+    """
+    Holds the model state and the current analysis and serves the requests.  Changes
+    of the model state are serialized by a lock, queries read the last analysis.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.cycling = CyclingAssimilation(cfg)
+        self.lock = threading.Lock()
+        self.analysis = None
+        self.num_ingested = 0
+        self.window = cfg.get('assimilation_time_window', 0)
+
+        # continue from the saved state without waiting for a new WRF file
+        c = self.cycling
+        if len(c.processed) > 0:
+            c.resume(sorted(c.processed)[-1])
+            self.update_analysis()
+
+
+    def update_analysis(self):
+        """
+        Take a snapshot of the model state for the queries.
+        """
+        c = self.cycling
+        S = c.models.get_state()
+        P = c.models.get_state_covar()
+        self.analysis = { 'time' : c.last_time,
+                          'fm1' : S[:,:,0].copy(),
+                          'fm10' : S[:,:,1].copy(),
+                          'fm100' : S[:,:,2].copy(),
+                          'fm10_var' : P[:,:,1,1].copy(),
+                          'fm10_na' : c.models_na.get_state()[:,:,1].copy(),
+                          'lat' : c.wrf_data.get_lats(),
+                          'lon' : c.wrf_data.get_lons() }
+
+
+    def cycle_forever(self):
+        """
+        Poll the watched directory and cycle new WRF files (runs on a background thread).
+        """
+        poll_interval = self.cfg.get('poll_interval', 5.0)
+        while True:
+            for fn in self.cycling.find_new_files():
+                with self.lock:
+                    self.cycling.run_cycle(fn)
+                    self.update_analysis()
+            time.sleep(poll_interval)
+
+
+    def make_observation(self, o, stations):
+        """
+        Construct an Observation from the request item o, the observation is either
+        from a known station or at a given position.
+        """
+        c = self.cycling
+        if 'station' in o:
+            s = stations[o['station']]
+        else:
+            s = Station()
+            s.id = s.name = 'lat%g_lon%g' % (o['lat'], o['lon'])
+            s.lat, s.lon = o['lat'], o['lon']
+            s.register_to_grid(c.wrf_data)
+
+        tm = c.last_time
+        if o.get('time') is not None:
+            tm = datetime.strptime(o['time'], '%Y-%m-%d %H:%M:%S').replace(tzinfo = pytz.timezone('GMT'))
+        return Observation(s, tm, float(o['value']), float(o.get('variance', self.cfg.get('service_obs_variance', 1e-4))), c.obs_var)
+
+
+    def ingest(self, req):
+        """
+        Assimilate a batch of observations into the current state.
+        """
+        c = self.cycling
+        with self.lock:
+            stations = dict([ (s.get_id(), s) for s in c.stations ])
+            obs = []
+            rejected = 0
+            for o in req['obs']:
+                if 'station' in o and o['station'] not in stations:
+                    rejected += 1
+                    continue
+                ob = self.make_observation(o, stations)
+                if abs((ob.get_time() - c.last_time).total_seconds()) > self.window:
+                    rejected += 1
+                    continue
+                obs.append(ob)
+
+            if len(obs) > 0:
+                ngp = [ ob.get_nearest_grid_point() for ob in obs ]
+                gi = np.array([ p[0] for p in ngp ], dtype = np.intp)
+                gj = np.array([ p[1] for p in ngp ], dtype = np.intp)
+                obs_vals = np.array([ ob.get_value() for ob in obs ])
+                c.assimilate_observations(obs, obs_vals, (gi, gj), c.wrf_data)
+                self.num_ingested += len(obs)
+                self.update_analysis()
+
+        return { 'assimilated' : len(obs), 'rejected' : rejected, 'time' : str(c.last_time) }
+
+
+    def point(self, req):
+        """
+        Return the analysis at the grid point nearest to the requested position.
+        """
+        a = self.analysis
+        i, j = find_closest_grid_point(req['lon'], req['lat'], a['lon'], a['lat'])
+        rep = dict([ (fn, float(a[fn][i,j])) for fn in analysis_fields ])
+        rep.update({ 'time' : str(a['time']), 'i' : int(i), 'j' : int(j),
+                     'grid_lat' : float(a['lat'][i,j]), 'grid_lon' : float(a['lon'][i,j]) })
+        return rep
+
+
+    def bbox(self, req):
+        """
+        Return the block of the analysis covering the grid points in the requested box.
+        """
+        a = self.analysis
+        lat0, lat1 = req['lat']
+        lon0, lon1 = req['lon']
+        inside = (a['lat'] >= lat0) & (a['lat'] <= lat1) & (a['lon'] >= lon0) & (a['lon'] <= lon1)
+        rows, cols = np.nonzero(np.any(inside, axis = 1))[0], np.nonzero(np.any(inside, axis = 0))[0]
+        if len(rows) == 0:
+            return { 'time' : str(a['time']), 'shape' : [ 0, 0 ] }
+
+        sl = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        rep = { 'time' : str(a['time']), 'i0' : int(rows[0]), 'j0' : int(cols[0]),
+                'shape' : [ int(rows[-1] - rows[0] + 1), int(cols[-1] - cols[0] + 1) ] }
+        for fn in req.get('fields', [ 'fm10' ]) + [ 'lat', 'lon' ]:
+            rep[fn] = a[fn][sl].tolist()
+        return rep
+
+
+    def status(self, req):
+        a = self.analysis
+        return { 'time' : str(a['time']) if a is not None else None,
+                 'shape' : list(a['fm10'].shape) if a is not None else None,
+                 'ingested' : self.num_ingested,
+                 'processed_files' : len(self.cycling.processed) }
+
+
+    def handle(self, req):
+        """
+        Execute the request req and return the reply.
+        """
+        cmd = req.get('cmd')
+        if cmd not in [ 'ingest', 'point', 'bbox', 'status' ]:
+            raise ValueError('Unknown command [%s].' % cmd)
+        if cmd != 'status' and self.analysis is None:
+            raise ValueError('No analysis is available yet.')
+        return getattr(self, cmd)(req)
+
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads JSON requests (one per line) and writes one JSON reply per request.
+    """
+
+    def handle(self):
+        while True:
+            l = self.rfile.readline()
+            if not l:
+                break
+            try:
+                rep = self.server.service.handle(json.loads(l))
+                rep['ok'] = True
+            except Exception as e:
+                rep = { 'ok' : False, 'error' : str(e) }
+            self.wfile.write((json.dumps(rep) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+def make_server(cfg, service):
+    """
+    Construct the socket server of the service as configured in cfg.
+    """
+    if cfg.get('service_socket') is not None:
+        path = cfg['service_socket']
+        if os.path.exists(path):
+            os.remove(path)
+        server = _UnixServer(path, _RequestHandler)
+    else:
+        server = _TCPServer(('127.0.0.1', cfg.get('service_port', 8765)), _RequestHandler)
+    server.service = service
+    return server
+
+
+def service_request(cfg, req):
+    """
+    Send the request req to the service configured in cfg and return the reply.
+    """
+    if cfg.get('service_socket') is not None:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(cfg['service_socket'])
+    else:
+        s = socket.create_connection(('127.0.0.1', cfg.get('service_port', 8765)))
+    f = s.makefile('rwb')
+    f.write((json.dumps(req) + '\n').encode('utf-8'))
+    f.flush()
+    rep = json.loads(f.readline())
+    f.close()
+    s.close()
+    return rep
+
+
+
+if __name__ == '__main__':
+
+    # read in configuration file to execute run
+    print("Reading configuration from [%s]" % sys.argv[1])
+
+    with open(sys.argv[1]) as f:
+        cfg = eval(f.read())
+
+    # ensure output path exists
+    if not os.path.isdir(cfg['output_dir']):
+        os.mkdir(cfg['output_dir'])
+
+    # configure diagnostics
+    init_diagnostics(os.path.join(cfg['output_dir'], 'service_diagnostics.txt'))
+    diagnostics().configure_tag("cycle_assim", True, True, False)
+
+    service = AssimilationService(cfg)
+    cycler = threading.Thread(target = service.cycle_forever)
+    cycler.daemon = True
+    cycler.start()
+
+    server = make_server(cfg, service)
+    print("INFO: serving requests on [%s]." % str(server.server_address))
+    server.serve_forever()
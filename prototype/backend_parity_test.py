@@ -0,0 +1,64 @@
+
+import model_backends
+
+import numpy as np
+
+
+def make_inputs():
+    """
+    A small synthetic grid with a drying, a raining and a wetting row and two observed
+    fuel types.  No cell is between the equilibria: there the linearization in
+    cell_model.py differs from cell_model_opt.pyx (which the numba backend follows).
+    """
+    Ny, Nx, k = 3, 4, 3
+    lat, lon = np.mgrid[39.0:39.3:Ny*1j, -105.0:-104.6:Nx*1j]
+    E = np.linspace(0.05, 0.2, Ny*Nx).reshape((Ny, Nx))
+    Ed = E - 0.02
+    Ew = E - 0.03
+    Ed[2,:] = E[2,:] + 0.03
+    Ew[2,:] = E[2,:] + 0.02
+    rain = np.zeros((Ny, Nx))
+    rain[1,:] = 2.0
+    Tk = np.array([1.0, 10.0, 100.0]) * 3600
+    P0 = np.eye(2*k+3) * 0.01
+    O = [ np.ones((Ny, Nx)) * 0.2, np.ones((Ny, Nx)) * 0.25 ]
+    V = [ np.ones((Ny, Nx)) * 0.01, np.ones((Ny, Nx)) * 0.02 ]
+    return lat, lon, k, E, Ed, Ew, rain, Tk, P0, O, V
+
+
+def run_backend(name):
+    """
+    Run one advance and one Kalman update with the backend name, return the state,
+    its covariance and the Kalman gains.
+    """
+    lat, lon, k, E, Ed, Ew, rain, Tk, P0, O, V = make_inputs()
+    backend = model_backends._backend_loaders[name]()
+    models = backend.create_grid(lat, lon, k, E, Tk, P0)
+    models.advance(Ed, Ew, rain, 3600.0, np.eye(2*k+3) * 1e-4)
+    Kg = models.kalman_update(O, V, [1, 2])
+    return np.array(models.get_state()), np.array(models.get_state_covar()), np.array(Kg)
+
+
+def test_backend_parity():
+    """
+    The compiled backends must reproduce the pure python CellMoistureModel.
+    """
+    ref = run_backend('numpy')
+    for name in [ 'numba', 'cython' ]:
+        try:
+            res = run_backend(name)
+        except ImportError as e:
+            print("WARN: skipping backend [%s] (%s)." % (name, str(e)))
+            continue
+        for what, r, x in zip([ 'state', 'covariance', 'gain' ], ref, res):
+            err = np.amax(np.abs(r - x))
+            print("INFO: backend [%s] %s max abs difference %g" % (name, what, err))
+            assert err < 1e-10, 'backend [%s] %s differs from numpy by %g' % (name, what, err)
+
+
+def run_module():
+    test_backend_parity()
+
+
+if __name__ == '__main__':
+    run_module()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the no-assimilation (baseline) model trajectory.  The baseline depends
+only on the WRF input, the time range, the initial state, the fuel time lags, the
+storage type of the derived forcing (see forcing_cache.py) and the model backend,
+so it is computed once and stored as a (time x Ny x Nx x k) array in a .npy file
+named by a hash of these inputs.  Runs and postprocessing scripts read the
+trajectory through a memory map instead of recomputing it.
+
+"""
+
+from wrf_series import wrf_files
+
+import numpy as np
+import hashlib
+import os
+
+
+def file_digest(file_name, chunk_size = 1 << 20):
+    """
+    Compute the sha1 digest of the contents of the file file_name.
+    """
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def baseline_key(input_file, times, Tk, m_init, forcing_dtype, backend_name):
+    """
+    Compute the key of the baseline trajectory of the model started from the extended
+    state m_init and driven by the WRF file input_file over the list of times with
+    fuel time lags Tk.  The forcing is derived from the WRF file and stored in
+    forcing_dtype, the model is advanced by the backend backend_name.
+    """
+    h = hashlib.sha1()
+    for fn in wrf_files(input_file):
+        h.update(file_digest(fn).encode('ascii'))
+    h.update(','.join([t.strftime('%Y%m%d_%H%M%S') for t in times]).encode('ascii'))
+    h.update(np.ascontiguousarray(Tk, dtype = np.float64))
+    h.update(str(m_init.shape).encode('ascii'))
+    h.update(np.ascontiguousarray(m_init, dtype = np.float64))
+    h.update(('%s|%s' % (forcing_dtype, backend_name)).encode('ascii'))
+    return h.hexdigest()[:16]
+
+
+
+class BaselineWriter:
+    """
+    Writes a baseline trajectory into the cache, the entry becomes visible
+    to lookups only after commit.
+    """
+
+    def __init__(self, tmp_path, path, shape):
+        self.tmp_path = tmp_path
+        self.path = path
+        self.fm = np.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = np.float64, shape = shape)
+
+
+    def store(self, t, f):
+        """
+        Store the moisture fields f (Ny x Nx x k) valid at time index t.
+        """
+        self.fm[t] = f
+
+
+    def commit(self):
+        """
+        Flush the trajectory to disk and move it into place.
+        """
+        self.fm.flush()
+        del self.fm
+        os.rename(self.tmp_path, self.path)
+
+
+
+class BaselineCache:
+    """
+    A directory of baseline trajectories stored as .npy files named by their key.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def entry_path(self, key):
+        """
+        Return the path of the cache entry with the given key.
+        """
+        return os.path.join(self.cache_dir, 'baseline_%s.npy' % key)
+
+
+    def lookup(self, key):
+        """
+        Return the read-only memory map of the cached trajectory or None if
+        no trajectory is cached under key.
+        """
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode = 'r')
+
+
+    def create(self, key, shape):
+        """
+        Return a writer for a new trajectory of the given shape stored under key.
+        """
+        path = self.entry_path(key)
+        return BaselineWriter('%s_%d_tmp.npy' % (path[:-4], os.getpid()), path, shape)
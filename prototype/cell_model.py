@@ -176,6 +176,14 @@ class CellMoistureModel:
         Return the state covariance. READ-ONLY under normal circumstances.
         """
         return self.P
+
+
+    def get_model_ids(self):
+        """
+        Return the ids [1..4] of the models that switched on during last model
+        advance.
+        """
+        return self.model_ids
     
     
     def kalman_update(self, O, V, fuel_types):
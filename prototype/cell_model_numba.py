@@ -0,0 +1,289 @@
+
+import numpy as np
+import numba
+import math
+
+
+@numba.njit(cache = True)
+def _advance_grid(m_ext, P, model_ids, Ed, Ew, rain, dt, Tk, r0, rk, Trk, S, mQ, update_covar):
+    """
+    Advance the moisture models at all grid points, this is the same computation
+    as in CellMoistureModel.advance_model (cell_model_opt.pyx) run over the whole grid.
+    """
+    Ny, Nx, n = m_ext.shape
+    k = Tk.shape[0]
+    equi = np.zeros(k)
+    change = np.zeros(k)
+    m_new = np.zeros(k)
+    J = np.zeros((n, n))
+    P2 = np.zeros((n, n))
+
+    for i in range(Ny):
+        for j in range(Nx):
+
+            # first, we break the state vector into components
+            m = m_ext[i, j]
+            dlt_E = m[2*k]
+            dlt_S = m[2*k+1]
+            dlt_Trk = m[2*k+2]
+            r = rain[i, j]
+
+            # add assimilated difference, which is shared across spatial locations
+            ed = Ed[i, j] + dlt_E
+            ew = Ew[i, j] + dlt_E
+
+            for f in range(k):
+                if r > r0:
+                    # equilibrium is equal to the saturation level (assimilated)
+                    equi[f] = S + dlt_S
+                    model_ids[i, j, f] = 3
+
+                    # rlag is modified by the rainfall intensity (assimilated)
+                    change[f] = dt / (Trk + dlt_Trk) * (1.0 - math.exp(- (r - r0) / rk))
+                else:
+                    # equilibrium is selected according to current moisture level
+                    equi[f] = m[f]
+                    model_ids[i, j, f] = 4
+                    if equi[f] > ed:
+                        model_ids[i, j, f] = 1
+                        equi[f] = ed
+                    elif equi[f] < ew:
+                        model_ids[i, j, f] = 2
+                        equi[f] = ew
+
+                    # the inverted time lag is constant according to fuel category
+                    change[f] = dt / (Tk[f] + m[k+f])
+
+                # select appropriate integration method according to change
+                if change[f] < 0.01:
+                    m_new[f] = m[f] + (equi[f] - m[f]) * (1.0 - math.exp(-change[f]))
+                else:
+                    m_new[f] = m[f] + (equi[f] - m[f]) * change[f] * (1 - 0.5 * change[f])
+
+            # update model state covariance using the old state
+            if update_covar:
+                J[:, :] = 0.0
+                for f in range(k):
+
+                    if change[f] < 0.01:
+                        J[f, f] = math.exp(-change[f]) if model_ids[i, j, f] != 4 else 1.0
+                        dmi_dchng = (equi[f] - m[f]) * math.exp(-change[f])
+                        dmi_dequi = 1.0 - math.exp(-change[f])
+                    else:
+                        J[f, f] = 1.0 - change[f] * (1 - 0.5 * change[f]) if model_ids[i, j, f] != 4 else 1.0
+                        dmi_dchng = (equi[f] - m[f]) * (1.0 - change[f])
+                        dmi_dequi = change[f] * (1 - 0.5 * change[f])
+
+                    if r <= r0:
+                        # if drying/wetting model active, jacobian entry w.r.t. equilibrium and Tk is nonzero
+                        if model_ids[i, j, f] != 4:
+                            J[f, 2*k] = dmi_dequi
+                            J[f, k+f] = dmi_dchng * (-dt) * (Tk[f] + m[k+f])**(-2)
+                    else:
+                        # rain model active
+                        J[f, 2*k+1] = dmi_dequi
+                        J[f, 2*k+2] = dmi_dchng * dt * (math.exp(-(r - r0)/rk) - 1.0) * (Trk + dlt_Trk)**(-2)
+
+                    # delta_Tk for each fuel have no dependencies except previous delta_Tk
+                    J[k+f, k+f] = 1.0
+
+                # the equilibrium constants
+                J[2*k, 2*k] = 1.0
+                J[2*k+1, 2*k+1] = 1.0
+                J[2*k+2, 2*k+2] = 1.0
+
+                # P <- J * P * J^T + Q
+                Pc = P[i, j]
+                for a in range(n):
+                    for b in range(n):
+                        s = 0.0
+                        for c in range(n):
+                            s += J[a, c] * Pc[c, b]
+                        P2[a, b] = s
+                for a in range(n):
+                    for b in range(n):
+                        s = 0.0
+                        for c in range(n):
+                            s += P2[a, c] * J[b, c]
+                        Pc[a, b] = s + mQ[a, b]
+
+            # update to the new state
+            for f in range(k):
+                m[f] = m_new[f]
+
+
+@numba.njit(cache = True)
+def _invert_small(A, Ai):
+    """
+    Invert the small matrix A into Ai using Gauss-Jordan elimination with partial pivoting.
+    A is overwritten.
+    """
+    n = A.shape[0]
+    Ai[:, :] = 0.0
+    for i in range(n):
+        Ai[i, i] = 1.0
+
+    for c in range(n):
+        piv = c
+        for r in range(c+1, n):
+            if abs(A[r, c]) > abs(A[piv, c]):
+                piv = r
+        if piv != c:
+            for q in range(n):
+                tmp = A[c, q]
+                A[c, q] = A[piv, q]
+                A[piv, q] = tmp
+                tmp = Ai[c, q]
+                Ai[c, q] = Ai[piv, q]
+                Ai[piv, q] = tmp
+        d = A[c, c]
+        for q in range(n):
+            A[c, q] /= d
+            Ai[c, q] /= d
+        for r in range(n):
+            if r != c:
+                fct = A[r, c]
+                for q in range(n):
+                    A[r, q] -= fct * A[c, q]
+                    Ai[r, q] -= fct * Ai[c, q]
+
+
+@numba.njit(cache = True)
+def _kalman_update_grid(m_ext, P, O, V, fuel_types, Kg):
+    """
+    Run the Kalman update at each grid point with the observations O[o, i, j],
+    observation variances V[o, i, j] of the fuel types fuel_types[o].
+    """
+    Ny, Nx, n = m_ext.shape
+    Nobs = fuel_types.shape[0]
+    I = np.zeros((Nobs, Nobs))
+    Ii = np.zeros((Nobs, Nobs))
+    KP = np.zeros((n, n))
+    res = np.zeros(Nobs)
+
+    for i in range(Ny):
+        for j in range(Nx):
+            m = m_ext[i, j]
+            Pc = P[i, j]
+            K = Kg[i, j]
+
+            # innovation covariance Ho * P * Ho^T + V
+            for a in range(Nobs):
+                for b in range(Nobs):
+                    I[a, b] = Pc[fuel_types[a], fuel_types[b]]
+                I[a, a] += V[a, i, j]
+            _invert_small(I, Ii)
+
+            # K = P * Ho^T * inv(I)
+            for a in range(n):
+                for b in range(Nobs):
+                    s = 0.0
+                    for c in range(Nobs):
+                        s += Pc[a, fuel_types[c]] * Ii[c, b]
+                    K[a, b] = s
+
+            # the state update uses the residuals wrt. the forecast state,
+            # so all residuals are computed before the state is modified
+            for b in range(Nobs):
+                res[b] = O[b, i, j] - m[fuel_types[b]]
+            for b in range(Nobs):
+                for a in range(n):
+                    m[a] += K[a, b] * res[b]
+
+            # P <- P - K * Ho * P
+            for a in range(n):
+                for c in range(n):
+                    s = 0.0
+                    for b in range(Nobs):
+                        s += K[a, b] * Pc[fuel_types[b], c]
+                    KP[a, c] = s
+            for a in range(n):
+                for c in range(n):
+                    Pc[a, c] -= KP[a, c]
+
+
+
+class GridMoistureModel:
+    """
+    The moisture model of cell_model_opt.CellMoistureModel for a whole grid, with
+    the states and covariances stored in contiguous arrays and compiled with numba.
+    """
+
+    r0 = 0.05                               # threshold rainfall [mm/h]
+    rk = 8.0                                # saturation rain intensity [mm/h]
+    Trk = 14 * 3600.0                       # time constant for wetting model [s]
+    S = 2.5                                 # saturation intensity [dimensionless]
+
+
+    def __init__(self, lat, lon, k, E, Tk, P0):
+        """
+        Initialize the models at all grid points with moisture levels E,
+        nominal fuel delays Tk and state covariance P0.
+        """
+        self.dom_shape = lat.shape
+        self.k = k
+        n = 2*k+3
+        self.Tk = np.asarray(Tk, dtype = np.float64) if Tk is not None else np.array([1, 10, 100]) * 3600.0
+        self.m_ext = np.zeros(self.dom_shape + (n,))
+        E = np.asarray(E)
+        self.m_ext[:,:,:k] = E if E.ndim == 3 else E[:,:,np.newaxis]
+        self.P = np.zeros(self.dom_shape + (n, n))
+        self.P[:,:] = np.eye(n) * 0.02 if P0 is None else P0
+        self.model_ids = np.zeros(self.dom_shape + (k,), dtype = np.int32)
+        self.noQ = np.zeros((n, n))
+
+
+    def advance(self, Ed, Ew, rain, dt, mQ = None):
+        """
+        Advance all the models on the grid by one time step, see CellGridModel.advance.
+        """
+        _advance_grid(self.m_ext, self.P, self.model_ids,
+                      np.ascontiguousarray(Ed, dtype = np.float64),
+                      np.ascontiguousarray(Ew, dtype = np.float64),
+                      np.ascontiguousarray(rain, dtype = np.float64),
+                      float(dt), self.Tk, self.r0, self.rk, self.Trk, self.S,
+                      self.noQ if mQ is None else np.ascontiguousarray(mQ, dtype = np.float64),
+                      mQ is not None)
+
+
+    def kalman_update(self, O, V, fuel_types):
+        """
+        Run the Kalman update in each model independently, see CellGridModel.kalman_update.
+        """
+        Nobs = len(fuel_types)
+        Kg = np.zeros(self.dom_shape + (2*self.k+3, Nobs))
+        _kalman_update_grid(self.m_ext, self.P,
+                            np.array([np.asarray(o, dtype = np.float64) for o in O]),
+                            np.array([np.asarray(v, dtype = np.float64) for v in V]),
+                            np.array(fuel_types, dtype = np.int64), Kg)
+        return Kg
+
+
+    def get_state(self):
+        """
+        Return the extended states of all models. READ-ONLY under normal circumstances.
+        """
+        return self.m_ext
+
+
+    def get_state_covar(self):
+        """
+        Return the state covariances of all models. READ-ONLY under normal circumstances.
+        """
+        return self.P
+
+
+    def get_model_ids(self):
+        """
+        Return the ids [1..4] of the models that switched on during last model advance.
+        """
+        return self.model_ids
+
+
+    def set_state(self, m_ext, P = None):
+        """
+        Overwrite the extended states (and optionally the state covariances).
+        """
+        self.m_ext[:] = m_ext
+        if P is not None:
+            self.P[:] = P
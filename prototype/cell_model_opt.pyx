@@ -201,7 +201,7 @@ cdef class CellMoistureModel:
             self.P += mQ
 
         # update to the new state
-        self.m_ext[:k] = m_newOA
+        self.m_ext[:k] = m_new
 
 
     def get_state(self):
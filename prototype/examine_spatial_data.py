@@ -8,7 +8,6 @@ Created on Wed Oct 24 17:40:24 2012
 from spatial_model_utilities import load_wrf_data, equilibrium_moisture, render_spatial_field, load_station_data
 
 import numpy as np
-from mpl_toolkits.basemap import Basemap
 import os
 import pylab as pb
 
@@ -52,6 +51,7 @@ if __name__ == '__main__':
     # construct our basemap
     lat_rng = (np.min(lat), np.max(lat))
     lon_rng = (np.min(lon), np.max(lon))
+    from mpl_toolkits.basemap import Basemap
     m = Basemap(llcrnrlon=lon_rng[0],llcrnrlat=lat_rng[0],
                 urcrnrlon=lon_rng[1],urcrnrlat=lat_rng[1],
                 projection = 'mill')
@@ -6,7 +6,6 @@ from wrf_model_data import WRFModelData
 from observation_stations import MesoWestStation
 from diagnostics import init_diagnostics, diagnostics
 
-from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.dates import DateFormatter
@@ -99,6 +98,7 @@ if __name__ == '__main__':
     
     # construct basemap for rendering
     domain_rng = wrf_data.get_domain_extent()
+    from mpl_toolkits.basemap import Basemap
     m = Basemap(llcrnrlon=domain_rng[0],llcrnrlat=domain_rng[1],
                 urcrnrlon=domain_rng[2],urcrnrlat=domain_rng[3],
                 projection = 'mill')
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the forcing fields derived from a WRF file (Ed, Ew and RAIN).  The fields
+are stored as .npy files in a directory per entry and are reopened as memory maps,
+so that runs and analysis scripts on the same WRF file do not derive them again.
+An entry is keyed by the path, the size and the modification time of the WRF file,
+the time slice, the derived fields and their storage type, so a modified WRF file
+never hits a stale entry.  Entries of an older version of the same file are removed
+when a new entry is stored.  The total size of the cache is capped, the least recently
+used entries are evicted first.
+
+The fields are stored either in the type in which they were derived ('native'),
+as 'float32' or 'quantized' to 16 bits with a per-field scale and offset (the
+quantized fields are not exact, the error is at most half of the quantization step).
+The cache is used by WRFModelData if passed in, in the pipeline it is configured by
+
+    'forcing_cache_dir' : 'model_outputs/forcing_cache/',
+    'forcing_cache_dtype' : 'native',
+    'forcing_cache_max_bytes' : 2**34
+
+"""
+
+from wrf_series import wrf_files
+
+import numpy as np
+import hashlib
+import shutil
+import glob
+import os
+
+
+# the fields derived from the WRF variables
+derived_fields = [ 'Ed', 'Ew', 'RAIN' ]
+
+
+def path_key(file_name):
+    """
+    Compute the part of the key that identifies the WRF file (or series of files) by its path.
+    """
+    paths = file_name if isinstance(file_name, (list, tuple)) else [ file_name ]
+    return hashlib.sha1('|'.join([ os.path.abspath(p) for p in paths ]).encode('utf-8')).hexdigest()[:12]
+
+
+def version_key(file_name):
+    """
+    Compute the part of the key that identifies the version of the WRF file by its
+    size and modification time (of a series by the names, sizes and times of its files).
+    """
+    h = hashlib.sha1()
+    for fn in wrf_files(file_name):
+        st = os.stat(fn)
+        h.update(('%s|%d|%r' % (os.path.abspath(fn), st.st_size, st.st_mtime)).encode('utf-8'))
+    return h.hexdigest()[:8]
+
+
+def forcing_key(file_name, time_slice, fields, dtype):
+    """
+    Compute the key of the fields derived from the time_slice of the WRF file file_name
+    stored in dtype.  The key changes whenever the size or the modification time of the
+    file changes.
+    """
+    h = hashlib.sha1(('%r|%s|%s' % ((time_slice.start, time_slice.stop, time_slice.step), ','.join(fields), dtype)).encode('utf-8'))
+    return '%s_%s_%s' % (path_key(file_name), version_key(file_name), h.hexdigest()[:12])
+
+
+def directory_size(path):
+    """
+    Return the total size of the files in the directory path.
+    """
+    return sum([ os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path) ])
+
+
+
+class DequantizedField:
+    """
+    A read-only view of a quantized field, which restores the values when indexed.
+    """
+
+    def __init__(self, q, scale, offset):
+        self.q = q
+        self.scale = scale
+        self.offset = offset
+        self.shape = q.shape
+        self.ndim = q.ndim
+        self.dtype = np.dtype(np.float32)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, ndx):
+        return (self.q[ndx] * self.scale + self.offset).astype(np.float32)
+
+
+
+class ForcingCache:
+    """
+    A directory of derived forcing entries, each a directory forcing_<key>
+    with a .npy file per field.
+    """
+
+    def __init__(self, cache_dir, dtype = 'native', max_bytes = None):
+        if dtype not in [ 'native', 'float32', 'quantized' ]:
+            raise ValueError('Invalid forcing cache type [%s], must be native, float32 or quantized.' % dtype)
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def entry_path(self, key):
+        """
+        Return the path of the cache entry with the given key.
+        """
+        return os.path.join(self.cache_dir, 'forcing_%s' % key)
+
+
+    def lookup(self, file_name, time_slice, fields = derived_fields):
+        """
+        Return a dictionary of the (read-only, memory mapped) fields derived from the
+        time_slice of file_name or None if they are not cached.
+        """
+        path = self.entry_path(forcing_key(file_name, time_slice, sorted(fields), self.dtype))
+        if not os.path.isdir(path):
+            return None
+
+        # the modification time of the entry records its last use
+        os.utime(path, None)
+        cached = {}
+        for fn in fields:
+            f = np.load(os.path.join(path, '%s.npy' % fn), mmap_mode = 'r')
+            if self.dtype == 'quantized':
+                so = np.load(os.path.join(path, '%s_scale.npy' % fn))
+                f = DequantizedField(f, so[0], so[1])
+            cached[fn] = f
+        return cached
+
+
+    def store(self, file_name, time_slice, cached):
+        """
+        Store the dictionary cached of fields derived from the time_slice of file_name.
+        """
+        fields = sorted(cached.keys())
+        key = forcing_key(file_name, time_slice, fields, self.dtype)
+        path = self.entry_path(key)
+        tmp_path = '%s_%d_tmp' % (path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        for fn in fields:
+            f = np.asarray(cached[fn])
+            if self.dtype == 'float32':
+                f = f.astype(np.float32)
+            elif self.dtype == 'quantized':
+                lo, hi = float(np.amin(f)), float(np.amax(f))
+                scale = (hi - lo) / 65535.0 if hi > lo else 1.0
+                np.save(os.path.join(tmp_path, '%s_scale.npy' % fn), np.array([scale, lo]))
+                f = np.round((f - lo) / scale).astype(np.uint16)
+            np.save(os.path.join(tmp_path, '%s.npy' % fn), f)
+
+        # entries of other versions of the same file are stale
+        current = 'forcing_%s_%s_' % (path_key(file_name), version_key(file_name))
+        for old in glob.glob(os.path.join(self.cache_dir, 'forcing_%s_*' % path_key(file_name))):
+            if not old.endswith('_tmp') and not os.path.basename(old).startswith(current):
+                shutil.rmtree(old, ignore_errors = True)
+
+        if os.path.exists(path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, path)
+        self.evict()
+        return path
+
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = [ p for p in glob.glob(os.path.join(self.cache_dir, 'forcing_*')) if not p.endswith('_tmp') ]
+        entries = sorted([ (os.path.getmtime(p), directory_size(p), p) for p in entries ])
+        total = sum([ e[1] for e in entries ])
+        for mtime, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(p, ignore_errors = True)
+            total -= size
+            print("INFO: evicted forcing cache entry [%s]." % p)
+
+
+
+def make_forcing_cache(cfg):
+    """
+    Return the ForcingCache configured in cfg or None if no cache is configured.
+    """
+    if cfg.get('forcing_cache_dir') is None:
+        return None
+    return ForcingCache(cfg['forcing_cache_dir'], cfg.get('forcing_cache_dtype', 'native'), cfg.get('forcing_cache_max_bytes'))
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy reading of the model forcing from a WRF file.  Instead of loading the whole
+forcing cube, the equilibria Ed, Ew and the rainfall for each time step are derived
+from the WRF variables at the two times bounding the step.  The derivation is the
+same computation as in WRFModelData (equilibrium_moisture, compute_rainfall_per_timestep)
+done in place in preallocated buffers.
+
+The PrefetchingForcing reads the following steps on a background thread into a small
+ring of buffers while the model works on the current step:
+
+    reader = StepForcingReader(cfg['input_file'])
+    pf = PrefetchingForcing(reader, 1, Nt, cfg.get('forcing_prefetch', 2))
+    for t in range(1, Nt):
+        Ed, Ew, rain, dt = pf.get(t)
+        ...
+    pf.close()
+
+or without the background thread, one step at a time into a single set of buffers
+
+    for t, Ed, Ew, rain, dt in derived_forcing(WRFModelData(cfg['input_file'], lazy = True)):
+        ...
+
+The results are identical to the fields computed by WRFModelData and the memory used
+does not depend on the number of time steps.
+
+"""
+
+from wrf_model_data import accumulated_rainfall, bucket_size
+from wrf_series import open_wrf, read_epoch_times
+
+from Queue import Queue
+import numpy as np
+import threading
+import traceback
+
+
+def derive_step_equilibria(T0, Q0, P0, T1, Q1, P1, Ed, Ew, w):
+    """
+    Compute the drying and wetting equilibria Ed, Ew for the interval between two WRF times
+    from the temperature, vapor mixing ratio and surface pressure at both times.  The results
+    are written into Ed and Ew, w is a list of 5 work arrays of the same shape.
+    The computation is the same as in WRFModelData.equilibrium_moisture.
+    """
+    Ti, Qi, lT, a, b = w
+
+    # average the fields over the interval
+    np.add(T0, T1, out = Ti)
+    np.multiply(0.5, Ti, out = Ti)
+    np.add(Q0, Q1, out = Qi)
+    np.multiply(0.5, Qi, out = Qi)
+    np.log(Ti, out = lT)
+
+    # saturated vapor pressure (into a)
+    np.divide(6763.22, Ti, out = a)
+    np.subtract(54.842763, a, out = a)
+    np.multiply(4.210, lT, out = b)
+    np.subtract(a, b, out = a)
+    np.multiply(0.000367, Ti, out = b)
+    np.add(a, b, out = a)
+    np.subtract(Ti, 218.8, out = b)
+    np.multiply(0.0415, b, out = b)
+    np.tanh(b, out = b)
+    np.divide(1331.22, Ti, out = Ed)
+    np.subtract(53.878, Ed, out = Ed)
+    np.multiply(9.44523, lT, out = Ew)
+    np.subtract(Ed, Ew, out = Ed)
+    np.multiply(0.014025, Ti, out = Ew)
+    np.add(Ed, Ew, out = Ed)
+    np.multiply(b, Ed, out = b)
+    np.add(a, b, out = a)
+    np.exp(a, out = a)
+
+    # water vapor pressure (into b, P is averaged into lT, which is not needed anymore)
+    np.add(P0, P1, out = lT)
+    np.multiply(0.5, lT, out = lT)
+    np.multiply(1 - 0.622, Qi, out = b)
+    np.add(0.622, b, out = b)
+    np.multiply(lT, Qi, out = Qi)
+    np.divide(Qi, b, out = b)
+
+    # relative humidity in percent (into b)
+    np.multiply(100, b, out = b)
+    np.divide(b, a, out = b)
+    H = b
+
+    # the terms shared by both equilibria: exp(0.1*H) into a, (1 - exp(-0.115*H)) into Qi
+    # and 0.18*(21.1 + 273.15 - T) into lT
+    np.multiply(0.1, H, out = a)
+    np.exp(a, out = a)
+    np.multiply(-0.115, H, out = Qi)
+    np.exp(Qi, out = Qi)
+    np.subtract(1, Qi, out = Qi)
+    np.subtract(21.1 + 273.15, Ti, out = lT)
+    np.multiply(0.18, lT, out = lT)
+    np.multiply(lT, Qi, out = lT)
+
+    # drying/wetting fuel equilibrium moisture contents
+    for E, c1, c2, c3 in [ (Ed, 0.924, 0.679, 0.000499), (Ew, 0.618, 0.753, 0.000454) ]:
+        np.power(H, c2, out = E)
+        np.multiply(c1, E, out = E)
+        np.multiply(c3, a, out = Ti)
+        np.add(E, Ti, out = E)
+        np.add(E, lT, out = E)
+        E *= 0.01
+
+
+
+class StepForcingReader:
+    """
+    Reads the WRF variables bounding each time step and derives the forcing of the step.
+    The slices of the previous step are kept, so that sequential reading loads each
+    WRF time only once.  The variables are read from the WRF file (or series of files)
+    source or from a WRFModelData object source, which holds the raw variables (e.g.
+    opened lazily).
+    """
+
+    def __init__(self, source):
+        if isinstance(source, (str, list, tuple)):
+            self.d = open_wrf(source)
+            self.v = self.d.variables
+            for vn in [ 'T2', 'Q2', 'PSFC', 'RAINC', 'RAINNC', 'I_RAINC', 'I_RAINNC' ]:
+                if vn in self.v:
+                    self.v[vn].set_auto_mask(False)
+            self.tsec = read_epoch_times(self.d)
+            self.first_ndx = 0
+            self.bucket_mm = bucket_size(self.d)
+        else:
+            self.d = None
+            self.v = source.fields
+            self.tsec = source.get_epoch_times()
+            self.first_ndx = source.file_ndx[0] if len(source.file_ndx) > 0 else 0
+            self.bucket_mm = source.bucket_mm
+        v = self.v
+        self.dom_shape = v['T2'].shape[1:]
+        self.dtype = v['T2'].dtype
+        self.rain_dtype = v['RAINNC'].dtype
+        self.prev = self.allocate_raw()
+        self.cur = self.allocate_raw()
+        self.work = [ np.zeros(self.dom_shape, dtype = self.dtype) for i in range(5) ]
+        self.last_t = None
+
+
+    def allocate_raw(self):
+        """
+        Allocate the buffers for the WRF variables at one time.
+        """
+        raw = dict([ (vn, np.zeros(self.dom_shape, dtype = self.dtype)) for vn in [ 'T2', 'Q2', 'PSFC' ] ])
+        raw['RAIN_ACC'] = np.zeros(self.dom_shape, dtype = self.rain_dtype)
+        return raw
+
+
+    def allocate_step(self):
+        """
+        Allocate the buffers for the forcing of one time step.
+        """
+        return { 'Ed' : np.zeros(self.dom_shape, dtype = self.dtype),
+                 'Ew' : np.zeros(self.dom_shape, dtype = self.dtype),
+                 'rain' : np.zeros(self.dom_shape, dtype = self.rain_dtype),
+                 'dt' : 0 }
+
+
+    def load_raw(self, t, raw):
+        """
+        Read the WRF variables at time index t into raw.
+        """
+        v = self.v
+        for vn in [ 'T2', 'Q2', 'PSFC' ]:
+            raw[vn][:] = v[vn][t,:,:]
+
+        # the accumulated rainfall is only needed as a sum, the accumulation at
+        # the start of the file is taken as zero as in rainfall_chunks
+        if t == 0 and self.first_ndx == 0:
+            raw['RAIN_ACC'][:] = 0.0
+        else:
+            raw['RAIN_ACC'][:] = accumulated_rainfall(v, t, self.bucket_mm)
+
+
+    def read_step(self, t, out):
+        """
+        Derive the forcing of time step t (the interval between WRF times t-1 and t)
+        into the buffers out (see allocate_step).
+        """
+        if self.last_t != t - 1:
+            self.load_raw(t - 1, self.prev)
+        self.load_raw(t, self.cur)
+        p, c = self.prev, self.cur
+
+        derive_step_equilibria(p['T2'], p['Q2'], p['PSFC'], c['T2'], c['Q2'], c['PSFC'], out['Ed'], out['Ew'], self.work)
+
+        # rainfall in mm/hr over the interval, a decrease of the accumulation is a reset
+        dt = int(self.tsec[t] - self.tsec[t-1])
+        np.subtract(c['RAIN_ACC'], p['RAIN_ACC'], out = out['rain'])
+        reset = out['rain'] < 0
+        out['rain'][reset] = c['RAIN_ACC'][reset]
+        out['rain'] *= 3600.0
+        out['rain'] /= dt
+        out['dt'] = dt
+
+        self.prev, self.cur = self.cur, self.prev
+        self.last_t = t
+
+
+    def close(self):
+        if self.d is not None:
+            self.d.close()
+
+
+
+def derived_forcing(source, first = 1, last = None):
+    """
+    Yield the tuples (t, Ed, Ew, rain, dt) of the time steps first, ..., last-1 (by default
+    up to the last time) with the forcing read from source (see StepForcingReader).  The
+    forcing of all steps is derived into the same buffers, so the arrays are only valid
+    until the next step is requested.
+    """
+    reader = StepForcingReader(source)
+    out = reader.allocate_step()
+    try:
+        for t in range(first, last if last is not None else len(reader.tsec)):
+            reader.read_step(t, out)
+            yield t, out['Ed'], out['Ew'], out['rain'], out['dt']
+    finally:
+        reader.close()
+
+
+
+class PrefetchingForcing:
+    """
+    Provides the forcing of consecutive time steps, which are read ahead on a background
+    thread into a ring of depth + 1 preallocated buffers.
+    """
+
+    def __init__(self, reader, first, last, depth = 2):
+        """
+        Start reading the steps first, ..., last-1 from the StepForcingReader reader.
+        """
+        self.reader = reader
+        self.buffers = [ reader.allocate_step() for i in range(depth + 1) ]
+        self.free = Queue()
+        self.ready = Queue()
+        for i in range(len(self.buffers)):
+            self.free.put(i)
+        self.in_use = None
+        self.thread = threading.Thread(target = self._prefetch, args = (first, last))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _prefetch(self, first, last):
+        """
+        Read the steps into free buffers, stops when it receives None instead of a buffer.
+        """
+        try:
+            for t in range(first, last):
+                i = self.free.get()
+                if i is None:
+                    return
+                self.reader.read_step(t, self.buffers[i])
+                self.ready.put((t, i))
+        except Exception:
+            self.ready.put((None, traceback.format_exc()))
+
+
+    def get(self, t):
+        """
+        Return the tuple (Ed, Ew, rain, dt) for the time step t.  The steps must be requested
+        in order and the arrays are only valid until the next call.
+        """
+        if self.in_use is not None:
+            self.free.put(self.in_use)
+            self.in_use = None
+
+        tr, i = self.ready.get()
+        if tr is None:
+            raise RuntimeError('Reading the forcing failed:\n%s' % i)
+        if tr != t:
+            raise ValueError('Forcing for step %d requested, but step %d is next.' % (t, tr))
+
+        self.in_use = i
+        b = self.buffers[i]
+        return b['Ed'], b['Ew'], b['rain'], b['dt']
+
+
+    def close(self):
+        """
+        Stop the background thread.
+        """
+        self.free.put(None)
+        self.thread.join()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Per-frame output of the assimilation in the layout of the Storage module of the
+julia prototype.  A frame is written for each time step with observations and
+holds the model state, the kriging results and the observations under the same
+keys as the julia frames (fm10_model_state, fm10_model_na_state, kriging_field,
+kriging_variance, kriging_obs, kriging_obs_station_ids, ...), so that
+postproc/postproc_assimilation.py reads the output of both prototypes.
+
+The frames are stored as numpy .npz files frame1.npz, frame2.npz, ... in the output
+directory and are written on a background thread
+
+    fw = FrameWriter(cfg['output_dir'])
+    fw.write(assimilation_frame(...))
+    ...
+    fw.close()
+
+"""
+
+from Queue import Queue
+from datetime import datetime
+import numpy as np
+import threading
+import traceback
+import os
+
+
+# keys of frame values that are times
+_time_keys = [ 'mt' ]
+_time_format = '%Y-%m-%d %H:%M:%S'
+
+
+def frame_path(output_dir, ndx, prefix = 'frame'):
+    """
+    Return the path of the frame with index ndx (the first frame has index 1).
+    """
+    return os.path.join(output_dir, '%s%d.npz' % (prefix, ndx))
+
+
+def assimilation_frame(mt, fm10, fm10_na, fm10_var, obs, obs_vals, krig_field, krig_var, krig_vals,
+                       fm10_assim, deltas, kalman_gain, beta, sigma2_eta):
+    """
+    Construct the frame of the assimilation at time mt.  The fields fm10 (forecast),
+    fm10_na (no assimilation), fm10_var (model variance) and fm10_assim (analysis) are
+    the 10-hr fuel moisture, obs is the list of assimilated observations with values
+    obs_vals, krig_vals are the values of the kriged field krig_field at the observations,
+    deltas are the maximal absolute adjustments of the 6 parameters of the extended state,
+    beta the coefficients of the trend and sigma2_eta the variance of the residuals.
+    As in the julia frames, the nearest grid points are one-based.
+    """
+    ngp = np.array([ o.get_nearest_grid_point() for o in obs ], dtype = np.int32).reshape((len(obs), 2))
+    gi, gj = ngp[:,0], ngp[:,1]
+    return { 'mt' : mt,
+             'fm10_model_state' : fm10,
+             'fm10_model_na_state' : fm10_na,
+             'fm10_model_var' : fm10_var,
+             'model_raws_mae' : np.mean(np.abs(fm10[gi, gj] - obs_vals)),
+             'model_na_raws_mae' : np.mean(np.abs(fm10_na[gi, gj] - obs_vals)),
+             'kriging_obs' : obs_vals,
+             'kriging_obs_station_ids' : [ o.get_station().get_id() for o in obs ],
+             'kriging_obs_ngp' : ngp + 1,
+             'kriging_field' : krig_field,
+             'kriging_variance' : krig_var,
+             'kriging_errors' : np.reshape(krig_vals - obs_vals, (1, len(obs))),
+             'kriging_beta' : np.reshape(beta, (-1, 1)),
+             'kriging_sigma2_eta' : sigma2_eta,
+             'fm10_model_state_assim' : fm10_assim,
+             'fm10_model_deltas' : deltas,
+             'model_raws_mae_assim' : np.mean(np.abs(fm10_assim[gi, gj] - obs_vals)),
+             'kalman_gain_fm10' : kalman_gain }
+
+
+def write_frame(path, frame, compress = False):
+    """
+    Store the frame (a dictionary of arrays, numbers, lists and times) into the .npz file path.
+    The file is written under a temporary name and moved into place when complete.
+    """
+    arrays = {}
+    for k, v in frame.items():
+        if k in _time_keys:
+            v = v.strftime(_time_format)
+        arrays[k] = np.asarray(v)
+
+    tmp_path = '%s_tmp' % path
+    with open(tmp_path, 'wb') as f:
+        if compress:
+            np.savez_compressed(f, **arrays)
+        else:
+            np.savez(f, **arrays)
+    os.rename(tmp_path, path)
+
+
+def read_frame(path):
+    """
+    Read the frame stored in the .npz file path.  Numbers, strings and times are returned
+    as python objects and lists of strings as lists, all other values as arrays.
+    """
+    frame = {}
+    with np.load(path) as d:
+        for k in d.files:
+            v = d[k]
+            if k in _time_keys:
+                v = datetime.strptime(str(v), _time_format)
+            elif v.ndim == 0:
+                v = v.item()
+            elif v.dtype.kind in 'SU':
+                v = v.tolist()
+            frame[k] = v
+    return frame
+
+
+
+class FrameWriter:
+    """
+    Writes frames into an output directory on a background thread.  The frames are
+    numbered in the order of submission, the queue of pending frames is bounded
+    so a slow disk blocks the submitting loop instead of accumulating frames.
+    """
+
+    def __init__(self, output_dir, prefix = 'frame', queue_size = 4, compress = False):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.compress = compress
+        self.frame_ndx = 0
+        self.error = None
+        self.jobs = Queue(queue_size)
+        self.thread = threading.Thread(target = self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _writer(self):
+        """
+        Write the frames from the queue, stops when it receives None.
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if self.error is not None:
+                continue
+            ndx, frame = job
+            try:
+                write_frame(frame_path(self.output_dir, ndx, self.prefix), frame, self.compress)
+            except Exception:
+                self.error = traceback.format_exc()
+
+
+    def check(self):
+        """
+        Raise RuntimeError if writing a frame has failed.
+        """
+        if self.error is not None:
+            raise RuntimeError('Writing a frame failed:\n%s' % self.error)
+
+
+    def write(self, frame, ndx = None):
+        """
+        Enqueue the frame for writing as the next frame (or as frame ndx).  The frame
+        must not be modified afterwards.  Returns the index of the frame.
+        """
+        self.check()
+        if ndx is None:
+            self.frame_ndx += 1
+            ndx = self.frame_ndx
+        self.jobs.put((ndx, frame))
+        return ndx
+
+
+    def close(self, check = True):
+        """
+        Wait for the pending frames and stop the background thread.  Raises RuntimeError
+        if writing a frame failed, unless check is False (e.g. after the run failed).
+        """
+        self.jobs.put(None)
+        self.thread.join()
+        if check:
+            self.check()
@@ -9,7 +9,6 @@ from mean_field_model import MeanFieldModel
 from diagnostics import init_diagnostics, diagnostics
 
 import numpy as np
-from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 import pytz
 from observation_stations import Station
@@ -65,6 +64,7 @@ def run_module():
     # construct a basemap representation of the area
     lat_rng = (np.min(lat), np.max(lat))
     lon_rng = (np.min(lon), np.max(lon))
+    from mpl_toolkits.basemap import Basemap
     m = Basemap(llcrnrlon=lon_rng[0],llcrnrlat=lat_rng[0],
                 urcrnrlon=lon_rng[1],urcrnrlat=lat_rng[1],
                 projection = 'mill')
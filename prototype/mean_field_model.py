@@ -12,7 +12,7 @@ class MeanFieldModel:
     
     def __init__(self, lock_gamma = None):
         self.lock_gamma = lock_gamma != None
-        self.gamma = 1.0 if lock_gamma == None else lock_gamma
+        self.gamma = np.atleast_1d(1.0 if lock_gamma == None else lock_gamma)
         
         # configure diagnostics
         diagnostics().push("mfm_lock_gamma", lock_gamma)
@@ -60,5 +60,5 @@ class MeanFieldModel:
         Return the predicted field given the fit gamma vector.
         The covariates passed must be 3D (lon x lat x covar_id).
         """
-        return np.sum(self.gamma[np.newaxis, np.newaxis,:] * Covar, axis = 3)
+        return np.sum(self.gamma[np.newaxis, np.newaxis,:] * Covar, axis = 2)
         
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Live metrics of a running assimilation.  The throughput (cell-steps per second),
+the wall time spent in each stage, the size of the kriging problems, the number of
+assimilated observations, the depths of the queues of the asynchronous sinks and
+the resident memory are written periodically into the output directory, either
+as a Prometheus text file (metrics.prom) or as a JSON snapshot (metrics.json).
+The file is replaced atomically, so it can be followed with watch or read by a
+scraper (e.g. the textfile collector of the node exporter) at any time.  Metrics
+are switched on by the configuration
+
+    'metrics' : { 'interval' : 10.0, 'format' : 'prom' }
+
+"""
+
+import json
+import time
+import os
+
+
+def resident_memory():
+    """
+    Return the resident memory of this process in bytes (the peak if the current
+    value is not available on this platform).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for l in f:
+                if l.startswith('VmRSS:'):
+                    return int(l.split()[1]) * 1024
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+class RunMetrics:
+    """
+    Accumulates the metrics of a run and writes them at most every interval seconds.
+    """
+
+    def __init__(self, output_dir, interval = 10.0, fmt = 'prom'):
+        if fmt not in [ 'prom', 'json' ]:
+            raise ValueError('Invalid metrics format [%s], must be prom or json.' % fmt)
+        self.path = os.path.join(output_dir, 'metrics.%s' % fmt)
+        self.fmt = fmt
+        self.interval = interval
+        self.t_start = time.time()
+        self.t_written = None
+
+        self.step = 0
+        self.cell_steps = 0
+        self.stage_seconds = {}
+        self.obs_assimilated = 0
+        self.kriging_size = 0
+        self.kriging_size_max = 0
+        self.queue_depths = {}
+
+        # the throughput since the previous write
+        self.last_cell_steps = 0
+        self.last_time = self.t_start
+        self.recent_rate = 0.0
+
+
+    def add_stage_time(self, name, seconds):
+        """
+        Account seconds of wall time to the stage name.
+        """
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+
+    def end_step(self, t, cells, num_obs, kriging_size, queue_depths):
+        """
+        Record the completion of time step t, which advanced cells grid cells and
+        assimilated num_obs observations with a kriging problem of size kriging_size.
+        """
+        self.step = t
+        self.cell_steps += cells
+        self.obs_assimilated += num_obs
+        self.kriging_size = kriging_size
+        self.kriging_size_max = max(self.kriging_size_max, kriging_size)
+        self.queue_depths = queue_depths
+
+        now = time.time()
+        if self.t_written is None or now - self.t_written >= self.interval:
+            self.write(now)
+
+
+    def snapshot(self, now):
+        """
+        Return the current metrics as a dictionary.
+        """
+        elapsed = now - self.t_start
+        if now > self.last_time and self.cell_steps > self.last_cell_steps:
+            self.recent_rate = (self.cell_steps - self.last_cell_steps) / (now - self.last_time)
+        self.last_cell_steps, self.last_time = self.cell_steps, now
+        return { 'step' : self.step,
+                 'elapsed_seconds' : elapsed,
+                 'cell_steps_total' : self.cell_steps,
+                 'cell_steps_per_second' : self.cell_steps / elapsed if elapsed > 0 else 0.0,
+                 'cell_steps_per_second_recent' : self.recent_rate,
+                 'stage_seconds' : dict(self.stage_seconds),
+                 'kriging_obs' : self.kriging_size,
+                 'kriging_obs_max' : self.kriging_size_max,
+                 'observations_assimilated_total' : self.obs_assimilated,
+                 'queue_depth' : dict(self.queue_depths),
+                 'resident_memory_bytes' : resident_memory(),
+                 'timestamp' : now }
+
+
+    def format_prom(self, m):
+        """
+        Render the metrics m in the Prometheus text exposition format.
+        """
+        lines = []
+        def metric(name, mtype, help, values):
+            lines.append('# HELP moisture_%s %s' % (name, help))
+            lines.append('# TYPE moisture_%s %s' % (name, mtype))
+            for labels, v in values:
+                lines.append('moisture_%s%s %r' % (name, labels, float(v)))
+
+        metric('step', 'gauge', 'Last completed time step.', [ ('', m['step']) ])
+        metric('elapsed_seconds', 'gauge', 'Wall time since the start of the run.', [ ('', m['elapsed_seconds']) ])
+        metric('cell_steps_total', 'counter', 'Grid cells advanced.', [ ('', m['cell_steps_total']) ])
+        metric('cell_steps_per_second', 'gauge', 'Average throughput of the run.', [ ('', m['cell_steps_per_second']) ])
+        metric('cell_steps_per_second_recent', 'gauge', 'Throughput since the previous snapshot.',
+               [ ('', m['cell_steps_per_second_recent']) ])
+        metric('stage_seconds_total', 'counter', 'Wall time spent in each stage.',
+               [ ('{stage="%s"}' % k, v) for (k, v) in sorted(m['stage_seconds'].items()) ])
+        metric('kriging_obs', 'gauge', 'Observations in the last kriging problem.', [ ('', m['kriging_obs']) ])
+        metric('kriging_obs_max', 'gauge', 'Observations in the largest kriging problem.', [ ('', m['kriging_obs_max']) ])
+        metric('observations_assimilated_total', 'counter', 'Observations assimilated.',
+               [ ('', m['observations_assimilated_total']) ])
+        metric('queue_depth', 'gauge', 'Items waiting in the queues of the asynchronous stages.',
+               [ ('{queue="%s"}' % k, v) for (k, v) in sorted(m['queue_depth'].items()) ])
+        metric('resident_memory_bytes', 'gauge', 'Resident memory of the driver process.', [ ('', m['resident_memory_bytes']) ])
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, now = None):
+        """
+        Write the metrics file (replacing the previous one).
+        """
+        now = time.time() if now is None else now
+        m = self.snapshot(now)
+        tmp_path = '%s_tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            if self.fmt == 'prom':
+                f.write(self.format_prom(m))
+            else:
+                json.dump(m, f, indent = 1, sort_keys = True)
+        os.rename(tmp_path, self.path)
+        self.t_written = now
+
+
+
+def make_metrics(cfg):
+    """
+    Return a RunMetrics object if metrics are configured in cfg, otherwise None.
+    """
+    mcfg = cfg.get('metrics')
+    if not mcfg:
+        return None
+    return RunMetrics(cfg['output_dir'], mcfg.get('interval', 10.0), mcfg.get('format', 'prom'))
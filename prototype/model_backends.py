@@ -0,0 +1,197 @@
+
+import numpy as np
+
+
+class CellGridModel:
+    """
+    A grid of independent per-cell moisture models.  The cells are instances
+    of a cell model class (the pure python cell_model.CellMoistureModel or the
+    compiled cell_model_opt.CellMoistureModel) and are advanced/updated one by one.
+    """
+
+    def __init__(self, cell_class, lat, lon, k, E, Tk, P0):
+        """
+        Construct a model for each grid point with initial moisture E[p],
+        nominal fuel delays Tk and initial state covariance P0.
+        """
+        self.dom_shape = lat.shape
+        self.k = k
+        self.cells = np.zeros(self.dom_shape, dtype = object)
+        for p in np.ndindex(self.dom_shape):
+            self.cells[p] = cell_class((lat[p], lon[p]), k, E[p], Tk, P0 = P0)
+
+
+    def advance(self, Ed, Ew, rain, dt, mQ = None):
+        """
+        Advance all the models on the grid by one time step.  Ed, Ew and rain
+        are 2D fields, see CellMoistureModel.advance_model for details.
+        """
+        cells = self.cells
+        for p in np.ndindex(self.dom_shape):
+            cells[p].advance_model(Ed[p], Ew[p], rain[p], dt, mQ)
+
+
+    def kalman_update(self, O, V, fuel_types):
+        """
+        Run the Kalman update in each model independently.
+
+          O - a list of 2D fields with the observed values (one for each observed fuel type)
+          V - a list of 2D fields with the variances of the observations
+          fuel_types - the fuel types for which the observations exist
+
+        Returns the Kalman gains as an array of shape dom_shape x (2k+3) x len(fuel_types).
+        """
+        Nobs = len(fuel_types)
+        Kg = np.zeros(self.dom_shape + (2*self.k+3, Nobs))
+        Op = np.zeros((Nobs,))
+        Vp = np.zeros((Nobs, Nobs))
+        for p in np.ndindex(self.dom_shape):
+
+            # construct observations for this position
+            for i in range(Nobs):
+                Op[i] = O[i][p]
+                Vp[i,i] = V[i][p]
+
+            Kg[p] = self.cells[p].kalman_update(Op, Vp, fuel_types)
+
+        return Kg
+
+
+    def get_state(self):
+        """
+        Return the extended states of all models as an array of shape dom_shape x (2k+3).
+        """
+        S = np.zeros(self.dom_shape + (2*self.k+3,))
+        for p in np.ndindex(self.dom_shape):
+            S[p] = self.cells[p].get_state()
+        return S
+
+
+    def get_state_covar(self):
+        """
+        Return the state covariances as an array of shape dom_shape x (2k+3) x (2k+3).
+        """
+        P = np.zeros(self.dom_shape + (2*self.k+3, 2*self.k+3))
+        for p in np.ndindex(self.dom_shape):
+            P[p] = self.cells[p].get_state_covar()
+        return P
+
+
+    def get_model_ids(self):
+        """
+        Return the ids [1..4] of the models that switched on during last model
+        advance as an array of shape dom_shape x k.
+        """
+        mid = np.zeros(self.dom_shape + (self.k,), dtype = np.int32)
+        for p in np.ndindex(self.dom_shape):
+            mid[p] = self.cells[p].get_model_ids()
+        return mid
+
+
+    def set_state(self, m_ext, P = None):
+        """
+        Overwrite the extended states (and optionally the state covariances)
+        of all the models, the arrays are shaped as returned by get_state()
+        and get_state_covar().
+        """
+        for p in np.ndindex(self.dom_shape):
+            # the cells hand out references to their internal arrays
+            self.cells[p].get_state()[:] = m_ext[p]
+            if P is not None:
+                self.cells[p].get_state_covar()[:] = P[p]
+
+
+
+class ModelBackend:
+    """
+    A compute backend, which constructs moisture model grids that share the same
+    advance/update API.
+    """
+
+    def __init__(self, name, grid_factory):
+        self.name = name
+        self.grid_factory = grid_factory
+
+
+    def create_grid(self, lat, lon, k, E, Tk, P0):
+        """
+        Construct a new model grid with the initial moisture E, see CellGridModel.
+        """
+        return self.grid_factory(lat, lon, k, E, Tk, P0)
+
+
+
+def _load_numpy_backend():
+    from cell_model import CellMoistureModel
+    return ModelBackend('numpy', lambda *args: CellGridModel(CellMoistureModel, *args))
+
+
+def _load_cython_backend():
+    from cell_model_opt import CellMoistureModel
+    return ModelBackend('cython', lambda *args: CellGridModel(CellMoistureModel, *args))
+
+
+def _load_numba_backend():
+    from cell_model_numba import GridMoistureModel
+    return ModelBackend('numba', GridMoistureModel)
+
+
+# the backend loaders indexed by name and the order in which auto-detection tries them
+_backend_loaders = {}
+_auto_order = []
+
+
+def register_backend(name, loader, auto_priority = None):
+    """
+    Register a new backend loader under name.  The loader must return a ModelBackend
+    and raise ImportError if the backend cannot be used on this host.  If auto_priority
+    is given, the backend is inserted at that position in the auto-detection order.
+    """
+    _backend_loaders[name] = loader
+    if auto_priority is not None and name not in _auto_order:
+        _auto_order.insert(auto_priority, name)
+
+
+def available_backends():
+    """
+    Return the names of the registered backends that can be loaded on this host.
+    """
+    avail = []
+    for name in _backend_loaders:
+        try:
+            _backend_loaders[name]()
+            avail.append(name)
+        except ImportError:
+            pass
+    return avail
+
+
+def load_backend(name = None):
+    """
+    Load the backend with the given name.  If the name is None or 'auto' or the
+    backend cannot be loaded, the fastest available backend is selected.
+
+        backend = load_backend(cfg.get('model_backend'))
+    """
+    if name is None or name == 'auto':
+        candidates = _auto_order
+    elif name in _backend_loaders:
+        candidates = [name] + [b for b in _auto_order if b != name]
+    else:
+        raise ValueError('Invalid model backend [%s] in configuration, known backends are %s.' % (name, str(sorted(_backend_loaders.keys()))))
+
+    for cand in candidates:
+        try:
+            backend = _backend_loaders[cand]()
+        except ImportError as e:
+            print("WARN: model backend [%s] is not available (%s)." % (cand, str(e)))
+            continue
+        print("INFO: using model backend [%s]." % cand)
+        return backend
+
+    raise ImportError('No model backend could be loaded from %s.' % str(candidates))
+
+
+register_backend('numba', _load_numba_backend, 0)
+register_backend('cython', _load_cython_backend, 1)
+register_backend('numpy', _load_numpy_backend, 2)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Coupling of nested domains run concurrently (see run_nested.py).  A parent domain
+passes its analysis to its child domains through a bounded queue after each time step.
+The child interpolates the analysis to its grid with precomputed bilinear weights,
+uses the parent's initial state as its own initial state and replaces the moisture
+of the cells in a band along its boundary with the parent's analysis.  The coupling
+is done by the pipeline stages 'nest_receive' and 'nest_send', which read the queues
+and the weights from the pipeline context
+
+    ctx.nest_parent = (queue, ndx, w)
+    ctx.nest_children = [ queue1, queue2, ... ]
+
+"""
+
+from pipeline import Stage, register_stage
+
+from Queue import Full, Empty
+import numpy as np
+
+
+def interpolation_weights(plat, plon, clat, clon, iters = 20):
+    """
+    Compute the bilinear interpolation weights from the parent grid (plat, plon) to the
+    points of the child grid (clat, clon).  The fractional parent grid indices of the
+    child points are found by Newton iterations on the bilinear map of the parent grid.
+    Returns (ndx, w, inside), where ndx (N x 4) are the flat indices of the parent cell
+    corners of each child point, w (N x 4) the weights and inside marks the child points
+    within the parent domain (points outside are assigned the nearest parent cell).
+    """
+    Ny, Nx = plat.shape
+    plat, plon = plat.astype(np.float64), plon.astype(np.float64)
+    la, lo = clat.ravel().astype(np.float64), clon.ravel().astype(np.float64)
+
+    # initial guess from an affine fit of the grid indices to the coordinates
+    I, J = np.mgrid[0:Ny, 0:Nx]
+    A = np.column_stack([plat.ravel(), plon.ravel(), np.ones(Ny * Nx)])
+    B = np.column_stack([la, lo, np.ones(len(la))])
+    y = np.dot(B, np.linalg.lstsq(A, I.ravel().astype(np.float64), rcond = None)[0])
+    x = np.dot(B, np.linalg.lstsq(A, J.ravel().astype(np.float64), rcond = None)[0])
+
+    for it in range(iters):
+        i0 = np.clip(np.floor(y).astype(np.intp), 0, Ny - 2)
+        j0 = np.clip(np.floor(x).astype(np.intp), 0, Nx - 2)
+        fy, fx = y - i0, x - j0
+
+        # the bilinear map of the cell and its derivatives w.r.t. the fractional indices
+        r, d_dy, d_dx = [], [], []
+        for L, p in [ (plat, la), (plon, lo) ]:
+            L00, L01, L10, L11 = L[i0, j0], L[i0, j0+1], L[i0+1, j0], L[i0+1, j0+1]
+            r.append(p - ((1-fy)*(1-fx)*L00 + (1-fy)*fx*L01 + fy*(1-fx)*L10 + fy*fx*L11))
+            d_dy.append((1-fx)*(L10 - L00) + fx*(L11 - L01))
+            d_dx.append((1-fy)*(L01 - L00) + fy*(L11 - L10))
+
+        # Newton step by Cramer's rule
+        det = d_dy[0] * d_dx[1] - d_dx[0] * d_dy[1]
+        dy = (r[0] * d_dx[1] - d_dx[0] * r[1]) / det
+        dx = (d_dy[0] * r[1] - d_dy[1] * r[0]) / det
+        y = np.clip(y + dy, -1.0, Ny)
+        x = np.clip(x + dx, -1.0, Nx)
+        if np.amax(np.abs(dy)) < 1e-6 and np.amax(np.abs(dx)) < 1e-6:
+            break
+
+    inside = (y >= 0) & (y <= Ny - 1) & (x >= 0) & (x <= Nx - 1)
+    i0 = np.clip(np.floor(y).astype(np.intp), 0, Ny - 2)
+    j0 = np.clip(np.floor(x).astype(np.intp), 0, Nx - 2)
+    fy, fx = np.clip(y - i0, 0.0, 1.0), np.clip(x - j0, 0.0, 1.0)
+    ndx = np.column_stack([i0*Nx + j0, i0*Nx + j0 + 1, (i0+1)*Nx + j0, (i0+1)*Nx + j0 + 1])
+    w = np.column_stack([(1-fy)*(1-fx), (1-fy)*fx, fy*(1-fx), fy*fx])
+    return ndx, w, inside.reshape(clat.shape)
+
+
+def interpolate_field(f, ndx, w, shape):
+    """
+    Interpolate the parent field f (Ny x Nx or Ny x Nx x k) to the child grid of the given
+    shape using the weights computed by interpolation_weights.
+    """
+    F = f.reshape((-1,) + f.shape[2:])
+    wk = w.reshape(w.shape + (1,) * (F.ndim - 1))
+    return np.sum(F[ndx] * wk, axis = 1).reshape(shape + f.shape[2:])
+
+
+def boundary_mask(shape, width):
+    """
+    Return a mask of the cells at most width cells away from the boundary of the grid.
+    """
+    mask = np.zeros(shape, dtype = np.bool_)
+    mask[:width,:] = True
+    mask[-width:,:] = True
+    mask[:,:width] = True
+    mask[:,-width:] = True
+    return mask
+
+
+
+class NestReceive(Stage):
+    """
+    Receives the analysis of the parent domain.  In setup, the child models are
+    initialized from the parent's initial state (unless cfg['nest_initialize'] is False),
+    in each step the moisture in the band of cfg['nest_boundary_width'] cells along the
+    boundary is replaced by the parent's analysis.
+    """
+
+    name = 'nest_receive'
+
+    def setup(self, ctx):
+        cfg = ctx.cfg
+        self.queue, self.ndx, self.w = ctx.nest_parent
+        self.timeout = cfg.get('nest_timeout', 600)
+        self.band = boundary_mask(ctx.dom_shape, cfg.get('nest_boundary_width', 3))
+
+        m0 = self.receive(0)
+        if cfg.get('nest_initialize', True):
+            m = interpolate_field(m0, self.ndx, self.w, ctx.dom_shape)
+            ctx.models.set_state(m)
+            ctx.models_na.set_state(m)
+
+
+    def receive(self, t):
+        """
+        Return the parent's state for time step t.
+        """
+        try:
+            tp, m = self.queue.get(True, self.timeout)
+        except Empty:
+            raise RuntimeError('No state received from the parent domain in %d seconds.' % self.timeout)
+        if tp != t:
+            raise ValueError('Parent state for step %d expected, but step %d received.' % (t, tp))
+        return m
+
+
+    def process(self, ctx):
+        s = ctx.step
+        f = interpolate_field(self.receive(ctx.t), self.ndx, self.w, ctx.dom_shape)
+        m = ctx.models.get_state().copy()
+        m[self.band,:3] = f[self.band]
+        ctx.models.set_state(m)
+        s['f'] = m[:,:,:3].copy()
+
+
+
+class NestSend(Stage):
+    """
+    Sends the initial state and the analysis of each step to the child domains.
+    """
+
+    name = 'nest_send'
+
+    def setup(self, ctx):
+        self.queues = ctx.nest_children
+        self.timeout = ctx.cfg.get('nest_timeout', 600)
+        self.send(0, ctx.models.get_state().copy())
+
+
+    def send(self, t, m):
+        for q in self.queues:
+            try:
+                q.put((t, m), True, self.timeout)
+            except Full:
+                raise RuntimeError('A child domain has not taken a state in %d seconds.' % self.timeout)
+
+
+    def process(self, ctx):
+        self.send(ctx.t, ctx.models.get_state()[:,:,:3].copy())
+
+
+
+for sc in [ NestReceive, NestSend ]:
+    register_stage(sc)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming output of the analysis fields into a CF-compliant netCDF4 file.  Each
+step appends the selected fields along an unlimited time dimension.  The variables
+are compressed and chunked in blocks of time_chunk steps x tiles of the grid, so
+that reading a map touches one row of tiles and reading the time series of a point
+touches one chunk per time_chunk steps.  The steps are buffered and written one
+chunk row at a time on a background thread, the file is closed between the writes
+so it can be read while the run continues.
+
+In the pipeline, the output is written by the 'netcdf' stage configured by
+
+    'netcdf_output' : { 'file' : 'analysis.nc', 'variables' : [ 'fm10', 'fm10_var' ],
+                        'steps' : [ (1, 48) ], 'every' : 1, 'region' : (0, 100, 20, 140),
+                        'complevel' : 4, 'time_chunk' : 24, 'tile' : (64, 64) }
+
+where all keys are optional: all variables, all steps and the whole domain are written
+by default, region is (i0, i1, j0, j1) in grid indices (end exclusive).
+
+"""
+
+from observation_index import epoch_seconds
+
+from Queue import Queue
+import numpy as np
+import threading
+import traceback
+
+
+# the variables that can be written with their long names and units
+analysis_variables = { 'fm1' : ('1-hr fuel moisture content analysis', '1'),
+                       'fm10' : ('10-hr fuel moisture content analysis', '1'),
+                       'fm100' : ('100-hr fuel moisture content analysis', '1'),
+                       'fm10_na' : ('10-hr fuel moisture content without assimilation', '1'),
+                       'fm10_var' : ('variance of the 10-hr fuel moisture model', '1'),
+                       'kriging_field' : ('kriged 10-hr fuel moisture observations', '1'),
+                       'kriging_variance' : ('variance of the kriged observations', '1'),
+                       'kalman_gain_fm1' : ('Kalman gain of the 1-hr fuel moisture', '1'),
+                       'kalman_gain_fm10' : ('Kalman gain of the 10-hr fuel moisture', '1') }
+
+fill_value = np.float32(-9999.0)
+
+
+def step_selected(ocfg, t):
+    """
+    Return True if the step t is selected for output by the configuration ocfg
+    (inclusive step ranges in 'steps' and every 'every'-th step).
+    """
+    steps = ocfg.get('steps')
+    if steps is not None and not any([ a <= t <= b for (a, b) in steps ]):
+        return False
+    return t % ocfg.get('every', 1) == 0
+
+
+def region_slice(ocfg):
+    """
+    Return the tuple of slices selecting the output region of the configuration ocfg.
+    """
+    r = ocfg.get('region')
+    if r is None:
+        return (slice(None), slice(None))
+    return (slice(r[0], r[1]), slice(r[2], r[3]))
+
+
+
+class AnalysisWriter:
+    """
+    Appends the analysis fields of each step to a netCDF4 file on a background thread.
+    """
+
+    def __init__(self, path, lat, lon, variables, complevel = 4, time_chunk = 24, tile = None,
+                 attrs = None, queue_size = 4):
+        """
+        Create the file path for the variables on the grid (lat, lon).  The chunks have
+        time_chunk steps and tile = (ny, nx) grid points (by default tiles of about 1 MB).
+        """
+        for vn in variables:
+            if vn not in analysis_variables:
+                raise ValueError('Unknown output variable [%s], known variables are %s.' % (vn, str(sorted(analysis_variables.keys()))))
+        self.path = path
+        self.variables = variables
+        self.time_chunk = time_chunk
+        self.dom_shape = lat.shape
+        if tile is None:
+            side = max(int((2**18 / time_chunk) ** 0.5), 1)
+            tile = (min(side, lat.shape[0]), min(side, lat.shape[1]))
+        self.create(lat, lon, complevel, tile, attrs)
+
+        # buffered steps, written when time_chunk steps are collected
+        self.buf_times = []
+        self.buf = dict([ (vn, np.zeros((time_chunk,) + self.dom_shape, dtype = np.float32)) for vn in variables ])
+        self.num_written = 0
+
+        self.error = None
+        self.jobs = Queue(queue_size)
+        self.thread = threading.Thread(target = self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def create(self, lat, lon, complevel, tile, attrs):
+        """
+        Create the file with the dimensions, the coordinates and the (empty) variables.
+        """
+        import netCDF4
+        d = netCDF4.Dataset(self.path, 'w', format = 'NETCDF4')
+        d.Conventions = 'CF-1.6'
+        d.title = 'Fuel moisture analysis'
+        for k, v in (attrs or {}).items():
+            setattr(d, k, v)
+
+        Ny, Nx = self.dom_shape
+        d.createDimension('time', None)
+        d.createDimension('south_north', Ny)
+        d.createDimension('west_east', Nx)
+
+        tv = d.createVariable('time', 'f8', ('time',))
+        tv.standard_name = 'time'
+        tv.units = 'seconds since 1970-01-01 00:00:00'
+        tv.calendar = 'standard'
+
+        for vn, val, sname, units in [ ('lat', lat, 'latitude', 'degrees_north'), ('lon', lon, 'longitude', 'degrees_east') ]:
+            v = d.createVariable(vn, 'f4', ('south_north', 'west_east'), zlib = True, complevel = complevel)
+            v.standard_name = sname
+            v.units = units
+            v[:] = val
+
+        for vn in self.variables:
+            long_name, units = analysis_variables[vn]
+            v = d.createVariable(vn, 'f4', ('time', 'south_north', 'west_east'), zlib = True, complevel = complevel,
+                                 shuffle = True, chunksizes = (self.time_chunk,) + tuple(tile), fill_value = fill_value)
+            v.long_name = long_name
+            v.units = units
+            v.coordinates = 'lat lon'
+        d.close()
+
+
+    def _writer(self):
+        """
+        Collect the steps from the queue and append them to the file, stops when
+        it receives None.
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                tm, fields = job
+                i = len(self.buf_times)
+                for vn in self.variables:
+                    f = fields.get(vn)
+                    self.buf[vn][i] = f if f is not None else fill_value
+                self.buf_times.append(tm)
+                if len(self.buf_times) == self.time_chunk:
+                    self.flush()
+            except Exception:
+                self.error = traceback.format_exc()
+
+        if self.error is None:
+            try:
+                self.flush()
+            except Exception:
+                self.error = traceback.format_exc()
+
+
+    def flush(self):
+        """
+        Append the buffered steps to the file.
+        """
+        n = len(self.buf_times)
+        if n == 0:
+            return
+        import netCDF4
+        d = netCDF4.Dataset(self.path, 'a')
+        i0 = self.num_written
+        d.variables['time'][i0:i0+n] = epoch_seconds(self.buf_times)
+        for vn in self.variables:
+            d.variables[vn][i0:i0+n,:,:] = self.buf[vn][:n]
+        d.close()
+        self.num_written += n
+        self.buf_times = []
+
+
+    def check(self):
+        """
+        Raise RuntimeError if writing has failed.
+        """
+        if self.error is not None:
+            raise RuntimeError('Writing [%s] failed:\n%s' % (self.path, self.error))
+
+
+    def write(self, tm, fields):
+        """
+        Enqueue the fields (a dictionary of arrays, missing variables are filled)
+        valid at time tm.  The arrays must not be modified afterwards.
+        """
+        self.check()
+        self.jobs.put((tm, fields))
+
+
+    def close(self):
+        """
+        Write the remaining steps and stop the background thread.
+        """
+        self.jobs.put(None)
+        self.thread.join()
+        self.check()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar index of the station observations by model time step.  The observations
+of all stations are assigned to the time steps once and stored sorted by time step
+in flat arrays (grid indices, values, variances, station indices), so that the
+observations of a time step are a contiguous slice and the model values at the
+observation points are gathered with a single fancy-indexing operation
+
+    idx = ObservationIndex(stations, 'FM', wrf_data.get_gmt_times(), cfg.get('assimilation_time_window', 0))
+    gi, gj = idx.grid_index(t)
+    mod_vals = f[gi, gj, 1]
+
+"""
+
+import numpy as np
+import calendar
+import copy
+
+
+def epoch_seconds(times):
+    """
+    Convert a list of datetime objects into an array of seconds since the epoch
+    (naive datetimes are taken to be in GMT).
+    """
+    return np.array([ calendar.timegm(t.utctimetuple()) for t in times ], dtype = np.float64)
+
+
+class ObservationIndex:
+    """
+    The observations of the type obs_type from a list of stations indexed
+    by the time steps of the model times tm (a list of datetime objects or an
+    array of seconds since the epoch).
+    """
+
+    def __init__(self, stations, obs_type, tm, window = 0):
+        """
+        Assign the observations of the stations to the nearest time step of tm, if the
+        observation is taken at most window seconds away from the model time (a report
+        exactly between two model times goes to the earlier one).  If a station has several
+        reports for a time step, only the closest one is kept.  With zero window, only the
+        observations taken exactly at a model time are indexed.
+        """
+        obs = []
+        station = []
+        for si in range(len(stations)):
+            st_obs = stations[si].get_observations(obs_type)
+            obs.extend(st_obs)
+            station.extend([si] * len(st_obs))
+
+        station = np.array(station, dtype = np.int32)
+        tm_ep = np.asarray(tm, dtype = np.float64) if isinstance(tm, np.ndarray) else epoch_seconds(tm)
+        obs_ep = epoch_seconds([ o.get_time() for o in obs ])
+
+        # the nearest model time is one of the neighbors of the insertion point
+        pos = np.searchsorted(tm_ep, obs_ep)
+        lo = np.clip(pos - 1, 0, len(tm) - 1)
+        hi = np.clip(pos, 0, len(tm) - 1)
+        d_lo = np.abs(obs_ep - tm_ep[lo])
+        d_hi = np.abs(obs_ep - tm_ep[hi])
+        step = np.where(d_hi < d_lo, hi, lo)
+        dist = np.minimum(d_lo, d_hi)
+
+        # sort by station, time step and distance and keep the closest report of each station
+        keep = np.nonzero(dist <= window)[0]
+        keep = keep[np.lexsort((dist[keep], step[keep], station[keep]))]
+        if len(keep) > 0:
+            first = np.ones(len(keep), dtype = np.bool_)
+            first[1:] = (station[keep][1:] != station[keep][:-1]) | (step[keep][1:] != step[keep][:-1])
+            keep = keep[first]
+
+        # sort by time step, the order of stations is kept within a step
+        keep = keep[np.lexsort((station[keep], step[keep]))]
+
+        self.Nt = len(tm)
+        self.obs = [ obs[i] for i in keep ]
+        self.step = step[keep].astype(np.int32)
+        self.station = station[keep]
+        self.offset = obs_ep[keep] - tm_ep[self.step]
+        self.value = np.array([ o.get_value() for o in self.obs ], dtype = np.float64)
+        self.variance = np.array([ o.get_measurement_variance() for o in self.obs ], dtype = np.float64)
+        ngp = [ o.get_nearest_grid_point() for o in self.obs ]
+        self.gi = np.array([ p[0] for p in ngp ], dtype = np.intp)
+        self.gj = np.array([ p[1] for p in ngp ], dtype = np.intp)
+
+        # observations of step t are at positions ptr[t]:ptr[t+1]
+        self.ptr = np.searchsorted(self.step, np.arange(self.Nt + 1))
+
+
+    def regrid(self, stations, active = None):
+        """
+        Return an index of the same observations after the stations (the list the index
+        was built from) have been registered to another grid.  The time steps are not
+        reassigned.  If active is given, only the observations of the stations si with
+        active[si] True are kept.
+        """
+        keep = np.ones(len(self.obs), dtype = np.bool_)
+        if active is not None:
+            keep = np.asarray(active, dtype = np.bool_)[self.station]
+
+        idx = copy.copy(self)
+        idx.obs = [ o for (o, k) in zip(self.obs, keep) if k ]
+        for name in [ 'step', 'station', 'offset', 'value', 'variance' ]:
+            setattr(idx, name, getattr(self, name)[keep])
+
+        ngp = [ stations[si].get_nearest_grid_point() for si in range(len(stations)) ]
+        idx.gi = np.array([ ngp[si][0] for si in idx.station ], dtype = np.intp)
+        idx.gj = np.array([ ngp[si][1] for si in idx.station ], dtype = np.intp)
+        idx.ptr = np.searchsorted(idx.step, np.arange(self.Nt + 1))
+        return idx
+
+
+    def step_slice(self, t):
+        """
+        Return the slice of the arrays which holds the observations of time step t.
+        """
+        return slice(self.ptr[t], self.ptr[t+1])
+
+
+    def num_obs(self, t):
+        """
+        Return the number of observations at time step t.
+        """
+        return self.ptr[t+1] - self.ptr[t]
+
+
+    def observations(self, t):
+        """
+        Return the list of Observation objects at time step t.
+        """
+        return self.obs[self.step_slice(t)]
+
+
+    def values(self, t):
+        """
+        Return the observed values at time step t.
+        """
+        return self.value[self.step_slice(t)]
+
+
+    def variances(self, t):
+        """
+        Return the measurement variances of the observations at time step t.
+        """
+        return self.variance[self.step_slice(t)]
+
+
+    def offsets(self, t):
+        """
+        Return the differences (in seconds) between the observation times and the model time t.
+        """
+        return self.offset[self.step_slice(t)]
+
+
+    def stations(self, t):
+        """
+        Return the indices of the stations of the observations at time step t.
+        """
+        return self.station[self.step_slice(t)]
+
+
+    def grid_index(self, t):
+        """
+        Return the arrays (gi, gj) of the nearest grid points of the observations at time step t.
+        """
+        sl = self.step_slice(t)
+        return self.gi[sl], self.gj[sl]
+
+
+    def gather(self, field, t):
+        """
+        Return the values of field (Ny x Nx or Ny x Nx x k) at the nearest grid points
+        of the observations at time step t.
+        """
+        sl = self.step_slice(t)
+        return field[self.gi[sl], self.gj[sl]]
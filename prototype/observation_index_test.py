@@ -0,0 +1,93 @@
+
+from observation_index import ObservationIndex, epoch_seconds
+from observation_stations import Observation
+
+from datetime import datetime, timedelta
+import numpy as np
+import pytz
+
+
+class SyntheticStation:
+    """
+    A station at the grid point grid_pt with observations of 'FM' at the given times.
+    """
+
+    def __init__(self, grid_pt, obs_times, values):
+        self.grid_pt = grid_pt
+        self.obs = { 'FM' : [ Observation(self, tm, v, 0.01 * v, 'FM') for tm, v in zip(obs_times, values) ] }
+
+    def get_observations(self, obs_type):
+        return self.obs[obs_type]
+
+    def get_nearest_grid_point(self):
+        return self.grid_pt
+
+
+gmt_tz = pytz.timezone('GMT')
+t0 = datetime(2012, 6, 1, tzinfo = gmt_tz)
+minutes = lambda m: t0 + timedelta(minutes = m)
+
+# hourly model times
+model_times = [ minutes(60 * i) for i in range(5) ]
+
+
+def make_stations():
+    """
+    Station 0 reports on the hour, twenty minutes past and exactly between the second and
+    third model time, station 1 reports before the first model time, twice around the
+    third and exactly between the fourth and fifth.
+    """
+    s0 = SyntheticStation((0, 1), [ minutes(m) for m in [ 0, 20, 90, 120 ] ], [ 1.0, 2.0, 3.0, 4.0 ])
+    s1 = SyntheticStation((2, 0), [ minutes(m) for m in [ -45, -10, 110, 125, 210 ] ], [ 6.0, 7.0, 8.0, 9.0, 10.0 ])
+    return [ s0, s1 ]
+
+
+def test_exact_matches():
+    """
+    With zero window only the reports taken exactly at a model time are indexed.
+    """
+    idx = ObservationIndex(make_stations(), 'FM', model_times)
+    assert [ idx.num_obs(t) for t in range(5) ] == [ 1, 0, 1, 0, 0 ]
+    assert list(idx.values(0)) == [ 1.0 ] and list(idx.values(2)) == [ 4.0 ]
+    assert list(idx.offsets(2)) == [ 0.0 ]
+
+
+def test_window_and_ties():
+    """
+    Within a window of 30 minutes the reports go to the nearest model time, a report
+    exactly between two times goes to the earlier one, only the closest report of each
+    station is kept for a step and reports further than the window are dropped.
+    """
+    for tm in [ model_times, epoch_seconds(model_times).astype(np.int64) ]:
+        idx = ObservationIndex(make_stations(), 'FM', tm, 1800)
+        assert [ idx.num_obs(t) for t in range(5) ] == [ 2, 1, 2, 1, 0 ]
+
+        # step 0: station 0 on the hour (closer than the report at 20 minutes) and station 1
+        # ten minutes before (the report 45 minutes before is outside the window)
+        assert list(idx.stations(0)) == [ 0, 1 ]
+        assert list(idx.values(0)) == [ 1.0, 7.0 ]
+        assert list(idx.offsets(0)) == [ 0.0, -600.0 ]
+
+        # the reports exactly between two model times go to the earlier one
+        assert list(idx.values(1)) == [ 3.0 ] and list(idx.offsets(1)) == [ 1800.0 ]
+        assert list(idx.values(3)) == [ 10.0 ] and list(idx.offsets(3)) == [ 1800.0 ]
+
+        # step 2: station 0 on the hour, of the two reports of station 1 the closer one
+        assert list(idx.stations(2)) == [ 0, 1 ]
+        assert list(idx.values(2)) == [ 4.0, 9.0 ]
+        assert list(idx.offsets(2)) == [ 0.0, 300.0 ]
+
+        gi, gj = idx.grid_index(2)
+        assert list(gi) == [ 0, 2 ] and list(gj) == [ 1, 0 ]
+        f = np.arange(12.0).reshape((3, 4))
+        assert list(idx.gather(f, 2)) == [ f[0,1], f[2,0] ]
+    print("INFO: observation index window and tie-breaking checked.")
+
+
+def run_module():
+    test_exact_matches()
+    test_window_and_ties()
+
+
+if __name__ == '__main__':
+    run_module()
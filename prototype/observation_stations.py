@@ -273,6 +273,9 @@ class MesoWestStation(Station):
         # parse the info_string
         self.name = name
 
+        # positions up to which the observation files have been read
+        self.obs_file_pos = {}
+
         Station.__init__(self)
 
 
@@ -307,12 +310,16 @@ class MesoWestStation(Station):
     def load_station_data(self, station_file):
         """
         Load all available fuel moisture data from the station measurement file
-        in an obs file.
+        in an obs file.  Repeated calls only load the packets appended to the
+        file since the previous call.  Returns the number of new observations.
         """
         gmt_tz = pytz.timezone('GMT')
+        Nnew = 0
 
         with open(station_file, "r") as f:
 
+            f.seek(self.obs_file_pos.get(station_file, 0))
+
             while True:
 
                 # read in the date or exit if another packet is not found
@@ -320,20 +327,28 @@ class MesoWestStation(Station):
                 if len(tm_str) == 0:
                     break
 
-                tstamp = gmt_tz.localize(datetime.strptime(tm_str, '%Y-%m-%d_%H:%M %Z'))
-            
-                # read in the variable names
-                var_str = map(string.strip, readline_skip_comments(f).split(","))
-            
-                # read in observations
-                vals = map(lambda x: float(x), readline_skip_comments(f).split(","))
+                # read in the variable names, observations and variances
+                var_line = readline_skip_comments(f)
+                val_line = readline_skip_comments(f)
+                variance_line = readline_skip_comments(f)
 
-                # read in variances
-                variances = map(lambda x: float(x), readline_skip_comments(f).split(","))
+                # the packet is still being written, pick it up on the next call
+                if len(variance_line) == 0:
+                    break
+
+                tstamp = gmt_tz.localize(datetime.strptime(tm_str, '%Y-%m-%d_%H:%M %Z'))
+                var_str = map(string.strip, var_line.split(","))
+                vals = map(lambda x: float(x), val_line.split(","))
+                variances = map(lambda x: float(x), variance_line.split(","))
 
                 # construct observations
                 for vn,val,var in zip(var_str, vals, variances):
                     self.obs[vn].append(Observation(self, tstamp, val, var, vn))
+                    Nnew += 1
+
+                self.obs_file_pos[station_file] = f.tell()
+
+        return Nnew
 
 
     def data_ok(self):
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Operational cycling mode for the moisture model.  A resident process that
+
+1. watches a directory for new WRF output files (one per forecast cycle),
+2. loads only the time slices that have not been processed yet,
+3. carries the model state forward from the previous cycle,
+4. assimilates any new records appended to the station .obs files,
+5. writes the analysis for each time step as soon as it is computed.
+
+    python operational_cycling.py cycling.cfg
+
+"""
+
+from kriging_methods import trend_surface_model_kriging
+from wrf_model_data import WRFModelData, read_wrf_times, accumulated_rainfall, rainfall_rates, bucket_size
+from wrf_series import open_wrf
+from forcing_source import derive_step_equilibria
+from model_backends import load_backend
+from spinup_cache import initialize_from_cache
+from mean_field_model import MeanFieldModel
+from observation_index import ObservationIndex
+from observation_stations import MesoWestStation
+from diagnostics import init_diagnostics, diagnostics
+
+import numpy as np
+import os
+import sys
+import glob
+import time
+import string
+import cPickle
+
+
+def read_rain_accumulation(file_name, ts):
+    """
+    Read the accumulated rainfall at the time indices ts of the WRF file file_name.
+    Unlike in rainfall_chunks, the accumulation is read as is also at the start of the file.
+    """
+    d = open_wrf(file_name)
+    acc = np.asarray(accumulated_rainfall(d.variables, ts, bucket_size(d)))
+    d.close()
+    return acc
+
+
+
+class CyclingAssimilation:
+    """
+    Carries the moisture model state from one WRF forecast cycle to the next
+    and assimilates station observations as they arrive.  The state is saved
+    after each cycle so that a restarted process resumes where it stopped.
+    The WRF variables at the last processed time are kept as well, so that the
+    models are advanced over the interval to the first time of the next file.
+    """
+
+    def __init__(self, cfg):
+        """
+        Set up the cycling from the configuration, restoring the saved state if any.
+        """
+        self.cfg = cfg
+        self.backend = load_backend(cfg.get('model_backend'))
+        self.obs_var = cfg.get('obs_var', 'FM')
+        self.fuel_ndx = 1
+        self.Q = np.eye(9) * cfg['Q']
+        self.P0 = np.eye(9) * cfg['P0']
+        self.Tk = np.array([1.0, 10.0, 100.0]) * 3600
+        self.mfm = MeanFieldModel(cfg['lock_gamma'])
+
+        self.models = None
+        self.models_na = None
+        self.wrf_data = None
+        self.stations = None
+        self.last_time = None
+        self.last_raw = None
+        self.processed = set()
+        self.saved_state = None
+
+        self.state_file = os.path.join(cfg['output_dir'], 'cycle_state.bin')
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'rb') as f:
+                self.saved_state = cPickle.load(f)
+            self.last_time = self.saved_state['last_time']
+            self.last_raw = self.saved_state.get('last_raw')
+            self.processed = self.saved_state['processed']
+            print("INFO: resuming cycling after %s." % str(self.last_time))
+
+
+    def find_new_files(self):
+        """
+        Return the sorted list of WRF files in the watched directory that have
+        not been processed yet and have not been modified for file_settle_time seconds
+        (so that WRF has finished writing them).
+        """
+        settle_time = self.cfg.get('file_settle_time', 2.0)
+        pattern = os.path.join(self.cfg['wrf_watch_dir'], self.cfg.get('wrf_file_pattern', 'wrfout_*'))
+        now = time.time()
+        return [ fn for fn in sorted(glob.glob(pattern))
+                 if fn not in self.processed and now - os.path.getmtime(fn) > settle_time ]
+
+
+    def initialize(self, wrf_data):
+        """
+        Construct the model grids and register the stations to the WRF grid.  The state
+        is restored from the previous run, taken from the spin-up cache or set from the
+        equilibria at timestep 1.  If the WRF file has only one time, the equilibria are
+        derived from the variables at that time.
+        """
+        cfg = self.cfg
+        lat, lon = wrf_data.get_lats(), wrf_data.get_lons()
+        Ed, Ew = wrf_data.get_moisture_equilibria()
+
+        if Ed.shape[0] > 1:
+            E = 0.5 * (Ed[1,:,:] + Ew[1,:,:])
+        else:
+            T2, Q2, PSFC = wrf_data['T2'][0], wrf_data['Q2'][0], wrf_data['PSFC'][0]
+            Ed0, Ew0 = np.zeros_like(T2), np.zeros_like(T2)
+            derive_step_equilibria(T2, Q2, PSFC, T2, Q2, PSFC, Ed0, Ew0, [ np.zeros_like(T2) for i in range(5) ])
+            E = 0.5 * (Ed0 + Ew0)
+        self.models = self.backend.create_grid(lat, lon, 3, E, self.Tk, self.P0)
+        self.models_na = self.backend.create_grid(lat, lon, 3, E, self.Tk, self.P0)
+
+        if self.saved_state is not None:
+            self.models.set_state(self.saved_state['m_ext'], self.saved_state['P'])
+            self.models_na.set_state(self.saved_state['m_ext_na'], self.saved_state['P_na'])
+            self.saved_state = None
+        else:
+            initialize_from_cache(cfg, lat, lon, wrf_data.get_gmt_times()[0], [self.models, self.models_na])
+
+        # load station information once, the observations are refreshed every cycle
+        with open(os.path.join(cfg['station_data_dir'], cfg['station_list_file']), 'r') as f:
+            si_list = f.read().split('\n')
+
+        si_list = filter(lambda x: len(x) > 0 and x[0] != '#', map(string.strip, si_list))
+
+        self.stations = []
+        for code in si_list:
+            mws = MesoWestStation(code)
+            mws.load_station_info(os.path.join(cfg["station_data_dir"], "%s.info" % code))
+            mws.register_to_grid(wrf_data)
+            self.stations.append(mws)
+
+        print('Loaded %d stations.' % len(self.stations))
+
+
+    def resume(self, file_name):
+        """
+        Construct the model grids from the saved state without advancing the models,
+        file_name is a processed WRF file which provides the grid.
+        """
+        self.wrf_data = WRFModelData(file_name, time_slice = slice(0, 2))
+        self.initialize(self.wrf_data)
+        self.refresh_observations()
+
+
+    def refresh_observations(self):
+        """
+        Read the records appended to the station .obs files since the last cycle and
+        drop the observations that are older than the current model time.
+        """
+        Nnew = 0
+        for s in self.stations:
+            if self.last_time is not None:
+                s.obs[self.obs_var] = [o for o in s.obs[self.obs_var] if o.get_time() > self.last_time]
+            obs_file = os.path.join(self.cfg["station_data_dir"], "%s.obs" % s.get_id())
+            if os.path.exists(obs_file):
+                Nnew += s.load_station_data(obs_file)
+
+        print("INFO: loaded %d new observations." % Nnew)
+
+
+    def assimilate(self, obs_index, t, wrf_data):
+        """
+        Krige the observations at time step t of obs_index and run the Kalman update
+        of the assimilated model.
+        """
+        self.assimilate_observations(obs_index.observations(t), obs_index.values(t),
+                                     obs_index.grid_index(t), wrf_data)
+
+
+    def assimilate_observations(self, obs_t, obs_vals, ngp, wrf_data):
+        """
+        Krige the observations obs_t with values obs_vals at the grid points ngp = (gi, gj)
+        and run the Kalman update of the assimilated model.
+        """
+        gi, gj = ngp
+        base_field = self.models.get_state()[:,:,self.fuel_ndx].copy()
+        mod_vals = base_field[gi, gj]
+        self.mfm.fit_to_data(mod_vals[:,np.newaxis], obs_vals)
+        predicted_field = self.mfm.predict_field(base_field[:,:,np.newaxis])
+
+        Kf_fn, Vf_fn = trend_surface_model_kriging(obs_t, wrf_data, predicted_field)
+        self.models.kalman_update([Kf_fn], [Vf_fn], [self.fuel_ndx])
+
+        diagnostics().push("cycle_assim", (str(self.last_time), len(obs_t)))
+
+
+    def store_analysis(self, model_time):
+        """
+        Write the analysis for model_time into the output directory.  The file is renamed
+        into place so that readers never see a partially written analysis.
+        """
+        S = self.models.get_state()
+        P = self.models.get_state_covar()
+        out_name = os.path.join(self.cfg['output_dir'], 'analysis_%s.npz' % model_time.strftime('%Y%m%d_%H%M'))
+        tmp_name = out_name[:-4] + '_tmp.npz'
+        np.savez(tmp_name, fm1 = S[:,:,0], fm10 = S[:,:,1], fm100 = S[:,:,2],
+                 fm10_var = P[:,:,1,1], fm10_na = self.models_na.get_state()[:,:,1])
+        os.rename(tmp_name, out_name)
+
+
+    def save_state(self):
+        """
+        Save the model state, so that a restarted process continues the cycling.
+        """
+        st = { 'last_time' : self.last_time,
+               'last_raw' : self.last_raw,
+               'processed' : self.processed,
+               'm_ext' : self.models.get_state(),
+               'P' : self.models.get_state_covar(),
+               'm_ext_na' : self.models_na.get_state(),
+               'P_na' : self.models_na.get_state_covar() }
+
+        tmp_name = self.state_file + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            cPickle.dump(st, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_name, self.state_file)
+
+
+    def run_cycle(self, file_name):
+        """
+        Advance the models through the new time slices of the WRF file file_name
+        and assimilate the observations available at these times.
+        """
+        tm_all = read_wrf_times(file_name)
+
+        new_ndx = [ i for i in range(len(tm_all)) if self.last_time is None or tm_all[i] > self.last_time ]
+        if len(new_ndx) == 0:
+            print("INFO: no new times in [%s]." % file_name)
+            self.processed.add(file_name)
+            return
+
+        # if the WRF variables at the last time of the previous cycle are kept, only the new
+        # slices are loaded and the first step is the interval from the last time, otherwise
+        # the preceding slice is loaded as well as the rainfall and equilibria are computed
+        # over the interval between slices
+        continued = self.last_time is not None and self.last_raw is not None
+        i0 = new_ndx[0] if continued else max(new_ndx[0] - 1, 0)
+        print("INFO: cycling [%s] from %s, %d new times." % (file_name, str(tm_all[new_ndx[0]]), len(new_ndx)))
+
+        wrf_data = WRFModelData(file_name, time_slice = slice(i0, None))
+        self.wrf_data = wrf_data
+        tm = wrf_data.get_gmt_times()
+        tsec = wrf_data.get_epoch_times()
+        acc = read_rain_accumulation(file_name, slice(i0, None))
+        Ed, Ew = wrf_data.get_moisture_equilibria()
+        T2, Q2, PSFC = wrf_data['T2'], wrf_data['Q2'], wrf_data['PSFC']
+
+        if continued:
+            # the rainfall is differenced from the accumulation at the last time
+            lr = self.last_raw
+            rain = rainfall_rates(acc, tsec, lr['RAIN_ACC'], lr['tsec'])
+            Ed, Ew = Ed.copy(), Ew.copy()
+            w = [ np.zeros_like(T2[0]) for i in range(5) ]
+            derive_step_equilibria(lr['T2'], lr['Q2'], lr['PSFC'], T2[0], Q2[0], PSFC[0], Ed[0], Ew[0], w)
+            tsec_prev = np.concatenate([[lr['tsec']], tsec[:-1]])
+        else:
+            rain = wrf_data['RAIN']
+            tsec_prev = np.concatenate([tsec[:1], tsec[:-1]])
+
+        if self.models is None:
+            self.initialize(wrf_data)
+
+        # the initial state is the state at the first time, from which the next file continues
+        if self.last_time is None:
+            self.last_time = tm[0]
+
+        self.refresh_observations()
+        obs_index = ObservationIndex(self.stations, self.obs_var, tsec, self.cfg.get('assimilation_time_window', 0))
+
+        for t in range(0 if continued else 1, len(tm)):
+            model_time = tm[t]
+            if self.last_time is not None and model_time <= self.last_time:
+                continue
+
+            # the forcing at t covers the interval between the slices t-1 (or the last time) and t
+            dt = int(tsec[t] - tsec_prev[t])
+            self.models.advance(Ed[t,:,:], Ew[t,:,:], rain[t,:,:], dt, self.Q)
+            self.models_na.advance(Ed[t,:,:], Ew[t,:,:], rain[t,:,:], dt, self.Q)
+            self.last_time = model_time
+
+            if obs_index.num_obs(t) > 0:
+                self.assimilate(obs_index, t, wrf_data)
+
+            self.store_analysis(model_time)
+            print("INFO: analysis for %s ready." % str(model_time))
+
+        self.last_raw = { 'T2' : np.array(T2[-1]), 'Q2' : np.array(Q2[-1]), 'PSFC' : np.array(PSFC[-1]),
+                          'RAIN_ACC' : acc[-1].copy(), 'tsec' : tsec[-1] }
+        self.processed.add(file_name)
+        self.save_state()
+
+
+    def run_forever(self):
+        """
+        Poll the watched directory and run a cycle for each new WRF file.
+        """
+        poll_interval = self.cfg.get('poll_interval', 5.0)
+        while True:
+            for fn in self.find_new_files():
+                self.run_cycle(fn)
+            time.sleep(poll_interval)
+
+
+
+if __name__ == '__main__':
+
+    # read in configuration file to execute run
+    print("Reading configuration from [%s]" % sys.argv[1])
+
+    with open(sys.argv[1]) as f:
+        cfg = eval(f.read())
+
+    # ensure output path exists
+    if not os.path.isdir(cfg['output_dir']):
+        os.mkdir(cfg['output_dir'])
+
+    # configure diagnostics
+    init_diagnostics(os.path.join(cfg['output_dir'], 'cycling_diagnostics.txt'))
+    diagnostics().configure_tag("cycle_assim", True, True, False)
+
+    CyclingAssimilation(cfg).run_forever()
@@ -0,0 +1,893 @@
+
+"""
+The data assimilation run as a pipeline of stages.  Each stage implements
+a small interface (setup, process, finish) and communicates with the other
+stages through the pipeline context.  The stages to run are listed in the
+configuration as
+
+    'stages' : [ 'forcing', 'observations', 'advance', 'mean_field', 'kriging', 'kalman', 'frames', 'figures', 'diagnostics' ]
+
+and output sinks can be moved into separate worker processes with
+
+    'stage_workers' : { 'figures' : 2 }
+
+A headless run ('headless' : True) skips the stages that plot, so that the
+plotting stack is never imported.  Selected steps and stages can be profiled,
+see profiling.py, and the throughput of the run can be followed live, see metrics.py.
+The 'netcdf' stage streams the analysis into a netCDF file, see netcdf_writer.py.
+
+"""
+
+from kriging_methods import trend_surface_model_kriging, universal_kriging_data_to_model
+from wrf_model_data import WRFModelData
+from forcing_source import StepForcingReader, PrefetchingForcing
+from model_backends import load_backend
+from spinup_cache import initialize_from_cache
+from baseline_cache import BaselineCache, baseline_key
+from forcing_cache import make_forcing_cache
+from wrf_series import is_series, wrf_files
+from mean_field_model import MeanFieldModel
+from observation_index import ObservationIndex
+from observation_stations import MesoWestStation
+from diagnostics import init_diagnostics, diagnostics
+from online_variance_estimator import OnlineVarianceEstimator
+from frame_writer import FrameWriter, assimilation_frame
+from netcdf_writer import AnalysisWriter, analysis_variables, step_selected, region_slice
+from render_queue import setup_render_figure, render_spatial_panels, render_model_snapshot, put_blocking
+from profiling import make_profiler, profiles_stage
+from metrics import make_metrics
+
+from multiprocessing import Process, Queue
+import numpy as np
+import time
+import os
+import string
+
+
+class PipelineContext:
+    """
+    The state shared by the stages of the pipeline.  Objects that live for the
+    whole run are attributes, the results computed in the current time step are
+    stored in the step dictionary, which is cleared at the beginning of each step.
+    """
+
+    def __init__(self, cfg, wrf_data = None, stations = None, obs_index = None):
+        """
+        Initialize the context, preloaded WRF data, stations and an observation index
+        may be supplied in which case the stages do not construct them again.
+        """
+        self.cfg = cfg
+        self.wrf_data = wrf_data
+        self.stations = stations
+        self.obs_index = obs_index
+        self.t = 0
+        self.Nt = 0
+        self.model_time = None
+        self.step = {}
+
+
+    def begin_step(self, t):
+        """
+        Start the time step t.
+        """
+        self.t = t
+        self.model_time = self.tm[t]
+        self.step = {}
+
+
+
+class Stage:
+    """
+    A stage of the pipeline.  The setup method is called once before the time loop,
+    process at each time step and finish once after the time loop.  If the run fails,
+    abort is called instead of finish.
+    """
+
+    name = None
+    plots = False
+
+    def setup(self, ctx):
+        pass
+
+    def process(self, ctx):
+        pass
+
+    def finish(self, ctx):
+        pass
+
+    def abort(self, ctx):
+        """
+        Release the processes and threads of the stage after a failed run without
+        waiting for the pending work (the stage may be only partly set up).
+        """
+        pass
+
+    def queue_depths(self):
+        """
+        Return the numbers of items waiting in the queues of the stage (by queue name).
+        """
+        return {}
+
+
+
+def queue_size(q):
+    """
+    Return the approximate size of the queue q (zero where the platform cannot tell).
+    """
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return 0
+
+
+
+class SinkStage(Stage):
+    """
+    An output stage, which only consumes the results of the other stages.  The work is
+    split into snapshot (which copies what is needed from the context) and consume
+    (which does the work on the snapshot), so that sinks can run in worker processes.
+    Sinks which must see all snapshots in order limit max_workers to 1.
+    """
+
+    max_workers = None
+
+    def open(self, cfg):
+        pass
+
+    def snapshot(self, ctx):
+        return None
+
+    def consume(self, payload):
+        pass
+
+    def close(self):
+        pass
+
+    def setup(self, ctx):
+        self.open(ctx.cfg)
+
+    def process(self, ctx):
+        payload = self.snapshot(ctx)
+        if payload is not None:
+            self.consume(payload)
+
+    def finish(self, ctx):
+        self.close()
+
+
+
+def _sink_worker(sink_class, cfg, jobs):
+    """
+    Worker process which feeds the snapshots from the jobs queue to a sink.
+    """
+    sink = sink_class()
+    sink.open(cfg)
+    profiler = None
+    if profiles_stage(cfg, sink_class.name):
+        profiler = make_profiler(cfg, '%s_worker_%d' % (sink_class.name, os.getpid()))
+
+    while True:
+        # retrieve next assignment (or None if end of queue)
+        job = jobs.get()
+        if job is None:
+            break
+        t, payload = job
+        if profiler is None:
+            sink.consume(payload)
+        else:
+            profiler.run(sink_class.name, t, sink.consume, payload)
+    sink.close()
+
+    if profiler is not None:
+        profiler.write_reports()
+
+
+
+class WorkerStage(Stage):
+    """
+    Runs a sink stage in worker processes.  The snapshots are passed through a bounded
+    queue, so the time loop blocks if the workers fall behind.
+    """
+
+    def __init__(self, sink, num_workers, queue_size):
+        self.sink = sink
+        self.name = sink.name
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+
+
+    def setup(self, ctx):
+        self.jobs = Queue(self.queue_size)
+        self.workers = [ Process(target = _sink_worker, args = (self.sink.__class__, ctx.cfg, self.jobs))
+                         for i in range(self.num_workers) ]
+        for w in self.workers:
+            w.start()
+
+
+    def process(self, ctx):
+        payload = self.sink.snapshot(ctx)
+        if payload is not None:
+            put_blocking(self.jobs, (ctx.t, payload), self.workers)
+
+
+    def finish(self, ctx):
+        for w in self.workers:
+            self.jobs.put(None)
+        for w in self.workers:
+            w.join()
+
+
+    def abort(self, ctx):
+        for w in getattr(self, 'workers', []):
+            if w.is_alive():
+                w.terminate()
+            w.join()
+
+
+    def queue_depths(self):
+        return { self.name : queue_size(self.jobs) }
+
+
+
+class ProfiledStage(Stage):
+    """
+    Runs the processing of a stage under the profiler in the profiled steps.
+    """
+
+    def __init__(self, stage, profiler):
+        self.stage = stage
+        self.name = stage.name
+        self.profiler = profiler
+
+    def setup(self, ctx):
+        self.stage.setup(ctx)
+
+    def process(self, ctx):
+        self.profiler.run(self.name, ctx.t, self.stage.process, ctx)
+
+    def finish(self, ctx):
+        self.stage.finish(ctx)
+
+    def abort(self, ctx):
+        self.stage.abort(ctx)
+
+    def queue_depths(self):
+        return self.stage.queue_depths()
+
+
+
+class ForcingSource(Stage):
+    """
+    Loads the WRF model data and provides the forcing (Ed, Ew, rain) for each time step.
+    The forcing at step t covers the interval between the WRF times t-1 and t.  If
+    cfg['forcing_prefetch'] is positive, the forcing is not preloaded but read from
+    the WRF file step by step, that many steps ahead on a background thread.
+    Otherwise the derived forcing is cached if cfg['forcing_cache_dir'] is set.
+    """
+
+    name = 'forcing'
+
+    def setup(self, ctx):
+        cfg = ctx.cfg
+        self.prefetch = None
+        depth = cfg.get('forcing_prefetch', 0)
+        if ctx.wrf_data is None:
+            print("INFO: input file is [%s]." % cfg['input_file'])
+            # with prefetching, only the grid and the times are loaded up front
+            ctx.wrf_data = WRFModelData(cfg['input_file'], fields = [] if depth > 0 else None, tz_name = cfg.get('tz_name'),
+                                        forcing_cache = make_forcing_cache(cfg))
+        elif 'Ed' in ctx.wrf_data.fields:
+            depth = 0
+
+        w = ctx.wrf_data
+        ctx.lat, ctx.lon = w.get_lats(), w.get_lons()
+        ctx.tm = w.get_gmt_times()
+        ctx.tm_epoch = w.get_epoch_times()
+        ctx.Nt = cfg['Nt'] if cfg.get('Nt') is not None else len(ctx.tm)
+        ctx.dom_shape = ctx.lat.shape
+
+        if depth > 0:
+            self.reader = StepForcingReader(w.file_name)
+            b = self.reader.allocate_step()
+            self.reader.read_step(1, b)
+            ctx.E_init = 0.5 * (b['Ed'] + b['Ew'])
+            self.prefetch = PrefetchingForcing(self.reader, 1, ctx.Nt, depth)
+        else:
+            self.rain = w['RAIN']
+            self.Ed, self.Ew = w.get_moisture_equilibria()
+            ctx.E_init = 0.5 * (self.Ed[1,:,:] + self.Ew[1,:,:])
+
+
+    def process(self, ctx):
+        t, s = ctx.t, ctx.step
+        if self.prefetch is not None:
+            s['Ed'], s['Ew'], s['rain'], s['dt'] = self.prefetch.get(t)
+        else:
+            s['Ed'] = self.Ed[t,:,:]
+            s['Ew'] = self.Ew[t,:,:]
+            s['rain'] = self.rain[t,:,:]
+            s['dt'] = int(ctx.tm_epoch[t] - ctx.tm_epoch[t-1])
+
+
+    def finish(self, ctx):
+        if self.prefetch is not None:
+            self.prefetch.close()
+            self.reader.close()
+
+
+    def abort(self, ctx):
+        if getattr(self, 'prefetch', None) is not None:
+            self.finish(ctx)
+
+
+    def queue_depths(self):
+        if self.prefetch is None:
+            return {}
+        return { 'forcing_prefetch' : queue_size(self.prefetch.ready) }
+
+
+
+class ObservationSource(Stage):
+    """
+    Loads the MesoWest stations listed in the configuration and provides the observations
+    available at each time step, their values and the nearest grid points (gi, gj).
+    Observations within cfg['assimilation_time_window'] seconds of a model time are
+    assimilated at that time.
+    """
+
+    name = 'observations'
+
+    def setup(self, ctx):
+        cfg = ctx.cfg
+        if ctx.stations is None:
+            ctx.stations = load_mesowest_stations(cfg, ctx.wrf_data)
+        if ctx.obs_index is None:
+            ctx.obs_index = ObservationIndex(ctx.stations, cfg.get('obs_var', 'FM'), ctx.tm_epoch,
+                                             cfg.get('assimilation_time_window', 0))
+
+
+    def process(self, ctx):
+        s, t = ctx.step, ctx.t
+        s['obs'] = ctx.obs_index.observations(t)
+        s['obs_vals'] = ctx.obs_index.values(t)
+        s['obs_ij'] = ctx.obs_index.grid_index(t)
+
+
+
+class ModelAdvance(Stage):
+    """
+    Advances the assimilated and the no-assimilation model grids.  If a baseline cache
+    is configured in cfg['baseline_cache_dir'] and holds the no-assimilation trajectory
+    of this run, the trajectory is read from the cache and ctx.models_na is not advanced.
+    """
+
+    name = 'advance'
+
+    def setup(self, ctx):
+        cfg = ctx.cfg
+
+        # construct initial conditions from timestep 1 (because Ed/Ew at zero are zero)
+        E = ctx.E_init
+
+        self.Q = np.eye(9) * cfg['Q']
+        P0 = np.eye(9) * cfg['P0']
+        Tk = np.array([1.0, 10.0, 100.0]) * 3600
+        backend = load_backend(cfg.get('model_backend'))
+        ctx.models = backend.create_grid(ctx.lat, ctx.lon, 3, E, Tk, P0)
+        ctx.models_na = backend.create_grid(ctx.lat, ctx.lon, 3, E, Tk, P0)
+
+        # start from a spun-up state if one is cached for this domain and time
+        initialize_from_cache(cfg, ctx.lat, ctx.lon, ctx.tm[0], [ctx.models, ctx.models_na])
+
+        # the no-assimilation trajectory is shared by all runs with the same inputs
+        self.baseline = None
+        self.baseline_writer = None
+        if cfg.get('baseline_cache_dir') is not None:
+            cache = BaselineCache(cfg['baseline_cache_dir'])
+            key = baseline_key(ctx.wrf_data.file_name, ctx.tm[:ctx.Nt], Tk, ctx.models_na.get_state(),
+                               ctx.wrf_data.forcing_dtype, backend.name)
+            self.baseline = cache.lookup(key)
+            if self.baseline is None:
+                self.baseline_writer = cache.create(key, (ctx.Nt,) + ctx.dom_shape + (3,))
+                self.baseline_writer.store(0, ctx.models_na.get_state()[:,:,:3])
+            else:
+                print("INFO: reading the no-assimilation trajectory from the baseline cache.")
+            diagnostics().push("baseline_path", cache.entry_path(key))
+
+
+    def process(self, ctx):
+        s = ctx.step
+        ctx.models.advance(s['Ed'], s['Ew'], s['rain'], s['dt'], self.Q)
+        s['f'] = ctx.models.get_state()[:,:,:3].copy()
+
+        if self.baseline is not None:
+            s['f_na'] = np.array(self.baseline[ctx.t])
+        else:
+            ctx.models_na.advance(s['Ed'], s['Ew'], s['rain'], s['dt'], self.Q)
+            s['f_na'] = ctx.models_na.get_state()[:,:,:3].copy()
+            if self.baseline_writer is not None:
+                self.baseline_writer.store(ctx.t, s['f_na'])
+        P = ctx.models.get_state_covar()
+        s['mV'] = P[:,:,1,1].copy()
+        s['mid'] = ctx.models.get_model_ids()[:,:,1].copy()
+
+        diagnostics().push("fm10_model_var", (ctx.t, np.mean(s['mV'])))
+
+
+    def finish(self, ctx):
+        # the trajectory is complete, make it available to other runs
+        if self.baseline_writer is not None:
+            self.baseline_writer.commit()
+            self.baseline_writer = None
+
+
+
+class MeanFieldFit(Stage):
+    """
+    Fits the mean field model to the observations of the 10-hr fuel and predicts
+    the mean field for kriging.
+    """
+
+    name = 'mean_field'
+    fuel_ndx = 1
+
+    def setup(self, ctx):
+        self.mfm = MeanFieldModel(ctx.cfg['lock_gamma'])
+        self.mod_re = OnlineVarianceEstimator(np.zeros(ctx.dom_shape), np.ones(ctx.dom_shape) * 0.05, 1)
+        ctx.mfm = self.mfm
+
+
+    def process(self, ctx):
+        s = ctx.step
+        obs_t = s['obs']
+        if len(obs_t) == 0:
+            return
+
+        # find the model values at the nearest grid points of the observations
+        base_field = s['f'][:,:,self.fuel_ndx]
+        gi, gj = s['obs_ij']
+        s['mod_vals'] = base_field[gi, gj]
+        s['mod_na_vals'] = s['f_na'][gi, gj, self.fuel_ndx]
+
+        # fit the current estimation of the moisture field to the data
+        self.mfm.fit_to_data(s['mod_vals'][:,np.newaxis], s['obs_vals'])
+
+        # predict the moisture field using observed fuel type
+        s['predicted_field'] = self.mfm.predict_field(base_field[:,:,np.newaxis])
+
+        # update the model residual estimator and get current best estimate of variance
+        self.mod_re.update_with(base_field - s['predicted_field'])
+        s['mresV'] = self.mod_re.get_variance()
+        diagnostics().push("fm10_model_residual_var", (ctx.t, np.mean(s['mresV'])))
+
+
+
+class Kriging(Stage):
+    """
+    Kriges the observations to the grid using the strategy in cfg['kriging_strategy']
+    (trend surface model 'tsm' by default or universal kriging 'uk').
+    """
+
+    name = 'kriging'
+    fuel_ndx = 1
+
+    def setup(self, ctx):
+        self.strategy = ctx.cfg.get('kriging_strategy', 'tsm')
+        if self.strategy not in [ 'tsm', 'uk' ]:
+            raise ValueError('Invalid kriging strategy [%s] in configuration.' % self.strategy)
+
+
+    def process(self, ctx):
+        s = ctx.step
+        s['Kf'], s['Vf'], s['fn'] = [], [], []
+        obs_t = s['obs']
+        if len(obs_t) == 0:
+            return
+
+        if self.strategy == 'tsm':
+            Kf_fn, Vf_fn = trend_surface_model_kriging(obs_t, ctx.wrf_data, s['predicted_field'])
+        else:
+            obs_stds = ctx.obs_index.variances(ctx.t) ** 0.5
+            Kf_fn, Vf_fn, gamma, mape = universal_kriging_data_to_model(obs_t, obs_stds, s['f'][:,:,self.fuel_ndx],
+                                                                        ctx.wrf_data, s['mresV'] ** 0.5, ctx.t)
+
+        gi, gj = s['obs_ij']
+        s['krig_vals'] = Kf_fn[gi, gj]
+        diagnostics().push("assim_data", (ctx.t, self.fuel_ndx, s['obs_vals'], s['krig_vals'], s['mod_vals'], s['mod_na_vals']))
+        diagnostics().push("fm10_kriging_var", (ctx.t, np.mean(Vf_fn)))
+
+        # append to storage for kriged fields in this time instant
+        s['Kf'].append(Kf_fn)
+        s['Vf'].append(Vf_fn)
+        s['fn'].append(self.fuel_ndx)
+
+
+
+class KalmanUpdate(Stage):
+    """
+    Runs the Kalman update of the assimilated model grid with the kriged fields.
+    """
+
+    name = 'kalman'
+
+    def process(self, ctx):
+        s = ctx.step
+        if len(s.get('fn', [])) == 0:
+            return
+
+        s['Kg'] = ctx.models.kalman_update(s['Kf'], s['Vf'], s['fn'])[:,:,:,0]
+        s['f_forecast'] = s['f']
+        s['f'] = ctx.models.get_state()[:,:,:3].copy()
+
+        # push new diagnostic outputs
+        diagnostics().push("assim_K0", (ctx.t, np.mean(s['Kg'][:,:,0])))
+        diagnostics().push("assim_K1", (ctx.t, np.mean(s['Kg'][:,:,1])))
+
+
+
+class FrameSink(SinkStage):
+    """
+    Writes a frame for each assimilation step in the layout of the julia prototype
+    (see frame_writer.py).  The frames are numbered when the snapshot is taken,
+    so they are numbered in time order even if written by several workers.
+    """
+
+    name = 'frames'
+    frame_ndx = 0
+    writer = None
+
+    def open(self, cfg):
+        self.writer = FrameWriter(cfg['output_dir'], queue_size = cfg.get('frame_queue_size', 4),
+                                  compress = cfg.get('frame_compress', False))
+
+
+    def snapshot(self, ctx):
+        s = ctx.step
+        if 'Kg' not in s:
+            return None
+
+        self.frame_ndx += 1
+        deltas = np.amax(np.abs(ctx.models.get_state()[:,:,3:9]), axis = (0, 1))
+        frame = assimilation_frame(ctx.model_time, s['f_forecast'][:,:,1], s['f_na'][:,:,1], s['mV'], s['obs'], s['obs_vals'],
+                                   s['Kf'][0], s['Vf'][0], s['krig_vals'], s['f'][:,:,1], deltas, s['Kg'][:,:,1].copy(),
+                                   ctx.mfm.gamma.copy(), np.mean(s['mresV']))
+        return self.frame_ndx, frame
+
+
+    def consume(self, p):
+        ndx, frame = p
+        self.writer.write(frame, ndx)
+
+
+    def close(self):
+        self.writer.close()
+
+
+    def queue_depths(self):
+        # the writer only exists if the sink runs in this process
+        if self.writer is None:
+            return {}
+        return { self.name : queue_size(self.writer.jobs) }
+
+
+
+class NetCDFSink(SinkStage):
+    """
+    Appends the analysis fields of the selected steps to a netCDF file (see netcdf_writer.py)
+    configured by cfg['netcdf_output'].  The grid is passed with the first snapshot, so that
+    the sink can run in a worker process.
+    """
+
+    name = 'netcdf'
+    max_workers = 1
+    grid_sent = False
+    writer = None
+
+    def open(self, cfg):
+        self.ocfg = cfg.get('netcdf_output', {})
+        self.path = os.path.join(cfg['output_dir'], self.ocfg.get('file', 'analysis.nc'))
+        src = cfg['input_file']
+        self.attrs = { 'source' : ','.join(wrf_files(src)) if is_series(src) else src }
+
+
+    def snapshot(self, ctx):
+        ocfg = ctx.cfg.get('netcdf_output', {})
+        if not step_selected(ocfg, ctx.t):
+            return None
+
+        s = ctx.step
+        sl = region_slice(ocfg)
+        Kg, Kf, Vf = s.get('Kg'), s.get('Kf', []), s.get('Vf', [])
+        fields = { 'fm1' : s['f'][:,:,0], 'fm10' : s['f'][:,:,1], 'fm100' : s['f'][:,:,2],
+                   'fm10_na' : s['f_na'][:,:,1], 'fm10_var' : s['mV'],
+                   'kriging_field' : Kf[0] if len(Kf) > 0 else None,
+                   'kriging_variance' : Vf[0] if len(Vf) > 0 else None,
+                   'kalman_gain_fm1' : Kg[:,:,0] if Kg is not None else None,
+                   'kalman_gain_fm10' : Kg[:,:,1] if Kg is not None else None }
+        variables = ocfg.get('variables', sorted(analysis_variables.keys()))
+        p = { 'time' : ctx.model_time,
+              'fields' : dict([ (vn, fields[vn][sl].astype(np.float32)) for vn in variables if fields[vn] is not None ]) }
+
+        if not self.grid_sent:
+            p['grid'] = (ctx.lat[sl], ctx.lon[sl])
+            self.grid_sent = True
+        return p
+
+
+    def consume(self, p):
+        if self.writer is None:
+            lat, lon = p['grid']
+            self.writer = AnalysisWriter(self.path, lat, lon, self.ocfg.get('variables', sorted(analysis_variables.keys())),
+                                         self.ocfg.get('complevel', 4), self.ocfg.get('time_chunk', 24),
+                                         self.ocfg.get('tile'), self.attrs)
+        self.writer.write(p['time'], p['fields'])
+
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            print("INFO: analysis written to [%s]." % self.path)
+
+
+    def queue_depths(self):
+        if self.writer is None:
+            return {}
+        return { self.name : queue_size(self.writer.jobs) }
+
+
+
+class FigureSink(SinkStage):
+    """
+    Renders the state of the model and the assimilation at each time step.
+    """
+
+    name = 'figures'
+    plots = True
+    maxE = 0.5
+
+    def open(self, cfg):
+        setup_render_figure()
+        self.output_dir = cfg['output_dir']
+
+
+    def snapshot(self, ctx):
+        s = ctx.step
+        zero = np.zeros(ctx.dom_shape)
+        Kg = s.get('Kg')
+        Kf = s.get('Kf', [])
+        Vf = s.get('Vf', [])
+        mresV = s.get('mresV', zero)
+        maxE = self.maxE
+        p = { 't' : ctx.t,
+              'title' : 'Model behavior for time %s' % str(ctx.model_time),
+              'panels' : [ (s['f'][:,:,0], '1-hr fuel', maxE),
+                           (s['f'][:,:,1], '10-hr fuel', maxE),
+                           (s['f_na'][:,:,1], '10hr fuel - no assim', maxE),
+                           (Kg[:,:,0] if Kg is not None else zero, 'Kalman gain for 1-hr fuel', 3.0),
+                           (Kg[:,:,1] if Kg is not None else zero, 'Kalman gain for 10-hr fuel', 1.0),
+                           (Kf[0] if len(Kf) > 0 else zero, 'Kriging field', maxE),
+                           (s['mid'], 'Model ids', 5.0),
+                           (Vf[0] if len(Vf) > 0 else zero, 'Kriging variance', np.max(Vf[0]) if len(Vf) > 0 else 1.0),
+                           (mresV, 'Model res. variance', np.max(mresV)) ] }
+        if 'krig_vals' in s:
+            p['station_vals'] = (s['obs_vals'], s['krig_vals'], s['mod_vals'], s['mod_na_vals'])
+        return p
+
+
+    def consume(self, p):
+        render_spatial_panels(os.path.join(self.output_dir, 'moisture_model_t%03d.png' % p['t']), p['panels'])
+        if 'station_vals' in p:
+            render_model_snapshot(os.path.join(self.output_dir, 'model_snapshot_f1_t%03d.png' % p['t']),
+                                  p['title'], *p['station_vals'])
+
+
+
+class DiagnosticsSink(Stage):
+    """
+    Stores the diagnostics at the end of the run and plots their time series.
+    """
+
+    name = 'diagnostics'
+
+    def finish(self, ctx):
+        out_dir = ctx.cfg['output_dir']
+
+        # store the diagnostics in a binary file
+        diagnostics().dump_store(os.path.join(out_dir, 'diagnostics.bin'))
+
+        if ctx.cfg.get('headless', False):
+            return
+
+        import matplotlib.pyplot as plt
+        plt.switch_backend('Agg')
+
+        plt.figure()
+        for tag, title, fname in [ ("assim_K1", 'Average Kalman gain', 'plot_kalman_gain_10hr.png'),
+                                   ("assim_K0", 'Average Kalman gain', 'plot_kalman_gain_1hr.png'),
+                                   ("fm10_model_var", 'Average fm10 model variance', 'plot_fm10_model_variance.png'),
+                                   ("fm10_model_residual_var", 'Average fm10 model residual variance', 'plot_fm10_model_residual_variance.png'),
+                                   ("fm10_kriging_var", 'Kriging field variance', 'plot_kriging_variance.png') ]:
+            D = diagnostics().pull(tag)
+            if D is None:
+                continue
+            plt.clf()
+            plt.plot([d[0] for d in D], [d[1] for d in D], 'ro-')
+            plt.title(title)
+            plt.savefig(os.path.join(out_dir, fname))
+
+        for tag, title, fname in [ ('mfm_gamma', 'Mean field model - gamma', 'plot_gamma.png'),
+                                   ('mfm_mape', 'Mean absolute prediction error of station data', 'plot_station_mape.png') ]:
+            D = diagnostics().pull(tag)
+            if D is None:
+                continue
+            plt.clf()
+            plt.plot(D, 'ro-')
+            plt.title(title)
+            plt.savefig(os.path.join(out_dir, fname))
+
+        plt.close()
+
+
+
+def load_mesowest_stations(cfg, wrf_data):
+    """
+    Load the stations listed in cfg['station_list_file'], register them to the
+    WRF grid and load their observations.
+    """
+    with open(os.path.join(cfg['station_data_dir'], cfg['station_list_file']), 'r') as f:
+        si_list = f.read().split('\n')
+
+    si_list = filter(lambda x: len(x) > 0 and x[0] != '#', map(string.strip, si_list))
+
+    # for each station id, load the station
+    stations = []
+    for code in si_list:
+        mws = MesoWestStation(code)
+        mws.load_station_info(os.path.join(cfg["station_data_dir"], "%s.info" % code))
+        mws.register_to_grid(wrf_data)
+        mws.load_station_data(os.path.join(cfg["station_data_dir"], "%s.obs" % code))
+        stations.append(mws)
+
+    print('Loaded %d stations.' % len(stations))
+
+    # check stations for nans
+    stations = filter(MesoWestStation.data_ok, stations)
+    print('Have %d stations with complete data.' % len(stations))
+
+    return stations
+
+
+
+# the stage classes indexed by the names used in the configuration
+_stage_classes = {}
+
+default_stages = [ 'forcing', 'observations', 'advance', 'mean_field', 'kriging', 'kalman', 'frames', 'figures', 'diagnostics' ]
+
+
+def register_stage(stage_class):
+    """
+    Make a stage class available to the configuration under its name.
+    """
+    _stage_classes[stage_class.name] = stage_class
+
+
+def build_stages(cfg):
+    """
+    Construct the stages listed in cfg['stages'] (or the default stages).  Sinks listed
+    in cfg['stage_workers'] are run in the given number of worker processes.  Stages
+    that only plot are dropped in headless runs.
+    """
+    workers = cfg.get('stage_workers', {})
+    headless = cfg.get('headless', False)
+    stages = []
+    for name in cfg.get('stages', default_stages):
+        if name not in _stage_classes:
+            raise ValueError('Invalid stage [%s] in configuration, known stages are %s.' % (name, str(sorted(_stage_classes.keys()))))
+        if headless and _stage_classes[name].plots:
+            print("INFO: headless run, skipping stage [%s]." % name)
+            continue
+        stage = _stage_classes[name]()
+        if workers.get(name, 0) > 0:
+            if not isinstance(stage, SinkStage):
+                raise ValueError('Stage [%s] is not an output sink and cannot run in a worker.' % name)
+            if stage.max_workers is not None and workers[name] > stage.max_workers:
+                raise ValueError('Stage [%s] can run in at most %d workers.' % (name, stage.max_workers))
+            stage = WorkerStage(stage, workers[name], cfg.get('stage_queue_size', 4))
+        stages.append(stage)
+    return stages
+
+
+def configure_diagnostics(cfg):
+    """
+    Initialize the diagnostics for a pipeline run.
+    """
+    init_diagnostics(os.path.join(cfg['output_dir'], 'moisture_model_v1_diagnostics.txt'))
+
+    # Error covariance matrix condition number in kriging
+    diagnostics().configure_tag("skdm_cov_cond", False, True, True)
+
+    # Assimilation parameters
+    diagnostics().configure_tag("assim_K0", False, True, True)
+    diagnostics().configure_tag("assim_K1", True, True, True)
+    diagnostics().configure_tag("assim_data", False, False, True)
+
+    diagnostics().configure_tag("fm10_model_residual_var", True, True, True)
+    diagnostics().configure_tag("fm10_model_var", False, True, True)
+    diagnostics().configure_tag("fm10_kriging_var", False, True, True)
+
+    # location of the cached no-assimilation trajectory for postprocessing
+    diagnostics().configure_tag("baseline_path", False, True, True)
+
+
+def run_pipeline(cfg, ctx = None):
+    """
+    Run the stages configured in cfg over all time steps.  A context with preloaded
+    WRF data and stations may be passed in.  Returns the context after the run.
+    """
+    if ctx is None:
+        ctx = PipelineContext(cfg)
+
+    # ensure output path exists
+    if not os.path.isdir(cfg['output_dir']):
+        os.makedirs(cfg['output_dir'])
+
+    configure_diagnostics(cfg)
+
+    stages = build_stages(cfg)
+
+    # the stages are only wrapped if profiling is configured
+    profiler = make_profiler(cfg, 'main')
+    if profiler is not None:
+        stages = [ ProfiledStage(s, profiler) if profiles_stage(cfg, s.name) else s for s in stages ]
+
+    metrics = make_metrics(cfg)
+
+    # the stages which were set up and not finished yet are aborted if the run fails,
+    # so that no worker process keeps the run alive
+    running = []
+    try:
+        for stage in stages:
+            running.append(stage)
+            stage.setup(ctx)
+
+        for t in range(1, ctx.Nt):
+            ctx.begin_step(t)
+            print("INFO: time: %s, step: %d" % (str(ctx.model_time), t))
+            if metrics is None:
+                for stage in stages:
+                    stage.process(ctx)
+                continue
+
+            for stage in stages:
+                t0 = time.time()
+                stage.process(ctx)
+                metrics.add_stage_time(stage.name, time.time() - t0)
+
+            s = ctx.step
+            num_obs = len(s.get('obs', [])) if 'Kg' in s else 0
+            kriging_size = len(s.get('obs', [])) if len(s.get('Kf', [])) > 0 else 0
+            depths = {}
+            for stage in stages:
+                depths.update(stage.queue_depths())
+            metrics.end_step(t, int(np.prod(ctx.dom_shape)), num_obs, kriging_size, depths)
+
+        while len(running) > 0:
+            running[0].finish(ctx)
+            running.pop(0)
+    finally:
+        for stage in running:
+            try:
+                stage.abort(ctx)
+            except Exception as e:
+                print("WARN: aborting stage [%s] failed: %s" % (stage.name, str(e)))
+
+    if profiler is not None:
+        profiler.write_reports()
+    if metrics is not None:
+        metrics.write()
+
+    return ctx
+
+
+for sc in [ ForcingSource, ObservationSource, ModelAdvance, MeanFieldFit, Kriging, KalmanUpdate, FrameSink, NetCDFSink, FigureSink, DiagnosticsSink ]:
+    register_stage(sc)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Dry run of a configuration: reads only the metadata of the WRF file and the station
+list, projects the memory needed by the run and the time per step and recommends
+settings for the host.  The time per step is extrapolated from a short calibration
+run of the model backends and kriging on a small synthetic grid.
+
+    python plan_run.py cfg/col_1km_pipeline.cfg [memory_limit_GB]
+
+"""
+
+from model_backends import load_backend, available_backends
+from kriging_methods import trend_surface_model_kriging, universal_kriging_data_to_model
+from observation_stations import Station, Observation
+from diagnostics import init_diagnostics, diagnostics
+from wrf_series import wrf_files
+
+from multiprocessing import cpu_count
+import numpy as np
+import os
+import sys
+import time
+import string
+
+
+# variables loaded by WRFModelData by default
+forcing_vars = [ 'T2', 'Q2', 'PSFC', 'RAINNC', 'RAINC' ]
+
+
+def read_domain_metadata(source):
+    """
+    Read the dimensions and data types of the WRF file without loading any data.  For
+    a series of WRF files (see wrf_series.py) the times and sizes of the files are summed
+    (times present in several files are counted in each, which is an upper bound).
+    """
+    import netCDF4
+    files = wrf_files(source)
+    meta = { 'Nt' : 0, 'file_size' : 0 }
+    for fn in files:
+        d = netCDF4.Dataset(fn)
+        v = d.variables
+        meta['Nt'] += v['Times'].shape[0]
+        meta['file_size'] += os.path.getsize(fn)
+        if fn == files[0]:
+            meta['dom_shape'] = v['T2'].shape[1:]
+            meta['itemsize'] = dict([ (vn, v[vn].dtype.itemsize) for vn in forcing_vars + [ 'XLAT', 'XLONG' ] ])
+        d.close()
+    return meta
+
+
+def count_stations(cfg):
+    """
+    Count the stations in the station list of the configuration (the observations are not read).
+    """
+    if cfg.get('station_list_file') is None:
+        return 0
+    with open(os.path.join(cfg['station_data_dir'], cfg['station_list_file']), 'r') as f:
+        si_list = f.read().split('\n')
+    return len(filter(lambda x: len(x) > 0 and x[0] != '#', map(string.strip, si_list)))
+
+
+def cell_object_size(k = 3):
+    """
+    Estimate the memory used by one python cell model object (numpy and cython backends).
+    """
+    from cell_model import CellMoistureModel
+    c = CellMoistureModel((0.0, 0.0), k, np.zeros(k), None, np.eye(2*k+3))
+    arrays = [ a for a in c.__dict__.values() if isinstance(a, np.ndarray) ]
+    return sys.getsizeof(c) + sys.getsizeof(c.__dict__) + sum([ sys.getsizeof(a) for a in arrays ]) + 100
+
+
+def estimate_memory(meta, Nst, cfg, backend_name, k = 3):
+    """
+    Project the memory used by the run, returns a list of (item, bytes).
+    """
+    Nt = meta['Nt'] if cfg.get('Nt') is None else cfg['Nt']
+    Ny, Nx = meta['dom_shape']
+    Ncells = Ny * Nx
+    isz = meta['itemsize']
+    n = 2*k+3
+    depth = cfg.get('forcing_prefetch', 0)
+
+    items = []
+    if depth > 0:
+        items.append(('forcing buffers (prefetch depth %d)' % depth, ((depth + 2) * 3 + 13) * Ncells * isz['T2']))
+    else:
+        # the whole cube is loaded, RAINC and RAINNC are released after the rainfall is computed
+        items.append(('forcing cube (%s)' % ', '.join(forcing_vars), sum([ isz[vn] for vn in forcing_vars ]) * Nt * Ncells))
+        items.append(('derived Ed, Ew, RAIN', (2 * isz['PSFC'] + isz['RAINNC']) * Nt * Ncells))
+        items.append(('temporaries of the equilibria (peak)', 6 * isz['T2'] * Nt * Ncells))
+    items.append(('grid coordinates', (isz['XLAT'] + isz['XLONG']) * Ncells))
+
+    # two model grids (assimilated and no-assimilation)
+    if backend_name == 'numba':
+        items.append(('model state and covariance (2 grids)', 2 * Ncells * (8 * (n + n*n) + 4 * k)))
+    else:
+        items.append(('model cell objects (2 grids)', 2 * Ncells * cell_object_size(k)))
+
+    # kriged field, variance, Kalman gains, per-step copies of the fields
+    items.append(('kriging and Kalman gain fields', Ncells * 8 * (4 + n)))
+    items.append(('per-step fields', Ncells * 8 * 12))
+    if cfg.get('kriging_strategy', 'tsm') == 'uk':
+        items.append(('kriging matrices (%d stations)' % Nst, 4 * Nst * Nst * 8))
+
+    return items
+
+
+def _calibration_observations(lat, lon, Nobs):
+    """
+    Construct Nobs observations at random grid points of the calibration grid.
+    """
+    obs = []
+    for i in range(Nobs):
+        s = Station()
+        s.grid_pt = (np.random.randint(lat.shape[0]), np.random.randint(lat.shape[1]))
+        s.lat, s.lon = lat[s.grid_pt], lon[s.grid_pt]
+        obs.append(Observation(s, None, 0.1 + 0.05 * np.random.rand(), 0.001, 'FM'))
+    return obs
+
+
+class _CalibrationGrid:
+    """
+    The grid of the calibration runs (the part of the WRFModelData interface used in kriging).
+    """
+
+    def __init__(self, lat, lon):
+        self.lat, self.lon = lat, lon
+
+    def get_lats(self):
+        return self.lat
+
+    def get_lons(self):
+        return self.lon
+
+
+
+def calibrate(backend_names, Nobs, uk, N = 16, steps = 3):
+    """
+    Measure the time per grid cell of the model advance and the Kalman update for each
+    backend and of the kriging on an N x N grid.  Returns a dictionary of times in seconds
+    per cell and step indexed by 'advance:<backend>', 'kalman:<backend>', 'kriging'.
+    """
+    init_diagnostics(None)
+    diagnostics().configure_tag("skdm_cov_cond", False, False, False)
+    lat, lon = np.mgrid[40.0:40.0 + 0.01*N:N*1j, -105.0:-105.0 + 0.01*N:N*1j]
+    Ncells = N * N
+    E = 0.1 * np.ones((N, N))
+    Tk = np.array([1.0, 10.0, 100.0]) * 3600
+    P0 = np.eye(9) * 0.01
+    Q = np.eye(9) * 5e-5
+    Ed, Ew, rain = 0.12 * np.ones((N, N)), 0.08 * np.ones((N, N)), np.zeros((N, N))
+    O, V = [ 0.1 * np.ones((N, N)) ], [ 0.001 * np.ones((N, N)) ]
+
+    times = {}
+    for name in backend_names:
+        models = load_backend(name).create_grid(lat, lon, 3, E, Tk, P0)
+
+        # the first step may include compilation, it is not timed
+        models.advance(Ed, Ew, rain, 3600, Q)
+        models.kalman_update(O, V, [1])
+
+        t0 = time.time()
+        for i in range(steps):
+            models.advance(Ed, Ew, rain, 3600, Q)
+        times['advance:' + name] = (time.time() - t0) / steps / Ncells
+
+        t0 = time.time()
+        for i in range(steps):
+            models.kalman_update(O, V, [1])
+        times['kalman:' + name] = (time.time() - t0) / steps / Ncells
+
+    obs = _calibration_observations(lat, lon, max(Nobs, 2))
+    grid = _CalibrationGrid(lat, lon)
+    t0 = time.time()
+    if uk:
+        obs_stds = np.array([o.get_measurement_variance() for o in obs]) ** 0.5
+        try:
+            universal_kriging_data_to_model(obs, obs_stds, E, grid, 0.05 * np.ones((N, N)), 0)
+        except Exception as e:
+            print("WARN: universal kriging failed in calibration (%s), timing trend surface model instead." % str(e))
+            t0 = time.time()
+            trend_surface_model_kriging(obs, grid, E)
+    else:
+        trend_surface_model_kriging(obs, grid, E)
+    times['kriging'] = (time.time() - t0) / Ncells
+
+    return times
+
+
+def available_memory():
+    """
+    Return the memory available on the host in bytes (or None if it cannot be determined).
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return int(l.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def format_bytes(b):
+    for unit in [ 'B', 'kB', 'MB', 'GB' ]:
+        if b < 1024.0 or unit == 'GB':
+            return '%.1f %s' % (b, unit)
+        b /= 1024.0
+
+
+
+if __name__ == '__main__':
+
+    # read in configuration file to plan
+    print("Reading configuration from [%s]" % sys.argv[1])
+
+    with open(sys.argv[1]) as f:
+        cfg = eval(f.read())
+
+    mem_limit = float(sys.argv[2]) * 1024**3 if len(sys.argv) > 2 else available_memory()
+
+    meta = read_domain_metadata(cfg['input_file'])
+    Nst = count_stations(cfg)
+    Nt = meta['Nt'] if cfg.get('Nt') is None else cfg['Nt']
+    Ny, Nx = meta['dom_shape']
+    uk = cfg.get('kriging_strategy', 'tsm') == 'uk'
+
+    print("")
+    print("Domain: %d times, %d x %d grid, %d stations, WRF file %s." % (Nt, Ny, Nx, Nst, format_bytes(meta['file_size'])))
+
+    # calibrate all backends available on this host
+    backends = [ b for b in [ 'numba', 'cython', 'numpy' ] if b in available_backends() ]
+    times = calibrate(backends, Nst, uk)
+    step_times = dict([ (b, Ny * Nx * (2 * times['advance:' + b] + times['kalman:' + b] + times['kriging'])) for b in backends ])
+    best = min(backends, key = lambda b: step_times[b])
+    backend_name = cfg.get('model_backend') if cfg.get('model_backend') in backends else best
+
+    items = estimate_memory(meta, Nst, cfg, backend_name)
+    total = sum([ b for (_, b) in items ])
+
+    print("")
+    print("Projected memory (%s backend):" % backend_name)
+    for item, b in items:
+        print("  %-45s %12s" % (item, format_bytes(b)))
+    print("  %-45s %12s" % ('total', format_bytes(total)))
+    if cfg.get('baseline_cache_dir') is not None:
+        print("  %-45s %12s" % ('baseline cache entry (on disk)', format_bytes(Nt * Ny * Nx * 3 * 8)))
+
+    print("")
+    print("Projected time per step (calibrated on this host):")
+    for b in backends:
+        print("  %-10s %8.3f s/step, %10.1f s for %d steps" % (b, step_times[b], step_times[b] * (Nt - 1), Nt - 1))
+
+    # recommendations
+    print("")
+    if mem_limit is not None:
+        print("Memory available: %s." % format_bytes(mem_limit))
+        if total > mem_limit:
+            print("WARN: the run does not fit into the available memory.")
+
+    print("")
+    print("Recommendations:")
+    print("  'model_backend' : '%s'" % best)
+    if mem_limit is not None:
+        forcing = sum([ b for (item, b) in items if item.startswith('forcing') or item.startswith('derived') or item.startswith('temporaries') ])
+        if cfg.get('forcing_prefetch', 0) == 0 and forcing > 0.5 * mem_limit:
+            print("  'forcing_prefetch' : 2 (the preloaded forcing takes %s)" % format_bytes(forcing))
+        print("  'sweep_workers' : %d (concurrent variants that fit into memory)" % max(1, min(cpu_count(), int(mem_limit / total))))
+    spare = max(cpu_count() - 1, 0)
+    if spare == 0:
+        print("  'headless' : True (no spare processor for rendering figures)")
+    else:
+        print("  'stage_workers' : { 'figures' : %d }" % min(spare, 4))
@@ -12,7 +12,6 @@ from observation_stations import MesoWestStation, Observation
 from statistics import compute_ols_estimator
 from diagnostics import init_diagnostics, diagnostics
 
-from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.dates import DateFormatter
@@ -128,6 +127,7 @@ if __name__ == '__main__':
     urcrnrlon = max(map(lambda x: x.lon, stations))
     urcrnrlat = max(map(lambda x: x.lat, stations))
 
+    from mpl_toolkits.basemap import Basemap
     m = Basemap(llcrnrlon=llcrnrlon,
                 llcrnrlat=llcrnrlat,
                 urcrnrlon=urcrnrlon,
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Point time-series index over the outputs of a run.  The outputs are stored time-major
+(a map per step), so the time series of a single point touches every step.  The indexer
+transposes selected variables into site-major arrays (cells x time) stored as .npy
+files, which are read through memory maps: the whole time series of a grid point is one
+contiguous row.  A lookup table of the grid points binned by lat/lon finds the grid point
+nearest to a query position without scanning the grid.
+
+The index is built from the netCDF output of the 'netcdf' pipeline stage (see
+netcdf_writer.py) or from the assimilation frames (see frame_writer.py) together with
+the WRF file of the run, which provides the grid
+
+    python point_index.py build model_outputs/col_1km_pipeline/analysis.nc index_dir [fm10 fm10_var]
+    python point_index.py build-frames model_outputs/col_1km/ wrfout.nc index_dir [fm10_model_state_assim]
+    python point_index.py query index_dir 39.5 -105.1 [days]
+
+"""
+
+from observation_index import epoch_seconds
+from frame_writer import frame_path, read_frame
+from wrf_model_data import WRFModelData, epoch_to_datetimes
+
+from datetime import timedelta
+import numpy as np
+import shutil
+import glob
+import sys
+import os
+
+
+def _lookup_table(lat, lon):
+    """
+    Bin the grid points by lat/lon into cells of about the grid spacing.  Returns the
+    origin and size of the bins, the shape of the bin grid and the points of each bin
+    in compressed form (the points of bin b are pts[start[b]:start[b+1]]).
+    """
+    Ny, Nx = lat.shape
+    lat0, lon0 = np.amin(lat), np.amin(lon)
+    dlat = max((np.amax(lat) - lat0) / max(Ny - 1, 1), 1e-6)
+    dlon = max((np.amax(lon) - lon0) / max(Nx - 1, 1), 1e-6)
+    bshape = (int((np.amax(lat) - lat0) / dlat) + 1, int((np.amax(lon) - lon0) / dlon) + 1)
+
+    bi = np.minimum(((lat.ravel() - lat0) / dlat).astype(np.intp), bshape[0] - 1)
+    bj = np.minimum(((lon.ravel() - lon0) / dlon).astype(np.intp), bshape[1] - 1)
+    b = bi * bshape[1] + bj
+    pts = np.argsort(b, kind = 'mergesort')
+    start = np.searchsorted(b[pts], np.arange(bshape[0] * bshape[1] + 1))
+    return np.array([lat0, lon0, dlat, dlon]), np.array(bshape), pts, start
+
+
+
+def build_index(index_dir, lat, lon, times, blocks, variables):
+    """
+    Build the index in index_dir from the grid (lat, lon), the list of the times of
+    the steps and an iterator blocks over (t0, fields), where fields maps each variable
+    to an array (n x Ny x Nx) of the steps t0, ..., t0 + n - 1.  The index is built in a
+    temporary directory and moved into place when complete.
+    """
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    Ny, Nx = lat.shape
+    Nt = len(times)
+    tmp_dir = index_dir.rstrip('/') + '_tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    fm = dict([ (vn, np.lib.format.open_memmap(os.path.join(tmp_dir, '%s.npy' % vn), mode = 'w+',
+                                               dtype = np.float32, shape = (Ny * Nx, Nt))) for vn in variables ])
+    for t0, fields in blocks:
+        for vn in variables:
+            f = fields[vn]
+            fm[vn][:, t0:t0+f.shape[0]] = f.reshape((f.shape[0], Ny * Nx)).T
+    for vn in variables:
+        fm[vn].flush()
+    del fm
+
+    box, bshape, pts, start = _lookup_table(lat, lon)
+    np.savez(os.path.join(tmp_dir, 'grid.npz'), lat = lat, lon = lon, times = epoch_seconds(times),
+             variables = np.array(variables), box = box, bshape = bshape, pts = pts, start = start)
+
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.rename(tmp_dir, index_dir)
+
+
+
+def index_netcdf(nc_path, index_dir, variables = None, block_bytes = 1 << 28):
+    """
+    Index the variables (by default all) of the netCDF output nc_path.  The file is read
+    in blocks of whole time chunks of at most about block_bytes per variable.
+    """
+    import netCDF4
+    d = netCDF4.Dataset(nc_path)
+    if variables is None:
+        variables = [ vn for vn, v in d.variables.items() if v.dimensions == ('time', 'south_north', 'west_east') ]
+    lat, lon = d.variables['lat'][:], d.variables['lon'][:]
+    tv = d.variables['time']
+    times = epoch_to_datetimes(np.asarray(tv[:]))
+
+    Nt = len(times)
+    chunk = d.variables[variables[0]].chunking()
+    tc = chunk[0] if chunk != 'contiguous' else 1
+    n = max(block_bytes // (lat.size * 4) // tc, 1) * tc
+
+    def blocks():
+        for t0 in range(0, Nt, n):
+            yield t0, dict([ (vn, np.ma.filled(d.variables[vn][t0:t0+n], np.nan).astype(np.float32)) for vn in variables ])
+
+    build_index(index_dir, lat, lon, times, blocks(), variables)
+    d.close()
+
+
+
+def index_frames(frame_dir, wrf_file, index_dir, variables = None):
+    """
+    Index the fields variables (by default the analysis fm10_model_state_assim) of the frames
+    in frame_dir, the grid is read from wrf_file.
+    """
+    variables = variables or [ 'fm10_model_state_assim' ]
+    w = WRFModelData(wrf_file, fields = [])
+    num_frames = len(glob.glob(os.path.join(frame_dir, 'frame*.npz')))
+    frames = [ read_frame(frame_path(frame_dir, ndx)) for ndx in range(1, num_frames + 1) ]
+    times = [ f['mt'] for f in frames ]
+
+    def blocks():
+        for t, f in enumerate(frames):
+            yield t, dict([ (vn, f[vn][np.newaxis,:,:]) for vn in variables ])
+
+    build_index(index_dir, w.get_lats(), w.get_lons(), times, blocks(), variables)
+
+
+
+class PointIndex:
+    """
+    Read access to an index built by build_index.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        g = np.load(os.path.join(index_dir, 'grid.npz'))
+        self.lat, self.lon = g['lat'], g['lon']
+        self.times = g['times']
+        self.variables = [ str(vn) for vn in g['variables'] ]
+        self.box, self.bshape, self.pts, self.start = g['box'], g['bshape'], g['pts'], g['start']
+        self.series_maps = {}
+
+
+    def nearest(self, lat, lon):
+        """
+        Return the grid point (i, j) nearest to the position (lat, lon) in the same metric
+        as find_closest_grid_point.  The bins around the position are searched in growing
+        rings until a grid point is found, the distance to that point then bounds the bins
+        which can contain the nearest grid point.
+        """
+        lat0, lon0, dlat, dlon = self.box
+        Bi, Bj = self.bshape
+        bi = int(np.clip((lat - lat0) // dlat, 0, Bi - 1))
+        bj = int(np.clip((lon - lon0) // dlon, 0, Bj - 1))
+        for r in range(max(Bi, Bj)):
+            cand = self.bin_points(bi - r, bi + r, bj - r, bj + r)
+            if len(cand) > 0:
+                break
+
+        # one more bin on each side guards against rounding at the bin edges
+        dmin = np.amin(np.sqrt(self.dist2(cand, lat, lon)))
+        cand = self.bin_points(int((lat - dmin - lat0) // dlat) - 1, int((lat + dmin - lat0) // dlat) + 1,
+                               int((lon - dmin - lon0) // dlon) - 1, int((lon + dmin - lon0) // dlon) + 1)
+        return np.unravel_index(cand[np.argmin(self.dist2(cand, lat, lon))], self.lat.shape)
+
+
+    def bin_points(self, i0, i1, j0, j1):
+        """
+        Return the grid points (flat indices) in the bins i0..i1 x j0..j1 (inclusive).
+        """
+        Bi, Bj = self.bshape
+        i0, i1, j0, j1 = max(i0, 0), min(i1, Bi - 1), max(j0, 0), min(j1, Bj - 1)
+        b = (np.arange(i0, i1 + 1)[:,np.newaxis] * Bj + np.arange(j0, j1 + 1)).ravel()
+        return np.concatenate([ self.pts[self.start[k]:self.start[k+1]] for k in b ] + [ np.zeros(0, dtype = np.intp) ])
+
+
+    def dist2(self, pts, lat, lon):
+        """
+        Return the squared distances (in degrees) of the grid points pts to (lat, lon).
+        """
+        return (lon - self.lon.ravel()[pts])**2 + (lat - self.lat.ravel()[pts])**2
+
+
+    def series_map(self, vn):
+        """
+        Return the (read-only) memory map of the cells x time array of the variable vn.
+        """
+        if vn not in self.series_maps:
+            if vn not in self.variables:
+                raise ValueError('Variable [%s] is not indexed, indexed variables are %s.' % (vn, str(self.variables)))
+            self.series_maps[vn] = np.load(os.path.join(self.index_dir, '%s.npy' % vn), mmap_mode = 'r')
+        return self.series_maps[vn]
+
+
+    def series(self, lat, lon, variables = None, start = None, end = None):
+        """
+        Return the time series of the variables (by default all) at the grid point nearest
+        to (lat, lon) between the datetimes start and end (inclusive, by default all).
+        """
+        i, j = self.nearest(lat, lon)
+        c = i * self.lat.shape[1] + j
+        t0 = np.searchsorted(self.times, epoch_seconds([start])[0]) if start is not None else 0
+        t1 = np.searchsorted(self.times, epoch_seconds([end])[0], side = 'right') if end is not None else len(self.times)
+
+        ts = { 'i' : i, 'j' : j, 'grid_lat' : self.lat[i,j], 'grid_lon' : self.lon[i,j],
+               'times' : epoch_to_datetimes(self.times[t0:t1]) }
+        for vn in (variables or self.variables):
+            ts[vn] = np.array(self.series_map(vn)[c, t0:t1])
+        return ts
+
+
+    def last_days(self, lat, lon, days, variables = None):
+        """
+        Return the time series of the last days (before the last indexed time) at (lat, lon).
+        """
+        end = epoch_to_datetimes(self.times[-1:])[0]
+        return self.series(lat, lon, variables, end - timedelta(days = days), end)
+
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4:
+        print('Usage: point_index.py build <nc_file> <index_dir> [variables]')
+        print('       point_index.py build-frames <frame_dir> <wrf_file> <index_dir> [variables]')
+        print('       point_index.py query <index_dir> <lat> <lon> [days]')
+        sys.exit(1)
+
+    cmd = sys.argv[1]
+    if cmd == 'build':
+        index_netcdf(sys.argv[2], sys.argv[3], sys.argv[4:] or None)
+    elif cmd == 'build-frames':
+        index_frames(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5:] or None)
+    elif cmd == 'query':
+        pi = PointIndex(sys.argv[2])
+        lat, lon = float(sys.argv[3]), float(sys.argv[4])
+        ts = pi.last_days(lat, lon, float(sys.argv[5])) if len(sys.argv) > 5 else pi.series(lat, lon)
+        print("Grid point (%d,%d) at %g, %g" % (ts['i'], ts['j'], ts['grid_lat'], ts['grid_lon']))
+        for k, tm in enumerate(ts['times']):
+            print("%s %s" % (str(tm), ' '.join([ '%s=%g' % (vn, ts[vn][k]) for vn in pi.variables ])))
+    else:
+        raise ValueError('Unknown command [%s].' % cmd)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of selected time steps and pipeline stages.  Profiling is switched on by
+the configuration
+
+    'profile' : { 'steps' : [ (10, 20) ], 'stages' : [ 'kriging', 'kalman' ],
+                  'memory' : True, 'sort' : 'cumulative', 'lines' : 40 }
+
+where steps is a list of inclusive step ranges (all steps if missing), stages lists
+the profiled stages (all if missing) and memory turns on tracking of the peak memory
+with tracemalloc (if available).  Each process writes the sorted report profile_<name>.txt,
+the raw stats profile_<name>.prof (readable by pstats) and profile_<name>_memory.txt
+into the output directory.  Without the 'profile' key, no profiler is constructed.
+
+"""
+
+import cProfile
+import pstats
+import os
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class StepProfiler:
+    """
+    Collects cProfile statistics and peak memory of the code run in the selected steps.
+    """
+
+    def __init__(self, pcfg, output_dir, name):
+        self.steps = pcfg.get('steps')
+        self.sort = pcfg.get('sort', 'cumulative')
+        self.lines = pcfg.get('lines', 40)
+        self.base = os.path.join(output_dir, 'profile_%s' % name)
+        self.prof = cProfile.Profile()
+        self.memory = pcfg.get('memory', False)
+        if self.memory and tracemalloc is None:
+            print("WARN: tracemalloc is not available, memory profiling is disabled.")
+            self.memory = False
+
+        # the largest peak of each label and the snapshot taken after that peak
+        self.mem_peaks = {}
+        self.snapshot = None
+        self.snapshot_label = None
+
+
+    def active(self, t):
+        """
+        Return True if the time step t is profiled.
+        """
+        return self.steps is None or any([ a <= t <= b for (a, b) in self.steps ])
+
+
+    def run(self, label, t, func, *args):
+        """
+        Call func(*args), profiling the call if the step t is selected.  The peak memory
+        of the call is accounted to label.
+        """
+        if not self.active(t):
+            return func(*args)
+
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.stop()
+                tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+
+        self.prof.enable()
+        try:
+            return func(*args)
+        finally:
+            self.prof.disable()
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1] - base
+                if peak > max([0] + list(self.mem_peaks.values())):
+                    self.snapshot = tracemalloc.take_snapshot()
+                    self.snapshot_label = '%s at step %d' % (label, t)
+                self.mem_peaks[label] = max(self.mem_peaks.get(label, 0), peak)
+
+
+    def write_reports(self):
+        """
+        Write the raw statistics and the reports into the output directory.
+        """
+        self.prof.dump_stats(self.base + '.prof')
+        with open(self.base + '.txt', 'w') as f:
+            st = pstats.Stats(self.base + '.prof', stream = f)
+            st.sort_stats(self.sort).print_stats(self.lines)
+
+        if self.memory:
+            tracemalloc.stop()
+            with open(self.base + '_memory.txt', 'w') as f:
+                f.write('Peak memory allocated during the profiled steps:\n')
+                for label in sorted(self.mem_peaks.keys()):
+                    f.write('  %-20s %10.1f kB\n' % (label, self.mem_peaks[label] / 1024.0))
+                if self.snapshot is not None:
+                    f.write('\nLargest allocations live after the largest peak (%s):\n' % self.snapshot_label)
+                    for stat in self.snapshot.statistics('lineno')[:self.lines]:
+                        f.write('  %s\n' % str(stat))
+
+        print("INFO: profile written to [%s.txt]." % self.base)
+
+
+
+def make_profiler(cfg, name):
+    """
+    Return a StepProfiler named name if profiling is configured in cfg, otherwise None.
+    """
+    pcfg = cfg.get('profile')
+    if not pcfg:
+        return None
+    return StepProfiler(pcfg, cfg['output_dir'], name)
+
+
+def profiles_stage(cfg, stage_name):
+    """
+    Return True if the stage stage_name is selected for profiling in cfg.
+    """
+    pcfg = cfg.get('profile')
+    if not pcfg:
+        return False
+    return pcfg.get('stages') is None or stage_name in pcfg['stages']
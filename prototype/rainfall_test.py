@@ -0,0 +1,136 @@
+
+from wrf_model_data import WRFModelData
+from forcing_source import derived_forcing
+
+from datetime import datetime, timedelta
+import numpy as np
+import tempfile
+import shutil
+import os
+
+
+# hours of the WRF times (the fifth interval is two hours long) and the accumulated
+# rainfall [mm], which is reset (e.g. by a restart of WRF) at the fifth time
+hours = [ 0, 1, 2, 3, 4, 6, 7 ]
+accumulation = [ 0.0, 1.0, 3.0, 3.5, 0.5, 2.5, 2.5 ]
+
+# the expected rainfall rates [mm/h], the rate at the first time is not known
+expected_rain = [ 0.0, 1.0, 2.0, 0.5, 0.5, 1.0, 0.0 ]
+
+
+def write_wrf_file(path, bucket_mm = None):
+    """
+    Write a small WRF file with the accumulation above split into RAINC and RAINNC.
+    If bucket_mm is given, RAINNC is stored in buckets of bucket_mm counted in I_RAINNC.
+    """
+    import netCDF4
+    Nt, Ny, Nx = len(hours), 2, 3
+    d = netCDF4.Dataset(path, 'w')
+    d.createDimension('Time', None)
+    d.createDimension('DateStrLen', 19)
+    d.createDimension('south_north', Ny)
+    d.createDimension('west_east', Nx)
+
+    t0 = datetime(2012, 6, 1)
+    tstr = [ (t0 + timedelta(hours = h)).strftime('%Y-%m-%d_%H:%M:%S') for h in hours ]
+    d.createVariable('Times', 'S1', ('Time', 'DateStrLen'))[:] = netCDF4.stringtochar(np.array(tstr, 'S19'))
+
+    def field(vn, values, dtype = 'f4'):
+        d.createVariable(vn, dtype, ('Time', 'south_north', 'west_east'))[:] = \
+            np.array(values)[:,np.newaxis,np.newaxis] * np.ones((Nt, Ny, Nx))
+
+    field('XLAT', [ 39.0 ] * Nt)
+    field('XLONG', [ -105.0 ] * Nt)
+    field('T2', [ 290.0 ] * Nt)
+    field('Q2', [ 0.005 ] * Nt)
+    field('PSFC', [ 80000.0 ] * Nt)
+
+    acc = np.array(accumulation)
+    field('RAINC', 0.25 * acc)
+    if bucket_mm is None:
+        field('RAINNC', 0.75 * acc)
+    else:
+        d.BUCKET_MM = bucket_mm
+        field('RAINNC', np.mod(0.75 * acc, bucket_mm))
+        field('I_RAINNC', np.floor(0.75 * acc / bucket_mm), 'i4')
+        field('I_RAINC', [ 0 ] * Nt, 'i4')
+    d.close()
+
+
+def check_rain(rain, expected, what):
+    err = np.amax(np.abs(np.asarray(rain) - np.asarray(expected)[:,np.newaxis,np.newaxis]))
+    print("INFO: %s max abs difference %g" % (what, err))
+    assert err < 1e-5, '%s rainfall differs from the expected rates by %g' % (what, err)
+
+
+def test_rainfall():
+    """
+    The rates are differenced over the actual intervals and across the reset, in any
+    chunk size and with the accumulation in buckets.
+    """
+    import netCDF4
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for bucket_mm in [ None, 1.0 ]:
+            path = os.path.join(tmp_dir, 'wrf_%s.nc' % bucket_mm)
+            write_wrf_file(path, bucket_mm)
+            for chunk in [ 1, 2, 24 ]:
+                w = WRFModelData(path, fields = [ 'RAINC', 'RAINNC' ])
+                d = netCDF4.Dataset(path)
+                w.compute_rainfall_per_timestep(d, chunk)
+                d.close()
+                check_rain(w['RAIN'], expected_rain, 'bucket %s chunk %d' % (bucket_mm, chunk))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_sliced_rainfall():
+    """
+    A load starting at a later time must difference from the accumulation read at
+    that time (not from zero) and agree with the rates of the full load.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'wrf.nc')
+        write_wrf_file(path)
+        for i0 in [ 1, 2, 4 ]:
+            w = WRFModelData(path, time_slice = slice(i0, None))
+            check_rain(w['RAIN'], [ 0.0 ] + expected_rain[i0+1:], 'sliced load from %d' % i0)
+
+            # the per step forcing of a lazily opened slice must agree
+            w = WRFModelData(path, time_slice = slice(i0, None), lazy = True)
+            rain = [ r.copy() for t, Ed, Ew, r, dt in derived_forcing(w) ]
+            w.close()
+            check_rain(rain, expected_rain[i0+1:], 'lazy sliced forcing from %d' % i0)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_lazy_bucket_rainfall():
+    """
+    The per step forcing of a lazily opened file with the accumulation in buckets must
+    agree with the eager load (an emptied bucket is not a reset).
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'wrf_bucket.nc')
+        write_wrf_file(path, 1.0)
+        for i0 in [ 0, 2 ]:
+            eager = WRFModelData(path, time_slice = slice(i0, None))['RAIN'][1:]
+            w = WRFModelData(path, time_slice = slice(i0, None), lazy = True)
+            rain = [ r.copy() for t, Ed, Ew, r, dt in derived_forcing(w) ]
+            w.close()
+            check_rain(rain, expected_rain[i0+1:], 'lazy bucket forcing from %d' % i0)
+            assert np.all(np.asarray(rain) == eager), 'lazy bucket forcing from %d differs from the eager load' % i0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_module():
+    test_rainfall()
+    test_sliced_rainfall()
+    test_lazy_bucket_rainfall()
+
+
+if __name__ == '__main__':
+    run_module()
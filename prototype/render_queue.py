@@ -0,0 +1,163 @@
+
+"""
+Background rendering of the per-step figures.  The time loop submits render jobs
+(a module level render function and its arguments) to a bounded queue served
+by a pool of worker processes.  The arguments are pickled at submission, so the
+workers always draw a snapshot of the arrays even if the driver modifies them
+afterwards.  When the queue is full, submit blocks until a worker catches up.
+
+    rq = RenderQueue(cfg.get('render_workers', 2), cfg.get('render_queue_size', 8))
+    rq.submit(render_spatial_panels, fname, panels)
+    ...
+    rq.close()
+
+"""
+
+from multiprocessing import Process, Queue
+from Queue import Full
+import cPickle
+
+
+def setup_render_figure():
+    """
+    Load the plotting stack without a display and create the figure reused by all jobs.
+    """
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    plt.figure(figsize = (12, 8))
+
+
+def _render_worker(jobs):
+    """
+    Worker process which executes the render jobs from the queue.
+    """
+    setup_render_figure()
+    while True:
+        # retrieve next assignment (or None if end of queue)
+        job = jobs.get()
+        if job is None:
+            break
+        func, args = cPickle.loads(job)
+        func(*args)
+
+
+
+def put_blocking(jobs, job, workers):
+    """
+    Put the job into the bounded queue jobs, waiting while the queue is full.
+    Raises RuntimeError if all the workers serving the queue have died.
+    """
+    while True:
+        try:
+            jobs.put(job, True, 1.0)
+            return
+        except Full:
+            if not any([w.is_alive() for w in workers]):
+                raise RuntimeError('All workers serving the queue have exited.')
+
+
+
+class RenderQueue:
+    """
+    A bounded queue of render jobs served by background processes.  With zero
+    workers, the jobs are rendered synchronously in the calling process.  A disabled
+    queue (headless runs) drops all jobs and never loads the plotting stack.
+    """
+
+    def __init__(self, num_workers = 2, queue_size = 8, enabled = True):
+        self.enabled = enabled
+        self.num_workers = num_workers if enabled else 0
+        self.figure_ready = False
+        self.workers = []
+        if self.num_workers > 0:
+            self.jobs = Queue(queue_size)
+            self.workers = [ Process(target = _render_worker, args = (self.jobs,)) for i in range(num_workers) ]
+            for w in self.workers:
+                w.start()
+
+
+    def submit(self, func, *args):
+        """
+        Submit the render function func (must be defined at module level) with args.
+        Blocks if the queue is full.
+        """
+        if not self.enabled:
+            return
+        if self.num_workers > 0:
+            put_blocking(self.jobs, cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL), self.workers)
+        else:
+            if not self.figure_ready:
+                setup_render_figure()
+                self.figure_ready = True
+            func(*args)
+
+
+    def close(self, abort = False):
+        """
+        Wait until all submitted jobs are rendered and stop the workers.  If all the
+        workers have died, the remaining jobs are dropped.  With abort (e.g. after
+        the run failed), the workers are terminated without rendering the remaining jobs.
+        """
+        if abort:
+            for w in self.workers:
+                if w.is_alive():
+                    w.terminate()
+        else:
+            try:
+                for w in self.workers:
+                    put_blocking(self.jobs, None, self.workers)
+            except RuntimeError:
+                print("WARN: all render workers have exited, the remaining figures are not rendered.")
+                abort = True
+
+        # the jobs left in the queue must not keep this process from exiting
+        if abort and self.num_workers > 0:
+            self.jobs.cancel_join_thread()
+        for w in self.workers:
+            w.join()
+        self.workers = []
+
+
+
+def render_spatial_panels(fname, panels):
+    """
+    Render a 3x3 grid of fields into the file fname.  Each panel is a tuple
+    (field, title, cmax), the color range of the panel is [0, cmax].
+    """
+    from spatial_model_utilities import render_spatial_field_fast
+    import matplotlib.pyplot as plt
+
+    plt.clf()
+    for i, (field, title, cmax) in enumerate(panels):
+        plt.subplot(3, 3, i+1)
+        render_spatial_field_fast(None, None, None, field, title)
+        plt.clim([0.0, cmax])
+        plt.axis('off')
+        plt.colorbar()
+
+    plt.savefig(fname)
+
+
+def render_model_snapshot(fname, title, obs, krig, mod, mod_na):
+    """
+    Plot the model values at observations points, observations, kriging results etc.
+    """
+    import matplotlib.pyplot as plt
+
+    plt.clf()
+    plt.plot(mod_na, 'go', markersize = 5)
+    plt.plot(mod, 'bo', markersize = 5)
+    leg = [ 'Model', 'Model+Assim']
+    mx = max(max(mod), max(mod_na), 0.5)
+
+    for (v,l,c) in [ (obs, 'Obs.', 'ro'), (krig, 'Kriged', 'mx') ]:
+        # adjust plot depending on whether observations are available
+        if v is not None:
+            mx = max(max(v), mx)
+            leg.append(l)
+            plt.plot(v, c, markersize = 5)
+
+    plt.ylim([0.0, 1.1 * mx])
+    plt.legend(leg)
+    plt.title(title)
+    plt.savefig(fname)
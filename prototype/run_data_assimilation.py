@@ -11,19 +11,21 @@ A more general application that
 @author: martin
 """
 
-from spatial_model_utilities import render_spatial_field_fast, great_circle_distance
+from spatial_model_utilities import great_circle_distance
 from time_series_utilities import build_observation_data
 
 from kriging_methods import trend_surface_model_kriging, universal_kriging_data_to_model
 
 from wrf_model_data import WRFModelData
-from cell_model_opt import CellMoistureModel
+from model_backends import load_backend
+from spinup_cache import initialize_from_cache
+from render_queue import RenderQueue, render_spatial_panels, render_model_snapshot
+from frame_writer import FrameWriter, assimilation_frame
 from mean_field_model import MeanFieldModel
 from observation_stations import MesoWestStation
 from diagnostics import init_diagnostics, diagnostics
 from online_variance_estimator import OnlineVarianceEstimator
 
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import sys
@@ -32,30 +34,6 @@ import cPickle
 import string
 
 
-def plot_model_snapshot(cfg, tm, t, fuel_ndx, obs, krig, mod, mod_na):
-    """
-    Plot the model values at observations points, observations, kriging results etc.
-    """
-    plt.figure()
-
-    plt.plot(mod_na, 'go', markersize = 5)
-    plt.plot(mod, 'bo', markersize = 5)
-    leg = [ 'Model', 'Model+Assim']
-    mx = max(max(mod), max(mod_na), 0.5)
-
-    for (v,l,c) in [ (obs, 'Obs.', 'ro'), (krig, 'Kriged', 'mx') ]:
-        # adjust plot depending on whether observations are available
-        if v is not None:
-            mx = max(max(v), mx)
-            leg.append(l)
-            plt.plot(v, c, markersize = 5)
-
-    plt.ylim([0.0, 1.1 * mx])
-    plt.legend(leg)
-    plt.title('Model behavior for time %s' % str(tm[t]))
-    plt.savefig(os.path.join(cfg['output_dir'], 'model_snapshot_f%d_t%03d.png' % (fuel_ndx, t)))
-
-
 def run_module():
     
     # read in configuration file to execute run
@@ -165,166 +143,142 @@ def run_module():
 
     # construct model grid using standard fuel parameters
     Tk = np.array([1.0, 10.0, 100.0]) * 3600
-    models = np.zeros(dom_shape, dtype = np.object)
-    models_na = np.zeros_like(models)
-    for p in np.ndindex(dom_shape): 
-        models[p] = CellMoistureModel((lat[p], lon[p]), 3, E[p], Tk, P0 = P0)
-        models_na[p] = CellMoistureModel((lat[p], lon[p]), 3, E[p], Tk, P0 = P0)
-
-    m = None
-    plt.figure(figsize = (12, 8))
+    backend = load_backend(cfg.get('model_backend'))
+    models = backend.create_grid(lat, lon, 3, E, Tk, P0)
+    models_na = backend.create_grid(lat, lon, 3, E, Tk, P0)
+
+    # start from a spun-up state if one is cached for this domain and time
+    initialize_from_cache(cfg, lat, lon, tm[0], [models, models_na])
+
+    # background rendering of the per-step figures
+    render_queue = RenderQueue(cfg.get('render_workers', 2), cfg.get('render_queue_size', 8),
+                               not cfg.get('headless', False))
+
+    # per-frame output of the assimilation steps for postprocessing
+    frames = None
+    if cfg.get('write_frames', True):
+        frames = FrameWriter(cfg['output_dir'], queue_size = cfg.get('frame_queue_size', 4),
+                             compress = cfg.get('frame_compress', False))
     
     ###  Run model for each WRF timestep and assimilate data when available
-    for t in range(1, Nt):
-        model_time = tm[t]
-        print("INFO: time: %s, step: %d" % (str(model_time), t))
-
-        # run the model update
-        for p in np.ndindex(dom_shape):
-            i, j = p
-            models[p].advance_model(Ed[t-1, i, j], Ew[t-1, i, j], rain[t-1, i, j], dt, Q)
-            models_na[p].advance_model(Ed[t-1, i, j], Ew[t-1, i, j], rain[t-1, i, j], dt, Q)
-            
-        # prepare visualization data
-        f = np.zeros((dom_shape[0], dom_shape[1], 3))
-        f_na = np.zeros((dom_shape[0], dom_shape[1], 3))
-        for p in np.ndindex(dom_shape):
-            f[p[0], p[1], :] = models[p].get_state()[:3]
-            f_na[p[0], p[1], :] = models_na[p].get_state()[:3]
-            P = models[p].get_state_covar()
-            cV12[p] = P[0,1]
-            mV[p] = P[1,1]
-            mid[p] = models[p].get_model_ids()[1]
-
-        diagnostics().push("fm10_model_var", (t, np.mean(mV)))
-
-        # run Kriging on each observed fuel type
-        Kf = []
-        Vf = []
-        fn = []
-        for obs_data, fuel_ndx in [ (obs_data_fm10, 1) ]:
-
-            # run the kriging subsystem and the Kalman update only if we have observations
-            if model_time in obs_data:
-
-                # retrieve observations for current time
-                obs_t = obs_data[model_time]
-
-
-                # fit the current estimation of the moisture field to the data 
-                base_field = f[:,:,fuel_ndx]
-                mfm.fit_to_data(base_field, obs_data[model_time])
-                
-                # find differences (residuals) between observed measurements and nearest grid points
-                # use this to update observation residual standard deviation 
-                obs_vals = np.array([o.get_value() for o in obs_data[model_time]])
-                mod_vals = np.array([base_field[o.get_nearest_grid_point()] for o in obs_data[model_time]])
-                mod_na_vals = np.array([f_na[:,:,fuel_ndx][o.get_nearest_grid_point()] for o in obs_data[model_time]])
-                obs_re.update_with(obs_vals - mod_vals)
-                diagnostics().push("obs_residual_var", (t, np.mean(obs_re.get_variance())))
+    failed = True
+    try:
+        for t in range(1, Nt):
+            model_time = tm[t]
+            print("INFO: time: %s, step: %d" % (str(model_time), t))
+
+            # run the model update
+            models.advance(Ed[t-1,:,:], Ew[t-1,:,:], rain[t-1,:,:], dt, Q)
+            models_na.advance(Ed[t-1,:,:], Ew[t-1,:,:], rain[t-1,:,:], dt, Q)
             
-                # predict the moisture field using observed fuel type
-                predicted_field = mfm.predict_field(base_field)
+            # prepare visualization data
+            f = models.get_state()[:,:,:3].copy()
+            f_na = models_na.get_state()[:,:,:3].copy()
+            P = models.get_state_covar()
+            cV12 = P[:,:,0,1].copy()
+            mV = P[:,:,1,1].copy()
+            mid = models.get_model_ids()[:,:,1].copy()
 
-                # update the model residual estimator and get current best estimate of variance
-                mod_re.update_with(f[:,:,fuel_ndx] - predicted_field)
-                mresV = mod_re.get_variance()
-                diagnostics().push("fm10_model_residual_var", (t, np.mean(mresV)))
+            diagnostics().push("fm10_model_var", (t, np.mean(mV)))
 
-                # krige observations to grid points
-                Kf_fn, Vf_fn = trend_surface_model_kriging(obs_data[model_time], wrf_data, predicted_field)
+            # run Kriging on each observed fuel type
+            Kf = []
+            Vf = []
+            fn = []
+            for obs_data, fuel_ndx in [ (obs_data_fm10, 1) ]:
 
-                krig_vals = np.array([Kf_fn[o.get_nearest_grid_point()] for o in obs_data[model_time]])                
-                diagnostics().push("assim_data", (t, fuel_ndx, obs_vals, krig_vals, mod_vals, mod_na_vals))
-                plot_model_snapshot(cfg, tm, t, fuel_ndx, obs_vals, krig_vals, mod_vals, mod_na_vals)
+                # run the kriging subsystem and the Kalman update only if we have observations
+                if model_time in obs_data:
 
-                diagnostics().push("fm10_kriging_var", (t, np.mean(Vf_fn)))
+                    # retrieve observations for current time
+                    obs_t = obs_data[model_time]
 
-                # append to storage for kriged fields in this time instant
-                Kf.append(Kf_fn)
-                Vf.append(Vf_fn)
-                fn.append(fuel_ndx)
 
-
-        # if there were any observations, run the kalman update step
-        if len(fn) > 0:
-            Nobs = len(fn)
-            # run the kalman update in each model independently
-            # gather the standard deviations of the moisture fuel after the Kalman update
-            for p in np.ndindex(dom_shape):
-                O = np.zeros((Nobs,))
-                V = np.zeros((Nobs, Nobs))
-                
-                # construct observations for this position
-                for i in range(Nobs):
-                    O[i] = Kf[i][p]
-                    V[i,i] = Vf[i][p]
+                    # fit the current estimation of the moisture field to the data 
+                    base_field = f[:,:,fuel_ndx]
+                    mfm.fit_to_data(base_field, obs_data[model_time])
                 
-                # execute the Kalman update
-                Kp = models[p].kalman_update(O, V, fn)
-                Kg[p[0], p[1], :] = Kp[:, 0]
-
-            # push new diagnostic outputs
-            diagnostics().push("assim_K0", (t, np.mean(Kg[:,:,0])))
-            diagnostics().push("assim_K1", (t, np.mean(Kg[:,:,1])))
-
-        # prepare visualization data        
-        f = np.zeros((dom_shape[0], dom_shape[1], 3))
-        for p in np.ndindex(dom_shape):
-            f[p[0], p[1], :] = models[p].get_state()[:3]
+                    # find differences (residuals) between observed measurements and nearest grid points
+                    # use this to update observation residual standard deviation 
+                    obs_vals = np.array([o.get_value() for o in obs_data[model_time]])
+                    mod_vals = np.array([base_field[o.get_nearest_grid_point()] for o in obs_data[model_time]])
+                    mod_na_vals = np.array([f_na[:,:,fuel_ndx][o.get_nearest_grid_point()] for o in obs_data[model_time]])
+                    obs_re.update_with(obs_vals - mod_vals)
+                    diagnostics().push("obs_residual_var", (t, np.mean(obs_re.get_variance())))
             
-        plt.clf()
-        plt.subplot(3,3,1)
-        render_spatial_field_fast(m, lon, lat, f[:,:,0], '1-hr fuel')
-        plt.clim([0.0, maxE])
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,2)
-        render_spatial_field_fast(m, lon, lat, f[:,:,1], '10-hr fuel')
-        plt.clim([0.0, maxE])        
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,3)
-        render_spatial_field_fast(m, lon, lat, f_na[:,:,1], '10hr fuel - no assim')
-        plt.clim([0.0, maxE])
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,4)
-        render_spatial_field_fast(m, lon, lat, Kg[:,:,0], 'Kalman gain for 1-hr fuel')  
-        plt.clim([0.0, 3.0])        
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,5)
-        render_spatial_field_fast(m, lon, lat, Kg[:,:,1], 'Kalman gain for 10-hr fuel')       
-        plt.clim([0.0, 1.0])        
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,6)
-	render_spatial_field_fast(m, lon, lat, Kf_fn, 'Kriging field')
-	plt.clim([0.0, maxE])
-        plt.axis('off')
-	plt.colorbar()
-        plt.subplot(3,3,7)
-        render_spatial_field_fast(m, lon, lat, mid, 'Model ids')
-        plt.clim([0.0, 5.0])
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,8)
-        render_spatial_field_fast(m, lon, lat, Vf_fn, 'Kriging variance')
-        plt.clim([0.0, np.max(Vf_fn)])
-        plt.axis('off')
-        plt.colorbar()
-        plt.subplot(3,3,9)
-        render_spatial_field_fast(m, lon, lat, mresV, 'Model res. variance')
-        plt.clim([0.0, np.max(mresV)])
-        plt.axis('off')
-        plt.colorbar()
-        
-        plt.savefig(os.path.join(cfg['output_dir'], 'moisture_model_t%03d.png' % t))
-
+                    # predict the moisture field using observed fuel type
+                    predicted_field = mfm.predict_field(base_field)
+
+                    # update the model residual estimator and get current best estimate of variance
+                    mod_re.update_with(f[:,:,fuel_ndx] - predicted_field)
+                    mresV = mod_re.get_variance()
+                    diagnostics().push("fm10_model_residual_var", (t, np.mean(mresV)))
+
+                    # krige observations to grid points
+                    Kf_fn, Vf_fn = trend_surface_model_kriging(obs_data[model_time], wrf_data, predicted_field)
+
+                    krig_vals = np.array([Kf_fn[o.get_nearest_grid_point()] for o in obs_data[model_time]])                
+                    diagnostics().push("assim_data", (t, fuel_ndx, obs_vals, krig_vals, mod_vals, mod_na_vals))
+                    render_queue.submit(render_model_snapshot,
+                                        os.path.join(cfg['output_dir'], 'model_snapshot_f%d_t%03d.png' % (fuel_ndx, t)),
+                                        'Model behavior for time %s' % str(tm[t]), obs_vals, krig_vals, mod_vals, mod_na_vals)
+
+                    diagnostics().push("fm10_kriging_var", (t, np.mean(Vf_fn)))
+
+                    # append to storage for kriged fields in this time instant
+                    Kf.append(Kf_fn)
+                    Vf.append(Vf_fn)
+                    fn.append(fuel_ndx)
+
+
+            # if there were any observations, run the kalman update step
+            if len(fn) > 0:
+                # run the kalman update in each model independently
+                Kg = models.kalman_update(Kf, Vf, fn)[:,:,:,0]
+
+                # push new diagnostic outputs
+                diagnostics().push("assim_K0", (t, np.mean(Kg[:,:,0])))
+                diagnostics().push("assim_K1", (t, np.mean(Kg[:,:,1])))
+
+            # prepare visualization data        
+            f_forecast = f
+            f = models.get_state()[:,:,:3].copy()
+
+            # store the frame of the assimilation step
+            if frames is not None and len(fn) > 0:
+                deltas = np.amax(np.abs(models.get_state()[:,:,3:9]), axis = (0, 1))
+                frames.write(assimilation_frame(model_time, f_forecast[:,:,1], f_na[:,:,1], mV, obs_t, obs_vals,
+                                                Kf_fn, Vf_fn, krig_vals, f[:,:,1], deltas, Kg[:,:,1].copy(),
+                                                mfm.gamma.copy(), np.mean(mresV)))
+            
+            # enqueue the fields for rendering in the background
+            render_queue.submit(render_spatial_panels, os.path.join(cfg['output_dir'], 'moisture_model_t%03d.png' % t),
+                                [ (f[:,:,0], '1-hr fuel', maxE),
+                                  (f[:,:,1], '10-hr fuel', maxE),
+                                  (f_na[:,:,1], '10hr fuel - no assim', maxE),
+                                  (Kg[:,:,0], 'Kalman gain for 1-hr fuel', 3.0),
+                                  (Kg[:,:,1], 'Kalman gain for 10-hr fuel', 1.0),
+                                  (Kf_fn, 'Kriging field', maxE),
+                                  (mid, 'Model ids', 5.0),
+                                  (Vf_fn, 'Kriging variance', np.max(Vf_fn)),
+                                  (mresV, 'Model res. variance', np.max(mresV)) ])
+
+        failed = False
+    finally:
+        # wait for the outstanding figures and frames, after a failure the render
+        # workers are stopped so that the run exits
+        render_queue.close(abort = failed)
+        if frames is not None:
+            frames.close(check = not failed)
 
     # store the diagnostics in a binary file
     diagnostics().dump_store(os.path.join(cfg['output_dir'], 'diagnostics.bin'))
+
+    # headless runs stop here, the plotting stack is only loaded for the summary plots
+    if cfg.get('headless', False):
+        return
+
+    import matplotlib.pyplot as plt
     
     # make a plot of gammas
     plt.figure()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the pipeline (see pipeline.py) on several nested domains concurrently, one
+process per domain.  The domains must share the station list and the WRF times.
+The stations are loaded and the observations are indexed by time step once, each
+domain process only registers the stations to its grid and assimilates the stations
+that lie within its domain.
+
+    python run_nested.py cfg/rf03_nested_d02.cfg cfg/rf03_nested_d03.cfg cfg/rf03_nested_d04.cfg
+
+A configuration with the key 'nest_parent' set to the input_file of another domain
+of the run is coupled to that domain (see nested_domains.py): the parent's analysis
+initializes the child models and sets the moisture in a band along the child's
+boundary ('nest_boundary_width' cells) at each step.  The interpolation weights
+from the parent to the child grid are computed once before the domains are started.
+
+"""
+
+from wrf_model_data import WRFModelData
+from pipeline import PipelineContext, load_mesowest_stations, run_pipeline, default_stages
+from observation_index import ObservationIndex
+from forcing_cache import make_forcing_cache
+from nested_domains import interpolation_weights
+from spatial_model_utilities import great_circle_distance
+
+from multiprocessing import Process, Queue
+import numpy as np
+import sys
+import time
+
+
+def nest_stages(cfg, is_child, is_parent):
+    """
+    Return the stage list of the configuration cfg with the coupling stages inserted
+    after the Kalman update (or after the model advance if there is no update).
+    """
+    stages = list(cfg.get('stages', default_stages))
+    pos = stages.index('kalman') + 1 if 'kalman' in stages else stages.index('advance') + 1
+    if is_parent:
+        stages.insert(pos, 'nest_send')
+    if is_child:
+        stages.insert(pos, 'nest_receive')
+    return stages
+
+
+def _run_domain(cfg, stations, obs_index, nest_parent, nest_children):
+    """
+    Run the pipeline of one domain on the shared stations and observation index.
+    """
+    depth = cfg.get('forcing_prefetch', 0)
+    wrf_data = WRFModelData(cfg['input_file'], fields = [] if depth > 0 else None, tz_name = cfg.get('tz_name'),
+                            forcing_cache = make_forcing_cache(cfg))
+
+    # only the stations within the domain (at most one grid diagonal from the nearest grid point) are used
+    lat, lon = wrf_data.get_lats(), wrf_data.get_lons()
+    max_dist = cfg.get('nest_station_max_dist', great_circle_distance(lon[0,0], lat[0,0], lon[1,1], lat[1,1]))
+    for s in stations:
+        s.register_to_grid(wrf_data)
+    active = [ s.get_dist_to_grid() <= max_dist for s in stations ]
+    print("INFO: domain [%s] assimilates %d of %d stations." % (cfg['input_file'], sum(active), len(stations)))
+
+    ctx = PipelineContext(cfg, wrf_data, stations, obs_index.regrid(stations, active))
+    ctx.nest_parent = nest_parent
+    ctx.nest_children = nest_children
+    run_pipeline(cfg, ctx)
+
+
+def run_nested(cfgs):
+    """
+    Run the domains of the configurations cfgs concurrently.  Returns the list of
+    the configurations whose run failed.
+    """
+    # only the grids and the times are loaded here
+    grids = [ WRFModelData(cfg['input_file'], fields = [], tz_name = cfg.get('tz_name')) for cfg in cfgs ]
+    tm = grids[0].get_epoch_times()
+    for cfg, g in zip(cfgs, grids):
+        if not np.array_equal(g.get_epoch_times(), tm):
+            raise ValueError('Domain [%s] does not have the times of domain [%s].' % (cfg['input_file'], cfgs[0]['input_file']))
+        if cfg.get('Nt') != cfgs[0].get('Nt'):
+            raise ValueError('All nested domains must run the same number of steps.')
+
+    cfg0 = cfgs[0]
+    stations = load_mesowest_stations(cfg0, grids[0])
+    obs_index = ObservationIndex(stations, cfg0.get('obs_var', 'FM'), tm, cfg0.get('assimilation_time_window', 0))
+
+    # couple the children to their parents
+    domains = dict([ (cfg['input_file'], i) for (i, cfg) in enumerate(cfgs) ])
+    parents = [ None ] * len(cfgs)
+    children = [ [] for cfg in cfgs ]
+    for i, cfg in enumerate(cfgs):
+        pf = cfg.get('nest_parent')
+        if pf is None:
+            continue
+        if pf not in domains:
+            raise ValueError('Parent domain [%s] of [%s] is not part of the run.' % (pf, cfg['input_file']))
+        p = domains[pf]
+        ndx, w, inside = interpolation_weights(grids[p].get_lats(), grids[p].get_lons(), grids[i].get_lats(), grids[i].get_lons())
+        if not np.all(inside):
+            print("WARN: %d points of domain [%s] are outside of its parent domain." % (np.sum(~inside), cfg['input_file']))
+        q = Queue(cfg.get('nest_queue_size', 2))
+        parents[i] = (q, ndx, w)
+        children[p].append(q)
+
+    # the parent's state replaces the initial state, so the cached baseline would not match
+    for i, cfg in enumerate(cfgs):
+        if parents[i] is not None and cfg.get('nest_initialize', True) and cfg.get('baseline_cache_dir') is not None:
+            print("INFO: domain [%s] is initialized by its parent, not using the baseline cache." % cfg['input_file'])
+            cfg['baseline_cache_dir'] = None
+        cfg['stages'] = nest_stages(cfg, parents[i] is not None, len(children[i]) > 0)
+
+    # all domains run at the same time, since the children wait for their parents' steps
+    running = []
+    for i, cfg in enumerate(cfgs):
+        p = Process(target = _run_domain, args = (cfg, stations, obs_index, parents[i], children[i]))
+        p.start()
+        running.append((p, cfg))
+        print("INFO: started domain [%s]." % cfg['input_file'])
+
+    failed = []
+    while len(running) > 0:
+        for p, cfg in list(running):
+            if not p.is_alive():
+                p.join()
+                running.remove((p, cfg))
+                if p.exitcode != 0:
+                    print("WARN: domain [%s] failed with exit code %d." % (cfg['input_file'], p.exitcode))
+                    failed.append(cfg)
+                else:
+                    print("INFO: domain [%s] finished." % cfg['input_file'])
+
+        # coupled domains cannot continue without the failed one
+        if len(failed) > 0 and any([ c.get('nest_parent') is not None for c in cfgs ]):
+            for p, cfg in running:
+                p.terminate()
+                p.join()
+                failed.append(cfg)
+            running = []
+
+        time.sleep(0.1)
+
+    return failed
+
+
+def run_module():
+
+    cfgs = []
+    for cfg_file in sys.argv[1:]:
+        print("Reading configuration from [%s]" % cfg_file)
+        with open(cfg_file) as f:
+            cfgs.append(eval(f.read()))
+
+    # domains writing into the same directory would overwrite each other
+    out_dirs = [ cfg['output_dir'] for cfg in cfgs ]
+    if len(set(out_dirs)) != len(out_dirs):
+        raise ValueError('The configurations of a nested run must have distinct output_dir values.')
+
+    if len(run_nested(cfgs)) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_module()
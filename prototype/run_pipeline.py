@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the data assimilation as a pipeline of stages (see pipeline.py):
+1. loads up a configuration file,
+2. obtains data from a WRF model,
+3. reads in observations and metadata for a list of stations,
+4. runs the moisture model and the assimilation mechanism,
+5. passes the results to the configured output sinks.
+
+    python run_pipeline.py cfg/col_1km_pipeline.cfg
+
+"""
+
+from pipeline import run_pipeline
+
+import sys
+
+
+def run_module():
+
+    # read in configuration file to execute run
+    print("Reading configuration from [%s]" % sys.argv[1])
+
+    with open(sys.argv[1]) as f:
+        cfg = eval(f.read())
+
+    run_pipeline(cfg)
+
+
+if __name__ == '__main__':
+    run_module()
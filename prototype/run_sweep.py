@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a sweep of pipeline configurations (see pipeline.py), which typically differ
+only in output_dir, lock_gamma or kriging_strategy.  The configurations are grouped
+by their WRF input and station list, the WRF data and stations of each group are
+loaded once and the variants are run concurrently in forked processes, which share
+the loaded forcing copy-on-write.  Each variant writes into its own output_dir.
+
+    python run_sweep.py cfg/col_1km_pipeline.cfg cfg/col_1km_pipeline_lockg.cfg ...
+
+The number of concurrent variants is limited to the number of processors or to
+the 'sweep_workers' value of the first configuration in a group.
+
+"""
+
+from wrf_model_data import WRFModelData
+from pipeline import PipelineContext, load_mesowest_stations, run_pipeline
+
+from multiprocessing import Process, cpu_count
+import sys
+import time
+
+
+def group_key(cfg):
+    """
+    Return the key identifying the shared inputs of the configuration cfg.
+    """
+    return (cfg['input_file'], cfg.get('tz_name'), cfg.get('station_data_dir'), cfg.get('station_list_file'))
+
+
+def group_configs(cfgs):
+    """
+    Group the configurations by their inputs, the order of the configurations
+    is preserved within each group.  Returns a list of (key, cfg_list).
+    """
+    groups = []
+    ndx = {}
+    for cfg in cfgs:
+        key = group_key(cfg)
+        if key not in ndx:
+            ndx[key] = len(groups)
+            groups.append((key, []))
+        groups[ndx[key]][1].append(cfg)
+    return groups
+
+
+def _run_variant(cfg, wrf_data, stations):
+    """
+    Run one variant of the sweep on the shared WRF data and stations.
+    """
+    run_pipeline(cfg, PipelineContext(cfg, wrf_data, stations))
+
+
+def run_group(cfgs, num_workers):
+    """
+    Load the inputs shared by the configurations cfgs and run the variants in
+    at most num_workers concurrent processes.  Returns the list of the configurations
+    whose run failed.
+    """
+    cfg0 = cfgs[0]
+    print("INFO: loading [%s] for %d variants." % (cfg0['input_file'], len(cfgs)))
+    wrf_data = WRFModelData(cfg0['input_file'], tz_name = cfg0.get('tz_name'))
+    stations = None
+    if cfg0.get('station_list_file') is not None:
+        stations = load_mesowest_stations(cfg0, wrf_data)
+
+    # the forked processes inherit the loaded data, no pickling is involved
+    pending = list(cfgs)
+    running = []
+    failed = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < num_workers:
+            cfg = pending.pop(0)
+            p = Process(target = _run_variant, args = (cfg, wrf_data, stations))
+            p.start()
+            running.append((p, cfg))
+            print("INFO: started variant [%s]." % cfg['output_dir'])
+
+        for p, cfg in list(running):
+            if not p.is_alive():
+                p.join()
+                running.remove((p, cfg))
+                if p.exitcode != 0:
+                    print("WARN: variant [%s] failed with exit code %d." % (cfg['output_dir'], p.exitcode))
+                    failed.append(cfg)
+                else:
+                    print("INFO: variant [%s] finished." % cfg['output_dir'])
+
+        time.sleep(0.1)
+
+    return failed
+
+
+def run_module():
+
+    cfgs = []
+    for cfg_file in sys.argv[1:]:
+        print("Reading configuration from [%s]" % cfg_file)
+        with open(cfg_file) as f:
+            cfgs.append(eval(f.read()))
+
+    # variants writing into the same directory would overwrite each other
+    out_dirs = [ cfg['output_dir'] for cfg in cfgs ]
+    if len(set(out_dirs)) != len(out_dirs):
+        raise ValueError('The configurations of a sweep must have distinct output_dir values.')
+
+    failed = []
+    for key, group in group_configs(cfgs):
+        failed.extend(run_group(group, group[0].get('sweep_workers', cpu_count())))
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_module()
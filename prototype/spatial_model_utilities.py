@@ -7,7 +7,6 @@ Created on Sun Oct 28 18:14:57 2012
 
 import numpy as np
 import os.path
-import matplotlib.pyplot as plt
 import codecs
 import re
 from datetime import datetime, timedelta
@@ -61,6 +60,8 @@ def render_spatial_field(m, lon, lat, field, title, clim = None):
     does not seem to have sufficient resolution.
     TODO: can I obtain more detailed topography?
     """
+    import matplotlib.pyplot as plt
+
 #    dx = (np.max(lon) - np.min(lon)) / 5
 #    dy = (np.max(lat) - np.min(lat)) / 5
 #    lat_rng = (np.min(lat), np.max(lat))
@@ -83,6 +84,8 @@ def render_spatial_field_fast(m, lon, lat, field, title):
     Drop_in replacement for render_spatial_field.  Does not use m, lon, lat
     parameters at all. 
     """
+    import matplotlib.pyplot as plt
+
     plt.imshow(field[::-1,:])
     plt.axis('tight')
     plt.title(title)
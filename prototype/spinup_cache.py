@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Spin-up of the moisture model state.  The forecast-only model is run over prior
+forcing (or over the same forcing repeated several times as a stand-in for its
+climatology) and the resulting state and covariance fields are cached, keyed by
+the domain and the time at which the state is valid.  The drivers initialize
+from the cache instead of from the equilibria at the first timestep.
+
+    python spinup_cache.py spinup.cfg
+
+"""
+
+from wrf_model_data import WRFModelData
+from model_backends import load_backend
+
+import numpy as np
+import hashlib
+import os
+import sys
+
+
+def domain_key(lat, lon):
+    """
+    Compute a key that identifies the domain from the grid point positions.
+    """
+    h = hashlib.sha1()
+    h.update(str(lat.shape).encode('ascii'))
+    h.update(np.ascontiguousarray(lat, dtype = np.float64))
+    h.update(np.ascontiguousarray(lon, dtype = np.float64))
+    return h.hexdigest()[:16]
+
+
+
+class SpinupCache:
+    """
+    A directory of spun-up model states stored as npz files named by the
+    domain key and the time at which the state is valid.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def entry_path(self, lat, lon, valid_time):
+        """
+        Return the path of the cache entry for the domain at valid_time.
+        """
+        return os.path.join(self.cache_dir, 'spinup_%s_%s.npz' % (domain_key(lat, lon), valid_time.strftime('%Y%m%d_%H%M')))
+
+
+    def store(self, lat, lon, valid_time, m_ext, P):
+        """
+        Store the extended state and the state covariance fields valid at valid_time.
+        """
+        path = self.entry_path(lat, lon, valid_time)
+        tmp_path = path[:-4] + '_tmp.npz'
+        np.savez(tmp_path, m_ext = m_ext, P = P)
+        os.rename(tmp_path, path)
+        return path
+
+
+    def lookup(self, lat, lon, valid_time):
+        """
+        Return the tuple (m_ext, P) cached for the domain at valid_time or None
+        if no such state is cached.
+        """
+        path = self.entry_path(lat, lon, valid_time)
+        if not os.path.exists(path):
+            return None
+        d = np.load(path)
+        return d['m_ext'], d['P']
+
+
+
+def run_spinup(wrf_data, backend, Tk, P0, Q, cycles = 1):
+    """
+    Run the forecast-only model over the forcing in wrf_data, starting from
+    the average of the equilibria at timestep 1.  The forcing is traversed
+    cycles times.  Returns the final model grid.
+    """
+    lat, lon = wrf_data.get_lats(), wrf_data.get_lons()
+    tsec = wrf_data.get_epoch_times()
+    rain = wrf_data['RAIN']
+    Ed, Ew = wrf_data.get_moisture_equilibria()
+
+    E = 0.5 * (Ed[1,:,:] + Ew[1,:,:])
+    models = backend.create_grid(lat, lon, 3, E, Tk, P0)
+
+    for c in range(cycles):
+        print("INFO: spin-up cycle %d/%d." % (c+1, cycles))
+        for t in range(1, len(tsec)):
+            dt = float(tsec[t] - tsec[t-1])
+            models.advance(Ed[t,:,:], Ew[t,:,:], rain[t,:,:], dt, Q)
+
+    return models
+
+
+def initialize_from_cache(cfg, lat, lon, start_time, grids):
+    """
+    Set the state of the model grids from the spin-up cache configured
+    in cfg['spinup_cache_dir'], if a state valid at start_time is cached.
+    Returns True if the grids were initialized from the cache.
+    """
+    if cfg.get('spinup_cache_dir') is None:
+        return False
+
+    entry = SpinupCache(cfg['spinup_cache_dir']).lookup(lat, lon, start_time)
+    if entry is None:
+        print("INFO: no spun-up state cached for %s, starting from equilibrium." % str(start_time))
+        return False
+
+    for g in grids:
+        g.set_state(entry[0], entry[1])
+    print("INFO: initialized model state from spin-up cache for %s." % str(start_time))
+    return True
+
+
+
+if __name__ == '__main__':
+
+    # read in configuration file to execute the spin-up
+    print("Reading configuration from [%s]" % sys.argv[1])
+
+    with open(sys.argv[1]) as f:
+        cfg = eval(f.read())
+
+    wrf_data = WRFModelData(cfg['spinup_input_file'])
+    backend = load_backend(cfg.get('model_backend'))
+    Tk = np.array([1.0, 10.0, 100.0]) * 3600
+    Q = np.eye(9) * cfg['Q']
+    P0 = np.eye(9) * cfg['P0']
+
+    models = run_spinup(wrf_data, backend, Tk, P0, Q, cfg.get('spinup_cycles', 1))
+
+    # the state is valid at the last time of the spin-up forcing
+    valid_time = wrf_data.get_gmt_times()[-1]
+    path = SpinupCache(cfg['spinup_cache_dir']).store(wrf_data.get_lats(), wrf_data.get_lons(), valid_time,
+                                                      models.get_state(), models.get_state_covar())
+    print("INFO: stored spun-up state valid at %s in [%s]." % (str(valid_time), path))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the startup time of a headless run: the modules needed by a batch run
+that renders nothing are imported in a fresh interpreter and the time is compared
+to the budget (in seconds).  The check also fails if any plotting (or netCDF)
+module is pulled in by the imports.
+
+    python startup_budget.py [budget] [repeats]
+
+"""
+
+import subprocess
+import sys
+
+
+# the modules imported by a headless pipeline run
+core_modules = [ 'wrf_model_data', 'cell_model', 'model_backends', 'kriging_methods',
+                 'observation_stations', 'diagnostics', 'time_series_utilities',
+                 'mean_field_model', 'spinup_cache', 'pipeline' ]
+
+# modules which must only be loaded when first used
+heavy_modules = [ 'matplotlib', 'pylab', 'mpl_toolkits', 'netCDF4' ]
+
+
+_probe = """
+import sys, time
+before = set(sys.modules)
+t0 = time.time()
+for name in %r:
+    __import__(name)
+dt = time.time() - t0
+heavy = sorted(set([ m.split('.')[0] for m in set(sys.modules) - before if m.split('.')[0] in %r ]))
+print(repr((dt, heavy)))
+"""
+
+
+def measure_startup(modules = core_modules):
+    """
+    Import the modules in a fresh interpreter and return the tuple (seconds, heavy),
+    where heavy is the list of heavy modules that were loaded by the imports.
+    """
+    out = subprocess.check_output([sys.executable, '-c', _probe % (modules, heavy_modules)])
+    return eval(out.decode('ascii').strip().split('\n')[-1])
+
+
+if __name__ == '__main__':
+
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    # the first import may have to compile the modules, take the best of several runs
+    results = [ measure_startup() for i in range(repeats) ]
+    best = min([ r[0] for r in results ])
+    heavy = sorted(set(sum([ r[1] for r in results ], [])))
+
+    print("INFO: headless startup %.3f s (best of %d), budget %.3f s." % (best, repeats, budget))
+    ok = True
+    if len(heavy) > 0:
+        print("WARN: headless imports loaded %s." % ', '.join(heavy))
+        ok = False
+    if best > budget:
+        print("WARN: headless startup exceeds the budget.")
+        ok = False
+
+    sys.exit(0 if ok else 1)
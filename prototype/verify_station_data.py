@@ -17,7 +17,6 @@ from observation_stations import MesoWestStation, Observation
 from statistics import compute_ols_estimator
 from diagnostics import init_diagnostics, diagnostics
 
-from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.dates import DateFormatter
@@ -1,12 +1,219 @@
 
 
-import netCDF4
 import pytz
 from datetime import datetime, timedelta
+from collections import OrderedDict
 import os
 import numpy as np
 
 
+# the WRF variables loaded by default
+default_fields = ['T2', 'Q2', 'PSFC', 'RAINNC', 'RAINC']
+
+# attributes which make netCDF4 mask or transform the values of a variable
+_masking_attrs = [ '_FillValue', 'missing_value', 'valid_min', 'valid_max', 'valid_range', 'scale_factor', 'add_offset' ]
+
+
+
+def decode_wrf_times_epoch(tm):
+    """
+    Decode the WRF character array Times (Nt x 19 characters 'YYYY-MM-DD_hh:mm:ss')
+    into an int64 array of seconds since the epoch (GMT) in one pass over the array.
+    """
+    c = np.ascontiguousarray(tm).view(np.uint8).reshape((-1, 19)).astype(np.int64)
+    if len(c) > 0 and not np.all(c[:, [4, 7, 10, 13, 16]] == [ ord('-'), ord('-'), ord('_'), ord(':'), ord(':') ]):
+        raise ValueError('The Times are not in the WRF format YYYY-MM-DD_hh:mm:ss.')
+    d = c - ord('0')
+    def num(i0, n):
+        return np.sum(d[:, i0:i0+n] * 10 ** np.arange(n - 1, -1, -1), axis = 1)
+
+    months = (num(0, 4) - 1970) * 12 + num(5, 2) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + num(8, 2) - 1
+    return days * 86400 + num(11, 2) * 3600 + num(14, 2) * 60 + num(17, 2)
+
+
+def epoch_to_datetimes(tsec, tz = None):
+    """
+    Convert an array of seconds since the epoch into a list of python datetime
+    objects in the time zone tz (GMT by default).
+    """
+    gmt_tz = pytz.timezone('GMT')
+    tp = [ datetime.utcfromtimestamp(s).replace(tzinfo = gmt_tz) for s in tsec.tolist() ]
+    if tz is not None:
+        tp = [ dt.astimezone(tz) for dt in tp ]
+    return tp
+
+
+def decode_wrf_times(tm):
+    """
+    Decode the WRF character array Times into a list of python datetime objects
+    in the GMT time zone.
+    """
+    return epoch_to_datetimes(decode_wrf_times_epoch(tm))
+
+
+def read_wrf_times(file_name):
+    """
+    Read only the simulation times from the WRF output file file_name (or a series
+    of files, see wrf_series.py).  The times are returned as a list of GMT python
+    datetime objects.
+    """
+    from wrf_series import open_wrf, read_epoch_times
+    d = open_wrf(file_name)
+    tm = epoch_to_datetimes(read_epoch_times(d))
+    d.close()
+    return tm
+
+
+
+def bucket_size(d):
+    """
+    Return the size of the rain buckets (the attribute BUCKET_MM) of the open WRF file d,
+    zero if WRF did not empty the buckets.
+    """
+    return float(d.BUCKET_MM) if 'BUCKET_MM' in d.ncattrs() else 0.0
+
+
+def accumulated_rainfall(v, ts, bucket_mm = 0.0):
+    """
+    Read the total accumulated rainfall (RAINC + RAINNC) at the time indices ts from
+    the netCDF variables v.  If WRF emptied the rain buckets (bucket_mm > 0), the
+    emptied amounts counted in I_RAINC and I_RAINNC are added back.
+    """
+    acc = v['RAINC'][ts,...] + v['RAINNC'][ts,...]
+    if bucket_mm > 0 and 'I_RAINC' in v and 'I_RAINNC' in v:
+        acc += bucket_mm * (v['I_RAINC'][ts,...] + v['I_RAINNC'][ts,...])
+    return acc
+
+
+def rainfall_rates(acc, tsec, acc_prev, t_prev):
+    """
+    Compute the rainfall rates (mm/hr) over the intervals ending at the times tsec
+    (seconds since the epoch) from the accumulated rainfall acc (n x Ny x Nx), where
+    acc_prev is the accumulation at the time t_prev preceding the first interval.
+    A decrease of the accumulation means it was reset (e.g. by a restart of WRF),
+    the rainfall since the reset is then the accumulation itself.
+    """
+    rain = np.empty_like(acc)
+    np.subtract(acc[0], acc_prev, out = rain[0])
+    np.subtract(acc[1:], acc[:-1], out = rain[1:])
+    reset = rain < 0
+    rain[reset] = acc[reset]
+    rain *= 3600.0
+    rain /= np.diff(np.concatenate([[t_prev], tsec])).astype(acc.dtype)[:,np.newaxis,np.newaxis]
+    return rain
+
+
+def rainfall_chunks(d, file_ndx, tsec, chunk = 24):
+    """
+    Yield the tuples (t0, rain) with the rainfall rates of the time steps t0, t0+1, ...
+    of the WRF times with indices file_ndx in the open netCDF file d and the times tsec
+    (seconds since the epoch), reading chunk times at a time.  As the rainfall before
+    the first time is not known, the rainfall at the first time is zero.  If the first
+    time is the start of the file, the accumulation there is taken to be zero, otherwise
+    the accumulation read at the first time is the base of the differences.
+    """
+    bucket_mm = bucket_size(d)
+    v = d.variables
+    acc_prev, t_prev = None, None
+    for t0 in range(0, len(file_ndx), chunk):
+        ts = file_ndx[t0:t0+chunk]
+        acc = np.asarray(accumulated_rainfall(v, ts, bucket_mm))
+        if acc_prev is None:
+            if file_ndx[0] == 0:
+                acc[0] = 0.0
+            rain = np.zeros_like(acc)
+            if len(ts) > 1:
+                rain[1:] = rainfall_rates(acc[1:], tsec[1:len(ts)], acc[0], tsec[0])
+        else:
+            rain = rainfall_rates(acc, tsec[t0:t0+len(ts)], acc_prev, t_prev)
+        acc_prev, t_prev = acc[-1], tsec[t0+len(ts)-1]
+        yield t0, rain
+
+
+def unmask_if_no_fill(var):
+    """
+    Switch off the masked arrays returned by the netCDF4 variable var, if the variable
+    has no fill value (or other attributes for which netCDF4 would mask values).  The
+    values read are the same, but plain arrays avoid the overhead of the masks.
+    """
+    if not any([ a in var.ncattrs() for a in _masking_attrs ]):
+        var.set_auto_mask(False)
+    return var
+
+
+
+class SliceCache:
+    """
+    A cache of the most recently used time slices of the lazily read variables.
+    """
+
+    def __init__(self, max_slices):
+        self.max_slices = max_slices
+        self.slices = OrderedDict()
+
+
+    def get(self, key):
+        s = self.slices.pop(key, None)
+        if s is not None:
+            self.slices[key] = s
+        return s
+
+
+    def put(self, key, s):
+        self.slices[key] = s
+        while len(self.slices) > self.max_slices:
+            self.slices.popitem(last = False)
+
+
+
+class LazyVariable:
+    """
+    A WRF variable read from the open file one time slice at a time, when indexed
+    (the first index is the time index).  The time slices are kept in a SliceCache
+    and are read-only, so that the cached slices cannot be modified.
+    """
+
+    def __init__(self, name, var, file_ndx, cache):
+        self.name = name
+        self.var = var
+        self.file_ndx = file_ndx
+        self.cache = cache
+        self.shape = (len(file_ndx),) + var.shape[1:]
+        self.dtype = var.dtype
+        self.ndim = len(self.shape)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def time_slice(self, t):
+        """
+        Return the slice at time index t.
+        """
+        t = t + self.shape[0] if t < 0 else t
+        if t < 0 or t >= self.shape[0]:
+            raise IndexError('Time index %d out of range for [%s] with %d times.' % (t, self.name, self.shape[0]))
+        s = self.cache.get((self.name, t))
+        if s is None:
+            s = np.asarray(self.var[self.file_ndx[t],...])
+            s.flags.writeable = False
+            self.cache.put((self.name, t), s)
+        return s
+
+
+    def __getitem__(self, ndx):
+        rest = ()
+        if isinstance(ndx, tuple):
+            ndx, rest = ndx[0], ndx[1:]
+        if isinstance(ndx, (int, np.integer)):
+            s = self.time_slice(int(ndx))
+            return s[rest] if len(rest) > 0 else s
+        ts = np.arange(self.shape[0])[ndx]
+        return np.array([ self.time_slice(t)[rest] for t in ts ])
+
+
 
 class WRFModelData:
     """
@@ -14,16 +221,49 @@ class WRFModelData:
     are provided.
     """
     
-    def __init__(self, file_name, fields = None, tz_name = None):
+    def __init__(self, file_name, fields = None, tz_name = None, time_slice = None, lazy = False, cache_slices = 16,
+                 forcing_cache = None):
         """
-        Load data from a file file_name. See load_wrf_data for standard fields that
+        Load data from a file file_name, which may also be a list of files or a glob
+        of a series of WRF files (see wrf_series.py). See load_wrf_data for standard fields that
         are loaded.  The fields can be overridden by passing a new list in the fields
         argument.  The model simulation times can be moved into a different time zone
         by passing in a time zone descriptor in tz_name (must be recognizable for pytz).
         If no time zone is given, the get_times() function assumes GMT is local time. 
+        If time_slice is given, only the selected time slices are loaded.
+
+        If lazy is True, the file is kept open and the fields are read one time slice
+        at a time when indexed (wrf_data['T2'][t]), the last cache_slices slices read
+        are kept in memory.  The derived fields (RAIN, Ed, Ew) are not computed in
+        the lazy mode, forcing_source.derived_forcing derives them per time step.
+
+        If a forcing_cache (see forcing_cache.py) is given, the derived fields are read
+        from the cache, if they are cached, and the WRF variables are then opened
+        lazily.  Otherwise the derived fields are stored in the cache after loading.
+        The storage type of the derived fields is kept in forcing_dtype ('native' unless
+        they were read from the cache).
         """
         self.file_name = file_name
-        self.load_data(file_name, fields)
+        self.time_slice = time_slice if time_slice is not None else slice(None)
+        self.dataset = None
+        var_names = fields if fields is not None else default_fields
+        derives = all([ v in var_names for v in default_fields ])
+
+        cached = None
+        if forcing_cache is not None and derives and not lazy:
+            cached = forcing_cache.lookup(file_name, self.time_slice)
+
+        self.forcing_dtype = 'native'
+        if cached is not None:
+            self.open_lazy(file_name, [ v for v in var_names if v not in ['RAINNC', 'RAINC'] ], cache_slices)
+            self.fields.update(cached)
+            self.forcing_dtype = forcing_cache.dtype
+        elif lazy:
+            self.open_lazy(file_name, fields, cache_slices)
+        else:
+            self.load_data(file_name, fields)
+            if forcing_cache is not None and derives:
+                forcing_cache.store(file_name, self.time_slice, dict([ (fn, self.fields[fn]) for fn in ['Ed', 'Ew', 'RAIN'] ]))
         if tz_name:
             self.construct_local_time(tz_name)
     
@@ -33,65 +273,94 @@ class WRFModelData:
         Load required variables from the file data_file.  A list of variables
         is either supplied or the default list is used which contains the following
         variables: 'T2', 'Q2', 'PSFC', 'RAINC', 'RAINNC'.  The fields
-        'Times', 'XLAT', 'XLONG' are always loaded.
+        'Times', 'XLAT', 'XLONG' are always loaded.  If both rain variables are
+        requested, only the rainfall per timestep RAIN is kept.
         """
         
         # replace empty array by default
         if var_names is None:
-            var_names = ['T2', 'Q2', 'PSFC', 'RAINNC', 'RAINC']
+            var_names = default_fields
             
         self.fields = {}
         
-        d = netCDF4.Dataset(os.path.join(data_file))
+        from wrf_series import open_wrf, read_epoch_times
+        ts = self.time_slice
+        d = open_wrf(data_file)
+        compute_rain = all([v in var_names for v in ['RAINNC', 'RAINC']])
         for vname in var_names:
-            self.fields[vname] = d.variables[vname][:,...]
-            
-        self.fields['lat'] = d.variables['XLAT'][0,:,:]
-        self.fields['lon'] = d.variables['XLONG'][0,:,:]
+            if not (compute_rain and vname in ['RAINNC', 'RAINC']):
+                self.fields[vname] = unmask_if_no_fill(d.variables[vname])[ts,...]
             
-        # time is always loaded and encoded as a list of python datetime objects
-        gmt_tz = pytz.timezone('GMT')
-        tm = d.variables['Times'][:,...]
-        tp = []
-        for t in tm:
-            dt = datetime.strptime(''.join(t), '%Y-%m-%d_%H:%M:%S')
-            dt = dt.replace(tzinfo = gmt_tz)
-            tp.append(dt)
+        self.fields['lat'] = unmask_if_no_fill(d.variables['XLAT'])[0,:,:]
+        self.fields['lon'] = unmask_if_no_fill(d.variables['XLONG'])[0,:,:]
             
-        self.fields['GMT'] = tp
- 
-        d.close()
+        # time is always loaded as seconds since the epoch, the python datetime
+        # objects are only created when requested (see __getitem__)
+        self.file_ndx = np.arange(d.variables['Times'].shape[0])[ts]
+        self.fields['GMT_epoch'] = read_epoch_times(d, ts)
+        self.bucket_mm = bucket_size(d)
 
         # if we have all the rain variables, compute the rainfall in each window
-        if all([v in var_names for v in ['RAINNC', 'RAINC']]):
-            self.compute_rainfall_per_timestep()
-            # remove the fields to reduce memory consumption
-            del self.fields['RAINNC']
-            del self.fields['RAINC']
+        if compute_rain:
+            self.compute_rainfall_per_timestep(d)
+ 
+        d.close()
         
-        # precompute the equilibrium fields needed everywhere
-        self.equilibrium_moisture()
+        # precompute the equilibrium fields needed everywhere (if the fields are loaded)
+        if all([v in var_names for v in ['T2', 'Q2', 'PSFC']]):
+            self.equilibrium_moisture()
 
 
-    def compute_rainfall_per_timestep(self):
+    def open_lazy(self, data_file, var_names, cache_slices):
+        """
+        Open the file data_file for lazy reading of the variables var_names (the default
+        list is the same as in load_data) with a cache of cache_slices time slices.
+        The fields 'Times', 'XLAT', 'XLONG' are loaded.  If the rain variables are opened
+        and WRF emptied the rain buckets, the bucket counts I_RAINC, I_RAINNC are opened too.
+        """
+        if var_names is None:
+            var_names = default_fields
+
+        from wrf_series import open_wrf, read_epoch_times
+        d = open_wrf(data_file)
+        self.dataset = d
+        self.file_ndx = np.arange(d.variables['Times'].shape[0])[self.time_slice]
+        cache = SliceCache(cache_slices)
+
+        self.bucket_mm = bucket_size(d)
+        if self.bucket_mm > 0 and all([ v in var_names for v in ['RAINNC', 'RAINC'] ]):
+            var_names = var_names + [ v for v in ['I_RAINC', 'I_RAINNC'] if v in d.variables and v not in var_names ]
+
+        self.fields = {}
+        for vname in var_names:
+            self.fields[vname] = LazyVariable(vname, unmask_if_no_fill(d.variables[vname]), self.file_ndx, cache)
+
+        self.fields['lat'] = unmask_if_no_fill(d.variables['XLAT'])[0,:,:]
+        self.fields['lon'] = unmask_if_no_fill(d.variables['XLONG'])[0,:,:]
+        self.fields['GMT_epoch'] = read_epoch_times(d, self.time_slice)
+
+
+    def close(self):
+        """
+        Close the file of the lazily read fields.
+        """
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+
+
+    def compute_rainfall_per_timestep(self, d, chunk = 24):
         """
         Compute the rainfall per timestep at each grid point from
-        WRF variables RAINNC and RAINC.
-        """
-        rainnc = self.fields['RAINNC']
-        rainc = self.fields['RAINC']
-        rain = np.zeros_like(rainnc)
-        rain_old = np.zeros_like(rainnc[0,:,:])
-        tm = self.fields['GMT']
-
-        # compute incremental rainfall and store it in mm/hr in the rain variable
-        for i in range(1, len(tm)):
-            t1 = tm[i-1]
-            t2 = tm[i]
-            dt = (t2 - t1).seconds
-            rain[i, :, :] = ((rainc[i,:,:] + rainnc[i,:,:]) - rain_old) * 3600.0 / dt
-            rain_old[:] = rainc[i,:,:]
-            rain_old += rainnc[i,:,:]
+        WRF variables RAINNC and RAINC in the open file d, reading
+        chunk times at a time (see rainfall_chunks).
+        """
+        for vn in [ 'RAINC', 'RAINNC', 'I_RAINC', 'I_RAINNC' ]:
+            if vn in d.variables:
+                unmask_if_no_fill(d.variables[vn])
+        rain = np.zeros((len(self.file_ndx),) + d.variables['RAINC'].shape[1:], dtype = d.variables['RAINC'].dtype)
+        for t0, r in rainfall_chunks(d, self.file_ndx, self.fields['GMT_epoch'], chunk):
+            rain[t0:t0+len(r)] = r
 
         self.fields['RAIN'] = rain
 
@@ -101,18 +370,30 @@ class WRFModelData:
         Changes the local_time variable to a new timezone.  The local time
         can be accessed using the get_times() function.
         """
-        # recode times into datetime objects
-        gt = self['GMT']
+        # the datetime objects are created when the local time is first requested
         self.tz = pytz.timezone(tz_name)
-        lt = [ dt.astimezone(self.tz) for dt in gt]
-        self.fields['LT'] = lt
+        self.fields.pop('LT', None)
         
         
     def get_gmt_times(self):
         """
-        Returns the local time (depends on time zone set).
+        Returns the GMT times as a list of python datetime objects.
         """
         return self['GMT']
+
+
+    def get_epoch_times(self):
+        """
+        Returns the GMT times as an int64 array of seconds since the epoch.
+        """
+        return self['GMT_epoch']
+
+
+    def get_datetime64_times(self):
+        """
+        Returns the GMT times as a datetime64[s] array.
+        """
+        return self['GMT_epoch'].astype('datetime64[s]')
     
     
     def get_local_times(self):
@@ -154,8 +435,13 @@ class WRFModelData:
 
     def __getitem__(self, name):
         """
-        Access a variable from the fields dictionary.
+        Access a variable from the fields dictionary.  The times as datetime objects
+        ('GMT' and 'LT') are created from the epoch times on first access.
         """
+        if name == 'GMT' and name not in self.fields:
+            self.fields['GMT'] = epoch_to_datetimes(self.fields['GMT_epoch'])
+        elif name == 'LT' and name not in self.fields and hasattr(self, 'tz'):
+            self.fields['LT'] = epoch_to_datetimes(self.fields['GMT_epoch'], self.tz)
         return self.fields[name]
 
 
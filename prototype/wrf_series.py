@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+A virtual dataset over a series of WRF files (e.g. one wrfout_d02_<time> file per
+output interval or per day).  The Times of the files are indexed once and the series
+presents one concatenated time axis, variables are read lazily from the files holding
+the requested times.  At most max_open files are kept open, the least recently used
+file is closed first.  The index of the files is stored next to the files and only
+the files that were added or modified since are read again, so reopening a long
+series does not touch the files at all.
+
+The series implements the parts of the netCDF4.Dataset interface used by
+WRFModelData and forcing_source.py, so a glob or a list of files can be used
+wherever a WRF file is expected
+
+    wrf_data = WRFModelData('wrfout/wrfout_d02_2012-06-*', lazy = True)
+    'input_file' : 'wrfout/wrfout_d02_2012-06-*'
+
+"""
+
+from wrf_model_data import decode_wrf_times_epoch
+
+from collections import OrderedDict
+import numpy as np
+import cPickle
+import glob
+import os
+
+
+def is_series(source):
+    """
+    Return True if the WRF source is a series of files (a list of files or a glob).
+    """
+    return isinstance(source, (list, tuple)) or any([ c in source for c in '*?[' ])
+
+
+def wrf_files(source):
+    """
+    Return the sorted list of the files of the WRF source (a file, a list of files or a glob).
+    """
+    if isinstance(source, (list, tuple)):
+        return sorted(source)
+    if is_series(source):
+        files = sorted(glob.glob(source))
+        if len(files) == 0:
+            raise IOError('No WRF files match [%s].' % source)
+        return files
+    return [ source ]
+
+
+def open_wrf(source):
+    """
+    Open the WRF source, a single file as a netCDF4.Dataset, a series as a WRFSeries.
+    """
+    if is_series(source):
+        return WRFSeries(source)
+    import netCDF4
+    return netCDF4.Dataset(source)
+
+
+def read_epoch_times(d, ts = slice(None)):
+    """
+    Return the times with indices ts of the open WRF file or series d as seconds since the epoch.
+    """
+    if isinstance(d, WRFSeries):
+        return d.tsec[ts]
+    return decode_wrf_times_epoch(d.variables['Times'][ts,...])
+
+
+
+class SeriesVariable:
+    """
+    A variable of the series, indexed like a netCDF4 variable with the time index first.
+    """
+
+    def __init__(self, series, name, var):
+        self.series = series
+        self.name = name
+        self.shape = (len(series.tsec),) + var.shape[1:]
+        self.dtype = var.dtype
+        self.ndim = len(self.shape)
+        self.dimensions = var.dimensions
+        self.attrs = dict([ (a, var.getncattr(a)) for a in var.ncattrs() ])
+        self.auto_mask = True
+
+
+    def ncattrs(self):
+        return list(self.attrs.keys())
+
+
+    def set_auto_mask(self, auto_mask):
+        self.auto_mask = auto_mask
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, ndx):
+        rest = ()
+        if isinstance(ndx, tuple):
+            ndx, rest = ndx[0], ndx[1:]
+        ts = np.arange(self.shape[0])[ndx]
+        scalar = np.ndim(ts) == 0
+        ts = np.atleast_1d(ts)
+
+        # read the times held by each file in one request
+        s = self.series
+        parts = []
+        start = 0
+        while start < len(ts):
+            fi = s.file_of[ts[start]]
+            end = start + 1
+            while end < len(ts) and s.file_of[ts[end]] == fi:
+                end += 1
+            local = s.local_ndx[ts[start:end]]
+            v = s.dataset(fi).variables[self.name]
+            v.set_auto_mask(self.auto_mask)
+            if np.all(np.diff(local) == 1):
+                parts.append(v[(slice(local[0], local[-1] + 1),) + rest])
+            else:
+                parts.append(v[(list(local),) + rest])
+            start = end
+
+        if len(parts) == 0:
+            return np.zeros((0,) + self.shape[1:], dtype = self.dtype)[(slice(None),) + rest]
+        res = np.ma.concatenate(parts) if any([ np.ma.isMaskedArray(p) for p in parts ]) else np.concatenate(parts)
+        return res[0] if scalar else res
+
+
+
+class WRFSeries:
+    """
+    A series of WRF files presented as one dataset with a concatenated time axis.
+    """
+
+    def __init__(self, source, max_open = 8, index_file = None):
+        """
+        Index the files of source (a list of files or a glob).  Times present in several
+        files (e.g. overlapping restart output) are taken from the first file.  The index is
+        cached in index_file (by default .wrf_series_index in the directory of the first file).
+        """
+        self.files = wrf_files(source)
+        self.max_open = max_open
+        self.index_file = index_file or os.path.join(os.path.dirname(os.path.abspath(self.files[0])), '.wrf_series_index')
+        self.open_files = OrderedDict()
+        self.index_files()
+
+        tsec, file_of, local_ndx = [], [], []
+        last = None
+        for fi, fn in enumerate(self.files):
+            ft = self.file_times[fn]
+            keep = ft > last if last is not None else np.ones(len(ft), dtype = np.bool_)
+            if not np.all(keep):
+                print("INFO: skipping %d times of [%s] present in earlier files." % (np.sum(~keep), fn))
+            tsec.append(ft[keep])
+            file_of.append(np.repeat(fi, np.sum(keep)))
+            local_ndx.append(np.nonzero(keep)[0])
+            if np.any(keep):
+                last = ft[keep][-1]
+
+        self.tsec = np.concatenate(tsec)
+        self.file_of = np.concatenate(file_of)
+        self.local_ndx = np.concatenate(local_ndx)
+        if np.any(np.diff(self.tsec) <= 0):
+            raise ValueError('The times of the WRF files are not increasing.')
+
+        self.variables = SeriesVariables(self)
+
+
+    def index_files(self):
+        """
+        Read the times of the files, the times of unchanged files are taken from the
+        index file, which is updated if any file had to be read.
+        """
+        index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                index = cPickle.load(f)
+
+        self.file_times = {}
+        changed = False
+        for fn in self.files:
+            st = os.stat(fn)
+            key = os.path.abspath(fn)
+            if key in index and index[key][:2] == (st.st_size, st.st_mtime):
+                self.file_times[fn] = index[key][2]
+            else:
+                self.file_times[fn] = read_epoch_times(self.dataset(self.files.index(fn)))
+                index[key] = (st.st_size, st.st_mtime, self.file_times[fn])
+                changed = True
+
+        if changed:
+            tmp_file = '%s_%d_tmp' % (self.index_file, os.getpid())
+            try:
+                with open(tmp_file, 'wb') as f:
+                    cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_file, self.index_file)
+            except (IOError, OSError) as e:
+                print("WARN: cannot store the index of the WRF files in [%s]: %s" % (self.index_file, str(e)))
+
+
+    def dataset(self, fi):
+        """
+        Return the open dataset of the file with index fi, closing the least
+        recently used file if too many files are open.
+        """
+        fn = self.files[fi]
+        d = self.open_files.pop(fn, None)
+        if d is None:
+            import netCDF4
+            d = netCDF4.Dataset(fn)
+            while len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last = False)[1].close()
+        self.open_files[fn] = d
+        return d
+
+
+    def ncattrs(self):
+        """
+        Return the names of the global attributes (of the first file).
+        """
+        return self.dataset(0).ncattrs()
+
+
+    def __getattr__(self, name):
+        # global attributes are taken from the first file
+        if name.startswith('__') or name in [ 'files', 'open_files' ]:
+            raise AttributeError(name)
+        return self.dataset(0).getncattr(name)
+
+
+    def close(self):
+        """
+        Close all open files.
+        """
+        while len(self.open_files) > 0:
+            self.open_files.popitem(last = False)[1].close()
+
+
+
+class SeriesVariables:
+    """
+    The variables of a series by name, looked up in the first file.
+    """
+
+    def __init__(self, series):
+        self.series = series
+        self.vars = {}
+
+
+    def __contains__(self, name):
+        return name in self.series.dataset(0).variables
+
+
+    def __getitem__(self, name):
+        if name not in self.vars:
+            self.vars[name] = SeriesVariable(self.series, name, self.series.dataset(0).variables[name])
+        return self.vars[name]
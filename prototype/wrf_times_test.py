@@ -0,0 +1,61 @@
+
+from wrf_model_data import decode_wrf_times_epoch, decode_wrf_times
+
+from datetime import datetime
+import numpy as np
+import calendar
+
+
+def wrf_times_array(tstr):
+    """
+    Convert a list of time strings into the WRF character array Times (Nt x 19).
+    """
+    return np.array([ list(s) for s in tstr ], dtype = 'S1')
+
+
+def test_decode_wrf_times_epoch():
+    """
+    The vectorized decoding must agree with strptime on random times (including
+    leap days and month ends) and at the edges of the days and years.
+    """
+    rs = np.random.RandomState(0)
+    t0 = calendar.timegm(datetime(1950, 1, 1).utctimetuple())
+    t1 = calendar.timegm(datetime(2100, 1, 1).utctimetuple())
+    tsec = list(rs.randint(t0, t1, 5000))
+    tsec += [ calendar.timegm(datetime(y, m, d, hh, mm, ss).utctimetuple())
+              for y, m, d, hh, mm, ss in [ (1970, 1, 1, 0, 0, 0), (2000, 2, 29, 23, 59, 59), (2012, 12, 31, 23, 59, 59),
+                                           (2013, 1, 1, 0, 0, 0), (1969, 12, 31, 12, 0, 0), (2100, 2, 28, 6, 30, 15) ] ]
+    tstr = [ datetime.utcfromtimestamp(s).strftime('%Y-%m-%d_%H:%M:%S') for s in tsec ]
+
+    expected = np.array([ calendar.timegm(datetime.strptime(s, '%Y-%m-%d_%H:%M:%S').utctimetuple()) for s in tstr ])
+    decoded = decode_wrf_times_epoch(wrf_times_array(tstr))
+    assert decoded.dtype == np.int64
+    assert np.all(decoded == expected), 'decoded times differ from strptime at %s' % str(np.nonzero(decoded != expected)[0][:5])
+
+    # the datetime objects are in GMT
+    tm = decode_wrf_times(wrf_times_array(tstr[:10]))
+    assert [ t.strftime('%Y-%m-%d_%H:%M:%S') for t in tm ] == tstr[:10]
+    assert all([ t.utcoffset().total_seconds() == 0 for t in tm ])
+    print("INFO: decoded %d times, all equal to strptime." % len(tstr))
+
+
+def test_invalid_wrf_times():
+    """
+    Times not in the WRF format are rejected.
+    """
+    for bad in [ '2012-06-01 00:00:00', '2012/06/01_00:00:00', '2012-06-01_00-00-00' ]:
+        try:
+            decode_wrf_times_epoch(wrf_times_array([ bad ]))
+        except ValueError:
+            continue
+        raise AssertionError('invalid time [%s] was decoded' % bad)
+    assert len(decode_wrf_times_epoch(np.zeros((0, 19), dtype = 'S1'))) == 0
+
+
+def run_module():
+    test_decode_wrf_times_epoch()
+    test_invalid_wrf_times()
+
+
+if __name__ == '__main__':
+    run_module()